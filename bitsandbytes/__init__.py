@@ -12,11 +12,8 @@ from .autograd._functions import (
     mm_cublas,
     matmul_4bit
 )
-from .cextension import COMPILED_WITH_CUDA
 from .nn import modules
-
-if COMPILED_WITH_CUDA:
-    from .optim import adam
+from .optim import adam
 
 __pdoc__ = {
     "libbitsandbytes": False,
@@ -25,3 +22,11 @@ __pdoc__ = {
 }
 
 PACKAGE_GITHUB_URL = "https://github.com/TimDettmers/bitsandbytes"
+
+
+def __getattr__(name):
+    # resolving COMPILED_WITH_CUDA runs the CUDA setup, so it is only done on request
+    if name == "COMPILED_WITH_CUDA":
+        from . import cextension
+        return cextension.COMPILED_WITH_CUDA
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -1 +1 @@
-from ._functions import undo_layout, get_inverse_transform_indices
+from ._functions import undo_layout, get_inverse_transform_indices, GlobalDequantCache
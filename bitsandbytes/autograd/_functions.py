@@ -1,5 +1,6 @@
 import operator
 import warnings
+from collections import OrderedDict
 from dataclasses import dataclass
 from functools import reduce  # Required in Python 3
 from typing import Tuple, Optional, List
@@ -223,6 +224,8 @@ matmul_cublas = MatMul8bit.apply
 
 def supports_igemmlt(device: torch.device) -> bool:
     """check if this device supports the optimized int8 kernel"""
+    if device.type == "cpu":
+        return True  # row-major int8 kernels of the CPU backend
     if torch.cuda.get_device_capability(device=device) < (7, 5):
         return False
     device_name = torch.cuda.get_device_name(device=device)
@@ -232,6 +235,31 @@ def supports_igemmlt(device: torch.device) -> bool:
     return True
 
 
+class SpecialFormat:
+    """
+    Class attribute which is F.get_special_format_str() of the current GPU unless it was assigned.
+
+    The format is looked up on first read instead of at class definition, since querying the GPU
+    initializes CUDA.
+    """
+
+    def __init__(self):
+        self.default = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, obj, objtype=None):
+        if obj is not None and self.name in obj.__dict__:
+            return obj.__dict__[self.name]
+        if self.default is None:
+            self.default = F.get_special_format_str()
+        return self.default
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.name] = value
+
+
 @dataclass
 class MatmulLtState:
     _tile_indices: Optional[torch.Tensor] = None
@@ -255,7 +283,7 @@ class MatmulLtState:
     has_fp16_weights = True
     memory_efficient_backward = False
     use_pool = False
-    formatB = F.get_special_format_str()
+    formatB = SpecialFormat()
 
     def reset_grads(self):
         self.CB = None
@@ -308,19 +336,22 @@ class MatMul8bitLt(torch.autograd.Function):
         # 3. Matmul
         # 4. Mixed-precision decomposition matmul
         # 5. Save state
-        formatB = state.formatB
+        # the CPU kernels work on row-major matrices and quantize fp32/bf16 inputs directly
+        on_cpu = A.device.type == "cpu"
+        formatB = "row" if on_cpu else state.formatB
+        quant_dtype = A.dtype if on_cpu else torch.float16
         input_shape = A.shape
         if state.outlier_pool is None:
             state.outlier_pool = GlobalOutlierPooler.get_instance()
 
         # Cast A to fp16
-        if A.dtype != torch.float16:
+        if A.dtype != quant_dtype:
             warnings.warn(f"MatMul8bitLt: inputs will be cast from {A.dtype} to float16 during quantization")
 
         # 1. Quantize A
         if len(A.shape) == 3:
             A = A.view(-1, A.shape[-1]).contiguous()
-        CA, CAt, SCA, SCAt, coo_tensorA = F.double_quant(A.to(torch.float16), threshold=state.threshold)
+        CA, CAt, SCA, SCAt, coo_tensorA = F.double_quant(A.to(quant_dtype), threshold=state.threshold)
 
         if state.threshold > 0.0 and coo_tensorA is not None:
             if state.has_fp16_weights:
@@ -355,7 +386,7 @@ class MatMul8bitLt(torch.autograd.Function):
                     state.SCB,
                     state.SCBt,
                     coo_tensorB,
-                ) = F.double_quant(B.to(torch.float16))
+                ) = F.double_quant(B.to(quant_dtype))
                 if using_igemmlt:
                     state.CxB, state.SB = F.transform(CB, to_order=formatB)
                 else:
@@ -393,9 +424,12 @@ class MatMul8bitLt(torch.autograd.Function):
 
         # 3. Matmul
         if using_igemmlt:
-            C32A, SA = F.transform(CA, "col32")
+            C32A, SA = (CA, (CA.shape, "row")) if on_cpu else F.transform(CA, "col32")
             out32, Sout32 = F.igemmlt(C32A, state.CxB, SA, state.SB)
-            if bias is None or bias.dtype == torch.float16:
+            if on_cpu:
+                # the output dtype and the bias are handled by the dequantization
+                output = F.mm_dequant(out32, Sout32, SCA, state.SCB, out=torch.empty(out32.shape, dtype=A.dtype), bias=bias)
+            elif bias is None or bias.dtype == torch.float16:
                 # we apply the fused bias here
                 output = F.mm_dequant(out32, Sout32, SCA, state.SCB, bias=bias)
                 output = output.to(A.dtype)
@@ -454,10 +488,11 @@ class MatMul8bitLt(torch.autograd.Function):
         if len(grad_output.shape) == 3:
             grad_output = grad_output.reshape(-1, grad_output.shape[-1]).contiguous()
 
-        Cgrad, Cgradt, SCgrad, SCgradt, coo_tensor = F.double_quant(grad_output.to(torch.float16))
+        on_cpu = grad_output.device.type == "cpu"
+        Cgrad, Cgradt, SCgrad, SCgradt, coo_tensor = F.double_quant(grad_output if on_cpu else grad_output.to(torch.float16))
         if req_gradB:
             CxAt, SAt = F.transform(CAt, formatB, transpose=True)
-            C32grad, Sgrad = F.transform(Cgradt, "col32", transpose=True)
+            C32grad, Sgrad = F.transform(Cgradt, formatB if on_cpu else "col32", transpose=True)
             gradB32, SgradB32 = F.igemmlt(C32grad, CxAt, Sgrad, SAt)
             grad_B = F.mm_dequant(gradB32, SgradB32, SCgradt, SCAt)
             if state.threshold > 0.0 and subA is not None:
@@ -465,7 +500,7 @@ class MatMul8bitLt(torch.autograd.Function):
 
         if req_gradA:
             if state.CBt is not None:
-                C32grad, Sgrad = F.transform(Cgrad, "col32")
+                C32grad, Sgrad = (Cgrad, (Cgrad.shape, "row")) if on_cpu else F.transform(Cgrad, "col32")
                 if state.CxBt is None:
                     state.CxBt, state.SBt = F.transform(state.CBt, to_order=formatB, transpose=True)
                 gradA32, SgradA32 = F.igemmlt(C32grad, state.CxBt, Sgrad, state.SBt)
@@ -475,11 +510,8 @@ class MatMul8bitLt(torch.autograd.Function):
                 CB = state.CB.to(ctx.dtype_A, copy=True).mul_(state.SCB.unsqueeze(1).mul(1.0 / 127.0))
                 grad_A = torch.matmul(grad_output, CB).view(ctx.grad_shape).to(ctx.dtype_A)
             elif state.CxB is not None:
-                CB = (
-                    undo_layout(state.CxB, state.tile_indices)
-                    .to(ctx.dtype_A)
-                    .mul_(state.SCB.unsqueeze(1).mul(1.0 / 127.0))
-                )
+                CxB = state.CxB if on_cpu else undo_layout(state.CxB, state.tile_indices)
+                CB = CxB.to(ctx.dtype_A).mul_(state.SCB.unsqueeze(1).mul(1.0 / 127.0))
                 grad_A = torch.matmul(grad_output, CB).view(ctx.grad_shape).to(ctx.dtype_A)
             else:
                 raise Exception("State must contain either CBt or CB or CxB matrix for backward")
@@ -487,6 +519,72 @@ class MatMul8bitLt(torch.autograd.Function):
         return grad_A, grad_B, None, grad_bias, None
 
 
+class GlobalDequantCache:
+    """
+    Bounded LRU cache of the dequantized 4-bit weights of MatMul4Bit.
+
+    The forward and backward pass and all micro-batches of a gradient accumulation step share
+    the dequantized weight instead of dequantizing it each time. The cache is disabled until a
+    byte budget is set with set_max_bytes. An entry is recomputed if the packed weight was
+    changed in place, and the least recently used entries are evicted to stay within the budget.
+    """
+    _instance = None
+
+    def __init__(self):
+        raise RuntimeError("Call get_instance() instead")
+
+    def initialize(self):
+        self.max_bytes = 0
+        self.num_bytes = 0
+        # (data_ptr, shape, id(quant_state), dtype) -> (quant_state, version, dequantized weight)
+        self.cache = OrderedDict()
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            cls._instance = cls.__new__(cls)
+            cls._instance.initialize()
+        return cls._instance
+
+    def set_max_bytes(self, max_bytes):
+        """Sets the byte budget of the cache, 0 disables it."""
+        self.max_bytes = max_bytes
+        self.evict(0)
+
+    def clear(self):
+        self.cache.clear()
+        self.num_bytes = 0
+
+    def evict(self, num_bytes):
+        """Removes the least recently used entries until num_bytes more fit into the budget."""
+        while self.cache and self.num_bytes + num_bytes > self.max_bytes:
+            _, (_, _, weight) = self.cache.popitem(last=False)
+            self.num_bytes -= weight.numel() * weight.element_size()
+
+    def dequantize(self, B, quant_state, dtype):
+        """Returns the dequantized weight of the packed 4-bit tensor B in dtype."""
+        if self.max_bytes <= 0:
+            return F.dequantize_fp4(B, quant_state).to(dtype)
+
+        # the quantization state is referenced by the entry, so its id identifies the weight
+        key = (B.data_ptr(), tuple(B.shape), id(quant_state), dtype)
+        entry = self.cache.get(key)
+        if entry is not None and entry[1] == B._version:
+            self.cache.move_to_end(key)
+            return entry[2]
+        if entry is not None:
+            del self.cache[key]
+            self.num_bytes -= entry[2].numel() * entry[2].element_size()
+
+        weight = F.dequantize_fp4(B, quant_state).to(dtype)
+        num_bytes = weight.numel() * weight.element_size()
+        if num_bytes <= self.max_bytes:
+            self.evict(num_bytes)
+            self.cache[key] = (quant_state, B._version, weight)
+            self.num_bytes += num_bytes
+        return weight
+
+
 class MatMul4Bit(torch.autograd.Function):
     # forward is the same, but we added the fallback for pre-turing GPUs
     # backward is mostly the same, but adds one extra clause (see "elif state.CxB is not None")
@@ -509,7 +607,7 @@ class MatMul4Bit(torch.autograd.Function):
 
         # 1. Dequantize
         # 2. MatmulnN
-        output = torch.nn.functional.linear(A, F.dequantize_fp4(B, state).to(A.dtype).t(), bias)
+        output = torch.nn.functional.linear(A, GlobalDequantCache.get_instance().dequantize(B, state, A.dtype).t(), bias)
 
         # 3. Save state
         ctx.state = state
@@ -540,7 +638,7 @@ class MatMul4Bit(torch.autograd.Function):
 
         # not supported by PyTorch. TODO: create work-around
         #if req_gradB: grad_B = torch.matmul(grad_output.t(), A)
-        if req_gradA: grad_A = torch.matmul(grad_output, F.dequantize_fp4(B, ctx.state).to(grad_output.dtype).t())
+        if req_gradA: grad_A = torch.matmul(grad_output, GlobalDequantCache.get_instance().dequantize(B, ctx.state, grad_output.dtype).t())
 
         return grad_A, grad_B, None, grad_bias, None
 
@@ -1,5 +1,6 @@
 import ctypes as ct
 import os
+import threading
 import torch
 
 from pathlib import Path
@@ -8,35 +9,90 @@ from warnings import warn
 from bitsandbytes.cuda_setup.main import CUDASetup
 
 
-setup = CUDASetup.get_instance()
-if setup.initialized != True:
-    setup.run_cuda_setup()
-
-lib = setup.lib
-try:
-    if lib is None and torch.cuda.is_available():
-        CUDASetup.get_instance().generate_instructions()
-        CUDASetup.get_instance().print_log_stack()
-        raise RuntimeError('''
-        CUDA Setup failed despite GPU being available. Please run the following command to get more information:
-
-        python -m bitsandbytes
-
-        Inspect the output of the command and see if you can locate CUDA libraries. You might need to add them
-        to your LD_LIBRARY_PATH. If you suspect a bug, please take the information from python -m bitsandbytes
-        and open an issue at: https://github.com/TimDettmers/bitsandbytes/issues''')
-    lib.cadam32bit_grad_fp32 # runs on an error if the library could not be found -> COMPILED_WITH_CUDA=False
-    lib.get_context.restype = ct.c_void_p
-    lib.get_cusparse.restype = ct.c_void_p
-    lib.cget_managed_ptr.restype = ct.c_void_p
-    COMPILED_WITH_CUDA = True
-except AttributeError as ex:
-    warn("The installed version of bitsandbytes was compiled without GPU support. "
-        "8-bit optimizers, 8-bit multiplication, and GPU quantization are unavailable.")
-    COMPILED_WITH_CUDA = False
-    print(str(ex))
-
-
-# print the setup details after checking for errors so we do not print twice
-if 'BITSANDBYTES_NOWELCOME' not in os.environ or str(os.environ['BITSANDBYTES_NOWELCOME']) == '0':
-    setup.print_log_stack()
+_setup_lock = threading.Lock()
+_lib = None
+_compiled_with_cuda = None
+
+
+def load_library():
+    """
+    Runs the CUDA setup and loads the native library on first use.
+
+    Returns
+    -------
+    ctypes.CDLL or None
+        The native library or None if no library could be loaded.
+    """
+    global _lib, _compiled_with_cuda
+    if _compiled_with_cuda is not None:
+        return _lib
+
+    with _setup_lock:
+        if _compiled_with_cuda is not None:
+            return _lib
+
+        setup = CUDASetup.get_instance()
+        if setup.initialized != True:
+            setup.run_cuda_setup()
+
+        lib = setup.lib
+        try:
+            if lib is None and torch.cuda.is_available():
+                CUDASetup.get_instance().generate_instructions()
+                CUDASetup.get_instance().print_log_stack()
+                raise RuntimeError('''
+                CUDA Setup failed despite GPU being available. Please run the following command to get more information:
+
+                python -m bitsandbytes
+
+                Inspect the output of the command and see if you can locate CUDA libraries. You might need to add them
+                to your LD_LIBRARY_PATH. If you suspect a bug, please take the information from python -m bitsandbytes
+                and open an issue at: https://github.com/TimDettmers/bitsandbytes/issues''')
+            lib.cadam32bit_grad_fp32 # runs on an error if the library could not be found -> COMPILED_WITH_CUDA=False
+            lib.get_context.restype = ct.c_void_p
+            lib.get_cusparse.restype = ct.c_void_p
+            lib.cget_managed_ptr.restype = ct.c_void_p
+            compiled_with_cuda = True
+        except AttributeError as ex:
+            warn("The installed version of bitsandbytes was compiled without GPU support. "
+                "8-bit optimizers, 8-bit multiplication, and GPU quantization are unavailable.")
+            compiled_with_cuda = False
+            print(str(ex))
+
+        # print the setup details after checking for errors so we do not print twice
+        if 'BITSANDBYTES_NOWELCOME' not in os.environ or str(os.environ['BITSANDBYTES_NOWELCOME']) == '0':
+            setup.print_log_stack()
+
+        _lib = lib
+        _compiled_with_cuda = compiled_with_cuda
+        return _lib
+
+
+def is_library_loaded():
+    """True if the CUDA setup already ran and the native library was looked up."""
+    return _compiled_with_cuda is not None
+
+
+class LazyLibrary:
+    """
+    Stand-in for the native library which defers the CUDA setup to the first access of a library function.
+
+    This keeps `import bitsandbytes` free of the library search, so that processes which never call
+    into the native code do not pay for it.
+    """
+
+    def __getattr__(self, name):
+        return getattr(load_library(), name)
+
+    def __setattr__(self, name, value):
+        setattr(load_library(), name, value)
+
+
+lib = LazyLibrary()
+
+
+def __getattr__(name):
+    if name == "COMPILED_WITH_CUDA":
+        load_library()
+        return _compiled_with_cuda
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
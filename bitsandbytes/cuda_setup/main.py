@@ -26,6 +26,13 @@ from itertools import product
 from pathlib import Path
 from typing import Set, Union
 from .env_vars import get_potentially_lib_path_containing_env_vars
+from .setup_cache import (
+    load_cached_setup,
+    remove_cached_setup,
+    save_cached_setup,
+    setup_cache_enabled,
+    setup_fingerprint,
+)
 
 # these are the most common libs names
 # libcudart.so is missing by default for a conda install with PyTorch 2.0 and instead
@@ -97,12 +104,14 @@ class CUDASetup:
             self.lib = None
             self.initialized = False
             self.error = False
+            self.cached_setup = None
 
-    def run_cuda_setup(self):
+    def run_cuda_setup(self, use_cache=True):
         self.initialized = True
         self.cuda_setup_log = []
+        self.cached_setup = None
 
-        binary_name, cudart_path, cuda, cc, cuda_version_string = evaluate_cuda_setup()
+        binary_name, cudart_path, cuda, cc, cuda_version_string = evaluate_cuda_setup(use_cache)
         self.cudart_path = cudart_path
         self.cuda = cuda
         self.cc = cc
@@ -140,6 +149,11 @@ class CUDASetup:
         except Exception as ex:
             self.add_log_entry(str(ex))
 
+        if self.lib is None and self.cached_setup is not None:
+            # the cached setup is stale, evaluate it again
+            remove_cached_setup(self.cached_setup)
+            self.run_cuda_setup(use_cache=False)
+
     def add_log_entry(self, msg, is_warning=False):
         self.cuda_setup_log.append((msg, is_warning))
 
@@ -373,13 +387,47 @@ def get_compute_capability(cuda):
     if ccs: return ccs[-1]
 
 
-def evaluate_cuda_setup():
+def evaluate_cuda_setup(use_cache=True):
+    """
+    Determines the binary to load. The result is cached on disk (see `setup_cache`) and reused by later
+    processes as long as the environment it depends on does not change. Results from the cache have no
+    handle of the CUDA driver library.
+    """
     if 'BITSANDBYTES_NOWELCOME' not in os.environ or str(os.environ['BITSANDBYTES_NOWELCOME']) == '0':
         print('')
         print('='*35 + 'BUG REPORT' + '='*35)
         print(('Welcome to bitsandbytes. For bug reports, please run\n\npython -m bitsandbytes\n\n'),
               ('and submit this information together with your error trace to: https://github.com/TimDettmers/bitsandbytes/issues'))
         print('='*80)
+
+    if not (use_cache and setup_cache_enabled()):
+        return discover_cuda_setup()
+
+    cuda_setup = CUDASetup.get_instance()
+    fingerprint = setup_fingerprint()
+    entry = load_cached_setup(fingerprint)
+    if entry is not None:
+        cuda_setup.cached_setup = fingerprint
+        for msg, is_warning in entry["log"]:
+            cuda_setup.add_log_entry(msg, is_warning)
+        cudart_path = None if entry["cudart_path"] is None else Path(entry["cudart_path"])
+        return entry["binary_name"], cudart_path, None, entry["cc"], entry["cuda_version_string"]
+
+    if not hasattr(cuda_setup, 'cuda_setup_log'):
+        cuda_setup.cuda_setup_log = []
+    log_start = len(cuda_setup.cuda_setup_log)
+    binary_name, cudart_path, cuda, cc, cuda_version_string = discover_cuda_setup()
+    save_cached_setup(fingerprint, {
+        "binary_name": binary_name,
+        "cudart_path": None if cudart_path is None else str(cudart_path),
+        "cc": cc,
+        "cuda_version_string": cuda_version_string,
+        "log": cuda_setup.cuda_setup_log[log_start:],
+    })
+    return binary_name, cudart_path, cuda, cc, cuda_version_string
+
+
+def discover_cuda_setup():
     if not torch.cuda.is_available(): return 'libbitsandbytes_cpu.so', None, None, None, None
 
     cuda_setup = CUDASetup.get_instance()
@@ -0,0 +1,128 @@
+"""
+On-disk cache of the CUDA setup evaluation.
+
+Finding the CUDA runtime scans all path-like environment variables and probes the driver, which every
+process would otherwise repeat. The evaluated setup is stored in a small json file per fingerprint of
+everything the evaluation depends on: the directories listed in path-like environment variables and
+their modification times, the driver version, the host, the torch build and the shipped binaries.
+Any change of these leads to a new evaluation.
+
+The cache lives in $BITSANDBYTES_CACHE_DIR, $XDG_CACHE_HOME/bitsandbytes or ~/.cache/bitsandbytes and
+is disabled with BITSANDBYTES_NO_SETUP_CACHE=1.
+"""
+
+import hashlib
+import json
+import os
+import platform
+import tempfile
+import torch
+
+from pathlib import Path
+from typing import Dict, Optional
+
+from .env_vars import get_potentially_lib_path_containing_env_vars
+
+CACHE_VERSION = 1
+
+# environment variables which change the evaluation without containing a path
+FINGERPRINT_ENV_VARS = ["CUDA_VISIBLE_DEVICES", "CUDA_DEVICE_ORDER"]
+
+
+def setup_cache_enabled() -> bool:
+    return os.environ.get("BITSANDBYTES_NO_SETUP_CACHE", "0") in ("", "0")
+
+
+def get_cache_dir() -> Path:
+    if "BITSANDBYTES_CACHE_DIR" in os.environ:
+        return Path(os.environ["BITSANDBYTES_CACHE_DIR"])
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return Path(cache_home) / "bitsandbytes"
+
+
+def path_mtime(path) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def setup_fingerprint() -> str:
+    """Hash of everything the CUDA setup evaluation depends on. Only stats files and directories."""
+    candidate_env_vars = get_potentially_lib_path_containing_env_vars()
+    # the search only finds libraries in existing directories, so other values of the variables do not
+    # matter, which keeps values that differ per process (e.g. PYTEST_CURRENT_TEST) out of the fingerprint
+    priority_env_vars = {name: candidate_env_vars.get(name) for name in ["CONDA_PREFIX", "LD_LIBRARY_PATH"]}
+    directories = set(["/usr/local/cuda/lib64"])
+    if "CONDA_PREFIX" in candidate_env_vars:
+        directories.add(os.path.join(candidate_env_vars["CONDA_PREFIX"], "lib"))
+    for name, value in candidate_env_vars.items():
+        if not name.startswith("BITSANDBYTES_"):
+            directories.update(path for path in value.split(":") if path and os.path.isdir(path))
+
+    package_dir = Path(__file__).parent.parent
+    try:
+        binaries = sorted(name for name in os.listdir(package_dir) if name.startswith("libbitsandbytes"))
+    except OSError:
+        binaries = []
+
+    try:
+        with open("/proc/driver/nvidia/version") as f:
+            driver = f.read()
+    except OSError:
+        driver = None
+
+    fingerprint = {
+        "version": CACHE_VERSION,
+        "host": platform.node(),
+        "torch": torch.__version__,
+        "torch_cuda": torch.version.cuda,
+        "driver": driver,
+        "env": sorted(priority_env_vars.items()),
+        "other_env": [(name, os.environ.get(name)) for name in FINGERPRINT_ENV_VARS],
+        "directories": sorted((path, path_mtime(path)) for path in directories),
+        "binaries": [(name, path_mtime(package_dir / name)) for name in binaries],
+    }
+    return hashlib.sha1(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()
+
+
+def cache_file(fingerprint: str) -> Path:
+    return get_cache_dir() / f"cuda_setup-{fingerprint}.json"
+
+
+def load_cached_setup(fingerprint: str) -> Optional[Dict]:
+    """Returns the cached evaluation for the fingerprint or None if there is none or it is unreadable."""
+    try:
+        with open(cache_file(fingerprint)) as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(entry, dict) or entry.get("version") != CACHE_VERSION:
+        return None
+    return entry
+
+
+def save_cached_setup(fingerprint: str, entry: Dict) -> None:
+    """
+    Writes the evaluation for the fingerprint. The file is written under a temporary name and renamed,
+    so concurrent processes never read a partial file. Failures to write are ignored.
+    """
+    entry = dict(entry, version=CACHE_VERSION)
+    path = cache_file(fingerprint)
+    tmp_path = None
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=".cuda_setup-", suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        if tmp_path is not None and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def remove_cached_setup(fingerprint: str) -> None:
+    try:
+        os.remove(cache_file(fingerprint))
+    except OSError:
+        pass
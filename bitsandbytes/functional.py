@@ -3,30 +3,65 @@
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
 import ctypes as ct
+import inspect
 import itertools
 import operator
 import random
+import threading
 import torch
 import itertools
 import math
-from scipy.stats import norm
+import mmap
 import numpy as np
-
-from functools import reduce  # Required in Python 3
-from typing import Tuple
+import os
+import tempfile
+import time
+
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, reduce  # Required in Python 3
+from typing import List, Tuple
 from torch import Tensor
 
-from .cextension import COMPILED_WITH_CUDA, lib
+from . import cextension
+from .cextension import lib
 
 
 # math.prod not compatible with python < 3.8
 def prod(iterable):
     return reduce(operator.mul, iterable, 1)
 
-name2qmap = {}
+class LibraryFunctionMap(Mapping):
+    """
+    Read-only name -> native functions map which is built on first use.
+
+    Looking up the functions loads the native library, so building the maps at import time would run
+    the CUDA setup on `import bitsandbytes`.
+    """
+
+    def __init__(self, load_maps, name):
+        self.load_maps = load_maps
+        self.name = name
+
+    def functions(self):
+        return self.load_maps().get(self.name, {})
+
+    def __getitem__(self, key):
+        return self.functions()[key]
 
-if COMPILED_WITH_CUDA:
+    def __iter__(self):
+        return iter(self.functions())
+
+    def __len__(self):
+        return len(self.functions())
+
+
+@lru_cache(maxsize=None)
+def load_cuda_optimizer_maps():
     """C FUNCTIONS FOR OPTIMIZERS"""
+    if not cextension.COMPILED_WITH_CUDA:
+        return {}
     str2optimizer32bit = {}
     str2optimizer32bit["adam"] = (lib.cadam32bit_grad_fp32, lib.cadam32bit_grad_fp16, lib.cadam32bit_grad_bf16)
     str2optimizer32bit["momentum"] = (
@@ -93,7 +128,70 @@ if COMPILED_WITH_CUDA:
         lib.cadagrad_8bit_blockwise_grad_fp16,
     )
 
+    return {
+        "str2optimizer32bit": str2optimizer32bit,
+        "str2optimizer8bit": str2optimizer8bit,
+        "str2optimizer8bit_blockwise": str2optimizer8bit_blockwise,
+    }
+
+@lru_cache(maxsize=None)
+def load_cpu_optimizer_maps():
+    if cextension.load_library() is None:
+        return {}
+    # CPU kernels take 16-bit parameters/gradients for all optimizers and the number of elements as int64
+    str2optimizer8bit_blockwise_cpu = {
+        name: (
+            getattr(lib, f"c{name}_8bit_blockwise_grad_fp32_cpu"),
+            getattr(lib, f"c{name}_8bit_blockwise_grad_fp16_cpu"),
+            getattr(lib, f"c{name}_8bit_blockwise_grad_bf16_cpu"),
+        )
+        for name in ["adam", "momentum", "rmsprop", "lion", "adagrad"]
+    }
+    str2optimizer8bit_blockwise_multi_cpu = {
+        name: (
+            getattr(lib, f"c{name}_8bit_blockwise_grad_multi_fp32_cpu"),
+            getattr(lib, f"c{name}_8bit_blockwise_grad_multi_fp16_cpu"),
+            getattr(lib, f"c{name}_8bit_blockwise_grad_multi_bf16_cpu"),
+        )
+        for name in ["adam", "momentum", "rmsprop", "lion", "adagrad"]
+    }
+    str2optimizer32bit_cpu = {
+        name: (
+            getattr(lib, f"c{name}32bit_grad_multi_fp32_cpu"),
+            getattr(lib, f"c{name}32bit_grad_multi_fp16_cpu"),
+            getattr(lib, f"c{name}32bit_grad_multi_bf16_cpu"),
+        )
+        for name in ["adam", "momentum", "rmsprop", "lion", "adagrad"]
+    }
+
+    return {
+        "str2optimizer8bit_blockwise_cpu": str2optimizer8bit_blockwise_cpu,
+        "str2optimizer8bit_blockwise_multi_cpu": str2optimizer8bit_blockwise_multi_cpu,
+        "str2optimizer32bit_cpu": str2optimizer32bit_cpu,
+    }
+
+str2optimizer32bit = LibraryFunctionMap(load_cuda_optimizer_maps, "str2optimizer32bit")
+str2optimizer8bit = LibraryFunctionMap(load_cuda_optimizer_maps, "str2optimizer8bit")
+str2optimizer8bit_blockwise = LibraryFunctionMap(load_cuda_optimizer_maps, "str2optimizer8bit_blockwise")
+str2optimizer8bit_blockwise_cpu = LibraryFunctionMap(load_cpu_optimizer_maps, "str2optimizer8bit_blockwise_cpu")
+str2optimizer8bit_blockwise_multi_cpu = LibraryFunctionMap(load_cpu_optimizer_maps, "str2optimizer8bit_blockwise_multi_cpu")
+str2optimizer32bit_cpu = LibraryFunctionMap(load_cpu_optimizer_maps, "str2optimizer32bit_cpu")
+
 class GlobalPageManager:
+    """
+    Keeps track of the paged tensors and schedules their prefetches.
+
+    Users of paged tensors acquire them under a key, like the parameter of optimizer states, right
+    before they are used and release them afterwards. The manager remembers which key of an owner,
+    like the optimizer, followed which and, on each acquire, prefetches the tensors of the next
+    prefetch_depth keys of the last iteration in the background, so reading them overlaps with the
+    current update. Owners call unregister once their tensors are no longer used. Released tensors
+    are evicted, least recently used first, once the prefetched and acquired tensors exceed
+    max_resident_bytes (None: no limit, paging is left to the driver or the operating system).
+
+    stats counts hits (the tensors were prefetched or still resident), misses (the tensors had to be
+    loaded on acquire), the seconds acquire waited for tensors (stall_time) and the evictions.
+    """
     _instance = None
 
     def __init__(self):
@@ -101,6 +199,25 @@ class GlobalPageManager:
 
     def initialize(self):
         self.paged_tensors = []
+        # directory of the files of memory-mapped paged tensors, None for the system temporary directory
+        self.page_dir = os.environ.get("BITSANDBYTES_PAGE_DIR")
+        self.prefetch_depth = 2
+        self.max_resident_bytes = None
+
+        # key -> tensors, key -> owner, key -> key of the same owner acquired after it in the last
+        # iteration, owner -> last key acquired by the owner
+        self.page_groups = {}
+        self.owners = {}
+        self.successors = {}
+        self.last_keys = {}
+        # key -> bytes of prefetched or acquired tensors which were not evicted, least recently used first
+        self.resident = OrderedDict()
+        self.in_use = set()
+        self.pending = {}
+        if getattr(self, "executor", None) is not None:
+            self.executor.shutdown(wait=True)
+        self.executor = None
+        self.reset_stats()
 
     @classmethod
     def get_instance(cls):
@@ -109,6 +226,9 @@ class GlobalPageManager:
             cls._instance.initialize()
         return cls._instance
 
+    def reset_stats(self):
+        self.stats = {"hits": 0, "misses": 0, "stall_time": 0.0, "evictions": 0}
+
     def prefetch_all(self, to_cpu=False):
         # assume the first added, will be hte
         # ones that are used first, so swap them in last
@@ -116,6 +236,111 @@ class GlobalPageManager:
         for t in self.paged_tensors[::-1]:
             prefetch_tensor(t, to_cpu)
 
+    def evict_all(self):
+        for t in self.paged_tensors:
+            evict_tensor(t)
+        self.resident.clear()
+
+    def unregister(self, owner, tensors=()):
+        """Forgets the keys of owner and removes its tensors from the paged tensors."""
+        for key in [key for key, key_owner in self.owners.items() if key_owner == owner]:
+            future = self.pending.pop(key, None)
+            if future is not None:
+                future.cancel()
+            self.page_groups.pop(key)
+            self.owners.pop(key)
+            self.successors.pop(key, None)
+            self.resident.pop(key, None)
+            self.in_use.discard(key)
+        self.last_keys.pop(owner, None)
+        tensor_ids = {id(t) for t in tensors}
+        if len(tensor_ids) > 0:
+            self.paged_tensors = [t for t in self.paged_tensors if id(t) not in tensor_ids]
+
+    def acquire(self, key, tensors, owner=None):
+        """Makes the paged tensors of key resident before they are used and prefetches the keys which usually follow."""
+        self.page_groups[key] = tensors
+        self.owners[key] = owner
+        last_key = self.last_keys.get(owner)
+        if last_key is not None and last_key != key:
+            self.successors[last_key] = key
+        self.last_keys[owner] = key
+
+        start = time.perf_counter()
+        future = self.pending.pop(key, None)
+        if future is not None:
+            future.result()
+            self.stats["hits"] += 1
+        elif key in self.resident:
+            # the driver migrates managed memory on its own, prefetching it again is asynchronous
+            for t in tensors:
+                if getattr(t, "page_buffer", None) is None:
+                    prefetch_tensor(t)
+            self.stats["hits"] += 1
+        else:
+            for t in tensors:
+                prefetch_tensor(t, blocking=True)
+            self.stats["misses"] += 1
+        self.stats["stall_time"] += time.perf_counter() - start
+
+        self.resident[key] = sum(t.numel()*t.element_size() for t in tensors)
+        self.resident.move_to_end(key)
+        self.in_use.add(key)
+        for next_key in self.upcoming(key):
+            self.schedule_prefetch(next_key)
+
+    def release(self, key):
+        """Marks the tensors of key as no longer used, evicts tensors if the resident budget is exceeded."""
+        if key not in self.in_use:
+            return
+        self.in_use.discard(key)
+        self.resident.move_to_end(key)
+        self.enforce_budget()
+
+    def upcoming(self, key):
+        """The keys which followed key in the last iteration, at most prefetch_depth of them."""
+        keys = []
+        seen = {key}
+        next_key = self.successors.get(key)
+        while next_key is not None and next_key not in seen and len(keys) < self.prefetch_depth:
+            keys.append(next_key)
+            seen.add(next_key)
+            next_key = self.successors.get(next_key)
+        return keys
+
+    def schedule_prefetch(self, key):
+        if key in self.pending or key in self.resident:
+            return
+        tensors = self.page_groups[key]
+        if all(getattr(t, "page_buffer", None) is None for t in tensors):
+            # prefetches of managed memory are asynchronous already
+            for t in tensors:
+                prefetch_tensor(t)
+        else:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bnb_prefetch")
+            self.pending[key] = self.executor.submit(
+                lambda: [prefetch_tensor(t, blocking=True) for t in tensors]
+            )
+        self.resident[key] = sum(t.numel()*t.element_size() for t in tensors)
+
+    def enforce_budget(self):
+        if self.max_resident_bytes is None:
+            return
+        protected = self.in_use.union(self.pending)
+        for last_key in self.last_keys.values():
+            protected.update(self.upcoming(last_key))
+        resident_bytes = sum(self.resident.values())
+        for key in list(self.resident):
+            if resident_bytes <= self.max_resident_bytes:
+                break
+            if key in protected:
+                continue
+            for t in self.page_groups[key]:
+                evict_tensor(t)
+            resident_bytes -= self.resident.pop(key)
+            self.stats["evictions"] += 1
+
 
 
 class CUBLAS_Context:
@@ -159,6 +384,76 @@ class Cusparse_Context:
             cls._instance.initialize()
         return cls._instance
 
+
+class CodebookRegistry:
+    """
+    Process-wide cache of quantization maps (codebooks).
+
+    Each map is built once per builder and arguments and copied once per device and dtype. The
+    returned tensors are shared by all callers and must not be modified in place.
+    """
+    _instance = None
+
+    def __init__(self):
+        raise RuntimeError("Call get_instance() instead")
+
+    def initialize(self):
+        self.lock = threading.Lock()
+        self.codebooks = {}
+        self.signatures = {}
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            cls._instance = cls.__new__(cls)
+            cls._instance.initialize()
+        return cls._instance
+
+    def get_key(self, builder, args, kwargs):
+        # bind the arguments so that create_dynamic_map() and create_dynamic_map(signed=True) share a key
+        if builder not in self.signatures:
+            self.signatures[builder] = inspect.signature(builder)
+        bound = self.signatures[builder].bind(*args, **kwargs)
+        bound.apply_defaults()
+        return (builder, tuple(bound.arguments.items()))
+
+    def get(self, builder, *args, device=None, dtype=torch.float32, **kwargs):
+        """
+        Returns builder(*args, **kwargs) on the device with the dtype.
+
+        Parameters
+        ----------
+        builder : callable
+            The function which builds the map, e.g. create_dynamic_map.
+        device : torch.device or str
+            The device of the map (default: cpu).
+        dtype : torch.dtype
+            The data type of the map.
+        """
+        device = torch.device("cpu" if device is None else device)
+        if device.type == "cuda" and device.index is None:
+            device = torch.device("cuda", torch.cuda.current_device())
+        key = self.get_key(builder, args, kwargs)
+        codebook = self.codebooks.get((key, device, dtype))
+        if codebook is not None:
+            return codebook
+
+        with self.lock:
+            base = self.codebooks.get((key, torch.device("cpu"), torch.float32))
+            if base is None:
+                base = builder(*args, **kwargs).float()
+                self.codebooks[(key, torch.device("cpu"), torch.float32)] = base
+            return self.codebooks.setdefault((key, device, dtype), base.to(device=device, dtype=dtype))
+
+    def clear(self):
+        with self.lock:
+            self.codebooks.clear()
+
+
+def get_codebook(builder, *args, device=None, dtype=torch.float32, **kwargs):
+    """Returns the shared map builder(*args, **kwargs) on the device, see CodebookRegistry."""
+    return CodebookRegistry.get_instance().get(builder, *args, device=device, dtype=dtype, **kwargs)
+
 dtype2bytes = {}
 dtype2bytes[torch.float32] = 4
 dtype2bytes[torch.float16] = 2
@@ -176,8 +471,50 @@ def get_paged(*shape, dtype=torch.float32, device=torch.device('cuda', index=0))
     out.page_deviceid = device.index
     return out
 
-def prefetch_tensor(A, to_cpu=False):
+def get_mmap_paged(*shape, dtype=torch.float32, page_dir=None):
+    """
+    Creates a zero-initialized CPU tensor which is backed by a memory-mapped file.
+
+    The operating system pages the tensor between the main memory and the file, so tensors can be
+    larger than the main memory. The file is created in page_dir, by default the page_dir of the
+    GlobalPageManager ($BITSANDBYTES_PAGE_DIR or the temporary directory), and is unlinked right
+    away, so its space is freed together with the tensor. prefetch_tensor and evict_tensor advise
+    the operating system which tensors are used next.
+    """
+    num_bytes = dtype2bytes[dtype]*prod(shape)
+    if page_dir is None:
+        page_dir = GlobalPageManager.get_instance().page_dir
+    # the file stays open with the tensor, evict_tensor drops its pages from the page cache
+    f = tempfile.TemporaryFile(dir=page_dir)
+    # sparse file, reads of untouched pages return zeros
+    f.truncate(num_bytes)
+    buffer = mmap.mmap(f.fileno(), num_bytes)
+    # optimizer states are read and written front to back, read ahead and drop behind aggressively
+    madvise_buffer(buffer, 'MADV_SEQUENTIAL')
+    out = torch.frombuffer(buffer, dtype=dtype, count=prod(shape)).view(shape)
+    out.is_paged = True
+    out.page_deviceid = -1
+    out.page_buffer = buffer
+    out.page_file = f
+    return out
+
+def madvise_buffer(buffer, advice):
+    # madvise is not available on all platforms, the advice is only a hint
+    option = getattr(mmap, advice, None)
+    if option is not None and hasattr(buffer, 'madvise'):
+        buffer.madvise(option)
+
+def prefetch_tensor(A, to_cpu=False, blocking=False):
     assert A.is_paged, 'Only paged tensors can be prefetched!'
+    buffer = getattr(A, 'page_buffer', None)
+    if buffer is not None:
+        # memory-mapped tensors live on the cpu, start reading them from the file
+        madvise_buffer(buffer, 'MADV_WILLNEED')
+        if blocking:
+            # read one value per page to fault all pages in
+            A.view(-1)[::max(mmap.PAGESIZE // A.element_size(), 1)].sum()
+        return
+
     if to_cpu:
         deviceid = -1
     else:
@@ -186,6 +523,28 @@ def prefetch_tensor(A, to_cpu=False):
     num_bytes = dtype2bytes[A.dtype]*A.numel()
     lib.cprefetch(get_ptr(A), ct.c_size_t(num_bytes), ct.c_int32(deviceid))
 
+def evict_tensor(A):
+    """
+    Moves a paged tensor out of the fast memory: managed memory to the cpu and memory-mapped tensors
+    out of the main memory. Modified pages of memory-mapped tensors are written to their file first,
+    so the content is kept.
+    """
+    assert A.is_paged, 'Only paged tensors can be evicted!'
+    buffer = getattr(A, 'page_buffer', None)
+    if buffer is not None:
+        # write modified pages back, clean pages can be dropped
+        buffer.flush()
+        if hasattr(mmap, 'MADV_PAGEOUT'):
+            madvise_buffer(buffer, 'MADV_PAGEOUT')
+        else:
+            # MADV_DONTNEED only unmaps the pages of a shared mapping, they stay in the page cache
+            # until they are dropped from the file
+            madvise_buffer(buffer, 'MADV_DONTNEED')
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(A.page_file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    else:
+        prefetch_tensor(A, to_cpu=True)
+
 def elementwise_func(func_name, A, B, value, prefetch=True):
     func = None
     if A.dtype == torch.float32:
@@ -233,18 +592,23 @@ def create_linear_map(signed=True, total_bits=8, add_zero=True):
         l = values.numel()//2
         return torch.Tensor(values[:l].tolist() + [0]*gap + values[l:].tolist())
 
+def normal_ppf(p):
+    """Quantile function of the standard normal distribution, evaluated in float64."""
+    p = torch.as_tensor(p, dtype=torch.float64)
+    return math.sqrt(2) * torch.erfinv(2 * p - 1)
+
 def create_normal_map(offset=0.9677083, use_extra_value=True):
 
     if use_extra_value:
         # one more positive value, this is an asymmetric type
-        v1 = norm.ppf(torch.linspace(offset, 0.5, 9)[:-1]).tolist()
+        v1 = normal_ppf(torch.linspace(offset, 0.5, 9)[:-1]).tolist()
         v2 = [0]*(256-15) ## we have 15 non-zero values in this data type
-        v3 = (-norm.ppf(torch.linspace(offset, 0.5, 8)[:-1])).tolist()
+        v3 = (-normal_ppf(torch.linspace(offset, 0.5, 8)[:-1])).tolist()
         v = v1 + v2 + v3
     else:
-        v1 = norm.ppf(torch.linspace(offset, 0.5, 8)[:-1]).tolist()
+        v1 = normal_ppf(torch.linspace(offset, 0.5, 8)[:-1]).tolist()
         v2 = [0]*(256-14) ## we have 14 non-zero values in this data type
-        v3 = (-norm.ppf(torch.linspace(offset, 0.5, 8)[:-1])).tolist()
+        v3 = (-normal_ppf(torch.linspace(offset, 0.5, 8)[:-1])).tolist()
         v = v1 + v2 + v3
 
     values = torch.Tensor(v)
@@ -320,10 +684,10 @@ def create_dynamic_map(signed=True, max_exponent_bits=7, total_bits=8):
     # these are additional items that come from the case
     # where all the exponent bits are zero and no
     # indicator bit is present
-    non_sign_bits = total_bits - (1 if signed else 0)
+    # the unsigned type uses the bit of the sign for a finer fraction, which fraction_items takes
+    # into account, so both have the same number of exponent and additional items
+    non_sign_bits = total_bits - 1
     additional_items = 2 ** (non_sign_bits - max_exponent_bits) - 1
-    if not signed:
-        additional_items = 2 * additional_items
     for i in range(max_exponent_bits):
         fraction_items = int((2 ** (i + non_sign_bits - max_exponent_bits) + 1 if signed else 2 ** (i + non_sign_bits - max_exponent_bits + 1) + 1))
         boundaries = torch.linspace(0.1, 1, fraction_items)
@@ -409,6 +773,18 @@ def get_ptr(A: Tensor) -> ct.c_void_p:
         return ct.c_void_p(A.data.data_ptr())
 
 
+def get_ptr_array(tensors) -> ct.Array:
+    """Get a ctypes array with the pointers of a list of PyTorch tensors (None stays None)."""
+    if tensors is None:
+        return None
+    return (ct.c_void_p*len(tensors))(*[get_ptr(A) for A in tensors])
+
+
+def set_cpu_threads():
+    """Lets the CPU kernels use as many threads as PyTorch (see torch.set_num_threads)."""
+    lib.cset_num_threads_cpu(ct.c_int32(torch.get_num_threads()))
+
+
 def pre_call(device):
     prev_device = torch.cuda.current_device()
     torch.cuda.set_device(device)
@@ -511,6 +887,129 @@ def nvidia_transform(
     return out, new_state
 
 
+class QuantileSketch:
+    """
+    Streaming quantile sketch (KLL) which can be updated chunk by chunk and merged.
+
+    Values are kept in compactors: a value on level h stands for 2**h input values. A full level
+    is sorted and every second value, starting at a random offset, moves to the next level. The
+    sketch holds about 3*k values and the rank error is about 1.7/k. Up to k values the quantiles
+    are exact.
+
+    Parameters
+    ----------
+    k : int
+        The capacity of the top level, which determines the accuracy.
+    seed : int
+        The seed of the random compaction offsets.
+    """
+
+    # values per update step, bounds the temporary memory for large tensors
+    chunk_size = 2**22
+
+    def __init__(self, k=2048, seed=0):
+        self.k = k
+        self.n = 0
+        self.min = float("inf")
+        self.max = float("-inf")
+        self.levels = [torch.empty(0)]
+        self.generator = torch.Generator().manual_seed(seed)
+
+    def capacity(self, level):
+        depth = len(self.levels) - 1 - level
+        return max(8, int(self.k * (2 / 3) ** depth))
+
+    def compress(self):
+        level = 0
+        while level < len(self.levels):
+            values = self.levels[level]
+            if values.numel() > self.capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(torch.empty(0))
+                values = values.sort().values
+                keep = values.numel() % 2
+                offset = int(torch.randint(2, (1,), generator=self.generator))
+                self.levels[level + 1] = torch.cat([self.levels[level + 1], values[keep:][offset::2]])
+                self.levels[level] = values[:keep]
+            level += 1
+
+    def update(self, A: Tensor):
+        """Adds the values of A, any shape and float type on any device. NaN values are skipped."""
+        A = A.detach().reshape(-1)
+        for start in range(0, A.numel(), self.chunk_size):
+            chunk = A[start:start + self.chunk_size].float().cpu()
+            chunk = chunk[~torch.isnan(chunk)]
+            if chunk.numel() == 0:
+                continue
+            self.n += chunk.numel()
+            self.min = min(self.min, chunk.min().item())
+            self.max = max(self.max, chunk.max().item())
+            # a large chunk is sorted once and compacted level by level while it stays sorted
+            level = 0
+            if chunk.numel() > self.k:
+                chunk = chunk.sort().values
+            while chunk.numel() > self.k:
+                if level + 1 == len(self.levels):
+                    self.levels.append(torch.empty(0))
+                keep = chunk.numel() % 2
+                self.levels[level] = torch.cat([self.levels[level], chunk[:keep]])
+                offset = int(torch.randint(2, (1,), generator=self.generator))
+                chunk = chunk[keep:][offset::2]
+                level += 1
+            self.levels[level] = torch.cat([self.levels[level], chunk])
+            self.compress()
+        return self
+
+    def merge(self, other: "QuantileSketch"):
+        """Adds the values of another sketch with the same k, e.g. of another worker."""
+        if other.k != self.k:
+            raise ValueError(f"Cannot merge sketches with different k: {self.k} and {other.k}")
+        for level, values in enumerate(other.levels):
+            if level == len(self.levels):
+                self.levels.append(torch.empty(0))
+            self.levels[level] = torch.cat([self.levels[level], values])
+        self.n += other.n
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.compress()
+        return self
+
+    def quantile(self, q) -> Tensor:
+        """
+        Returns the quantiles q in [0, 1] of the values added so far with linear interpolation
+        between the closest ranks, like torch.quantile.
+        """
+        if self.n == 0:
+            raise ValueError("The sketch is empty.")
+        q = torch.as_tensor(q, dtype=torch.float64)
+        values = torch.cat(self.levels)
+        weights = torch.cat([torch.full((v.numel(),), 2.0**level, dtype=torch.float64) for level, v in enumerate(self.levels)])
+        values, order = values.sort()
+        cumulative = weights[order].cumsum(0)
+
+        rank = q.clamp(0, 1) * (cumulative[-1] - 1)
+        lower = rank.floor()
+        idx_lower = torch.searchsorted(cumulative, lower, right=True).clamp(max=values.numel() - 1)
+        idx_upper = torch.searchsorted(cumulative, rank.ceil(), right=True).clamp(max=values.numel() - 1)
+        frac = (rank - lower).float()
+        out = values[idx_lower] + frac * (values[idx_upper] - values[idx_lower])
+        out = torch.where(q <= 0, torch.full_like(out, self.min), out)
+        out = torch.where(q >= 1, torch.full_like(out, self.max), out)
+        return out
+
+    def state_dict(self):
+        return {"k": self.k, "n": self.n, "min": self.min, "max": self.max, "levels": [v.clone() for v in self.levels]}
+
+    @classmethod
+    def from_state_dict(cls, state_dict, seed=0):
+        sketch = cls(state_dict["k"], seed)
+        sketch.n = state_dict["n"]
+        sketch.min = state_dict["min"]
+        sketch.max = state_dict["max"]
+        sketch.levels = [v.float().cpu() for v in state_dict["levels"]]
+        return sketch
+
+
 def estimate_quantiles(A: Tensor, out: Tensor = None, offset: float = 1 / 512, num_quantiles=256) -> Tensor:
     '''
     Estimates 256 equidistant quantiles on the input tensor eCDF.
@@ -524,9 +1023,12 @@ def estimate_quantiles(A: Tensor, out: Tensor = None, offset: float = 1 / 512, n
     usually has a much lower error but is not a minimum entropy encoding. Given an offset
     of 0.02 equidistance points in the range [0.02, 0.98] are used for the quantiles.
 
+    CPU tensors of any float type and QuantileSketch objects are evaluated with a quantile sketch,
+    which also supports more than 256 quantiles.
+
     Parameters
     ----------
-    A : torch.Tensor
+    A : torch.Tensor or QuantileSketch
         The input tensor. Any shape.
     out : torch.Tensor
         Tensor with the 256 estimated quantiles.
@@ -540,26 +1042,37 @@ def estimate_quantiles(A: Tensor, out: Tensor = None, offset: float = 1 / 512, n
     torch.Tensor:
         The 256 quantiles in float32 datatype.
     '''
-    if A.numel() < 256: raise NotImplementedError(f'Quantile estimation needs at least 256 values in the Tensor, but Tensor had only {A.numel()} values.')
-    if num_quantiles > 256: raise NotImplementedError(f"Currently only a maximum of 256 equally spaced quantiles are supported, but the argument num_quantiles={num_quantiles}")
+    on_cpu = isinstance(A, QuantileSketch) or A.device.type == "cpu"
+    numel = A.n if isinstance(A, QuantileSketch) else A.numel()
+    if numel < 256: raise NotImplementedError(f'Quantile estimation needs at least 256 values in the Tensor, but Tensor had only {numel} values.')
+    if num_quantiles > 256 and not on_cpu: raise NotImplementedError(f"Currently only a maximum of 256 equally spaced quantiles are supported, but the argument num_quantiles={num_quantiles}")
     if num_quantiles < 256 and offset == 1/(512):
         # override default arguments
         offset = 1/(2*num_quantiles)
 
-    if out is None: out = torch.zeros((256,), dtype=torch.float32, device=A.device)
-    is_on_gpu([A, out])
-    device = pre_call(A.device)
-    if A.dtype == torch.float32:
-        lib.cestimate_quantiles_fp32(get_ptr(A), get_ptr(out), ct.c_float(offset), ct.c_int(A.numel()))
-    elif A.dtype == torch.float16:
-        lib.cestimate_quantiles_fp16(get_ptr(A), get_ptr(out), ct.c_float(offset), ct.c_int(A.numel()))
+    if on_cpu:
+        # a rank error well below the default offset of 1/512
+        sketch = A if isinstance(A, QuantileSketch) else QuantileSketch(k=8192).update(A)
+        quantiles = sketch.quantile(torch.linspace(offset, 1 - offset, max(256, num_quantiles), dtype=torch.float64))
+        if out is None:
+            out = quantiles
+        else:
+            out.copy_(quantiles)
     else:
-        raise NotImplementedError(f"Not supported data type {A.dtype}")
-    post_call(device)
+        if out is None: out = torch.zeros((256,), dtype=torch.float32, device=A.device)
+        is_on_gpu([A, out])
+        device = pre_call(A.device)
+        if A.dtype == torch.float32:
+            lib.cestimate_quantiles_fp32(get_ptr(A), get_ptr(out), ct.c_float(offset), ct.c_int(A.numel()))
+        elif A.dtype == torch.float16:
+            lib.cestimate_quantiles_fp16(get_ptr(A), get_ptr(out), ct.c_float(offset), ct.c_int(A.numel()))
+        else:
+            raise NotImplementedError(f"Not supported data type {A.dtype}")
+        post_call(device)
 
     if num_quantiles < 256:
         step = round(256/num_quantiles)
-        idx = torch.linspace(0, 255, num_quantiles).long().to(A.device)
+        idx = torch.linspace(0, 255, num_quantiles).long().to(out.device)
         out = out[idx]
 
     return out
@@ -594,9 +1107,7 @@ def quantize_blockwise(A: Tensor, code: Tensor = None, absmax: Tensor = None, ou
 
 
     if code is None:
-        if "dynamic" not in name2qmap:
-            name2qmap["dynamic"] = create_dynamic_map().to(A.device)
-        code = name2qmap["dynamic"]
+        code = get_codebook(create_dynamic_map, device=A.device)
 
     if absmax is None:
         n = A.numel()
@@ -623,6 +1134,7 @@ def quantize_blockwise(A: Tensor, code: Tensor = None, absmax: Tensor = None, ou
     else:
         # cpu
         code = code.cpu()
+        set_cpu_threads()
         lib.cquantize_blockwise_cpu_fp32(get_ptr(code), get_ptr(A), get_ptr(absmax), get_ptr(out), ct.c_longlong(blocksize), ct.c_longlong(A.numel()))
 
     if nested:
@@ -674,9 +1186,7 @@ def dequantize_blockwise(
     """
     assert quant_state is not None or absmax is not None
     if code is None and quant_state is None:
-        if "dynamic" not in name2qmap:
-            name2qmap["dynamic"] = create_dynamic_map().to(A.device)
-        code = name2qmap["dynamic"]
+        code = get_codebook(create_dynamic_map, device=A.device)
 
     if out is None:
         out = torch.zeros_like(A, dtype=torch.float32)
@@ -706,10 +1216,189 @@ def dequantize_blockwise(
         post_call(A.device)
     else:
         code = code.cpu()
-        lib.cdequantize_blockwise_cpu_fp32(get_ptr(quant_state[1]), get_ptr(A), get_ptr(quant_state[0]), get_ptr(out), ct.c_longlong(blocksize), ct.c_longlong(A.numel()))
+        set_cpu_threads()
+        if out.dtype == torch.float32:
+            lib.cdequantize_blockwise_cpu_fp32(get_ptr(code), get_ptr(A), get_ptr(absmax), get_ptr(out), ct.c_longlong(blocksize), ct.c_longlong(A.numel()))
+        elif out.dtype == torch.float16:
+            lib.cdequantize_blockwise_cpu_fp16(get_ptr(code), get_ptr(A), get_ptr(absmax), get_ptr(out), ct.c_longlong(blocksize), ct.c_longlong(A.numel()))
+        elif out.dtype == torch.bfloat16:
+            lib.cdequantize_blockwise_cpu_bf16(get_ptr(code), get_ptr(A), get_ptr(absmax), get_ptr(out), ct.c_longlong(blocksize), ct.c_longlong(A.numel()))
+        else:
+            raise ValueError(f"Blockwise quantization only supports 16/32-bit floats, but got {out.dtype}")
+
+    return out
+
+def concat_blockwise(tensors: List[Tensor], blocksize: int, dtype: torch.dtype) -> Tuple[Tensor, List[int]]:
+    """
+    Concatenates the flattened tensors into one buffer, each padded with zeros to a multiple of blocksize.
+
+    No block of the buffer spans two tensors, so quantizing the buffer blockwise gives the same
+    values as quantizing each tensor on its own. Returns the buffer and the offset of each tensor.
+    """
+    offsets = []
+    parts = []
+    total = 0
+    padding = torch.zeros((blocksize,), dtype=dtype, device=tensors[0].device)
+    for A in tensors:
+        n = A.numel()
+        offsets.append(total)
+        parts.append(A.reshape(-1).to(dtype))
+        pad = -n % blocksize
+        if pad > 0:
+            parts.append(padding[:pad])
+        total += n + pad
+    return torch.cat(parts), offsets
+
+
+def quantize_blockwise_many(tensors: List[Tensor], code: Tensor = None, blocksize=256, nested=False) -> Tuple[Tensor, list]:
+    """
+    Quantizes a list of tensors blockwise with a single call into the library.
+
+    The tensors are packed into one flat buffer (see concat_blockwise) which is quantized
+    with quantize_blockwise, so all tensors share one absmax array. Each tensor is padded
+    to a full block, which costs up to blocksize - 1 extra values per tensor, so the default
+    blocksize is small.
+
+    Parameters
+    ----------
+    tensors : list(torch.Tensor)
+        The input tensors, all on the same device.
+    code : torch.Tensor
+        The quantization map.
+    blocksize : int
+        The blocksize used in quantization. Larger blocks need fewer absmax values but more padding.
+    nested : bool
+        Quantize the shared absmax array as well.
+
+    Returns
+    -------
+    torch.Tensor:
+        The flat 8-bit buffer of all tensors.
+    list:
+        The quantization state [quant_state, offsets, shapes, dtypes], where quant_state is the state of
+        quantize_blockwise for the flat buffer and offsets are the positions of the tensors in it.
+    """
+    dtypes = [A.dtype for A in tensors]
+    # the CPU kernel quantizes fp32 inputs
+    dtype = dtypes[0] if len(set(dtypes)) == 1 and dtypes[0] == torch.float16 and tensors[0].device.type != 'cpu' else torch.float32
+    flat, offsets = concat_blockwise(tensors, blocksize, dtype)
+    out, quant_state = quantize_blockwise(flat, code=code, blocksize=blocksize, nested=nested)
+    return out, [quant_state, offsets, [A.shape for A in tensors], dtypes]
 
+
+def dequantize_blockwise_many(A: Tensor, state: list, out: List[Tensor] = None) -> List[Tensor]:
+    """
+    Dequantizes the flat buffer of quantize_blockwise_many with a single call into the library.
+
+    Parameters
+    ----------
+    A : torch.Tensor
+        The flat 8-bit buffer.
+    state : list
+        The quantization state of quantize_blockwise_many.
+    out : list(torch.Tensor)
+        Tensors the dequantized values are copied into, e.g. the original tensors.
+
+    Returns
+    -------
+    list(torch.Tensor):
+        The dequantized tensors in their original dtypes.
+    """
+    quant_state, offsets, shapes, dtypes = state
+    flat = dequantize_blockwise(A, quant_state)
+    tensors = [flat[offset:offset + prod(shape)].view(shape).to(dtype) for offset, shape, dtype in zip(offsets, shapes, dtypes)]
+    if out is None:
+        return tensors
+    for dst, src in zip(out, tensors):
+        dst.copy_(src)
     return out
 
+
+# Decision pivots and code values of the 4-bit data types. These mirror the
+# binary search trees of dQuantizeFP4/dQuantizeNF4 and dDequantizeFP4Tree/dDequantizeNF4
+# in csrc/kernels.cu so that the CPU path produces the same bits as the CUDA kernels.
+fp4_pivots = torch.tensor([0.00260417, 0.0859375, 0.20833333, 0.29166667, 0.4166667, 0.583333, 0.8333333], dtype=torch.float32)
+# FP4 code (without sign bit) of the i-th interval of |x| between the pivots
+fp4_interval2code = torch.tensor([0b000, 0b001, 0b110, 0b111, 0b100, 0b101, 0b010, 0b011], dtype=torch.int32)
+fp4_code2value = torch.tensor([
+    0.0, 5.208333333e-03, 0.66666667, 1.0, 0.33333333, 0.5, 0.16666667, 0.25,
+    -0.0, -5.208333333e-03, -0.66666667, -1.0, -0.33333333, -0.5, -0.16666667, -0.25], dtype=torch.float32)
+
+nf4_pivots = torch.tensor([
+    -0.8480964004993439, -0.6106329262256622, -0.4599952697753906, -0.33967943489551544,
+    -0.23460740596055984, -0.13791173323988914, -0.045525018125772476, 0.03979014977812767,
+    0.1202552504837513, 0.2035212516784668, 0.2920137718319893, 0.3893125355243683,
+    0.5016634166240692, 0.6427869200706482, 0.8614784181118011], dtype=torch.float32)
+nf4_code2value = torch.tensor([
+    -1.0, -0.6961928009986877, -0.5250730514526367, -0.39491748809814453,
+    -0.28444138169288635, -0.18477343022823334, -0.09105003625154495, 0.0,
+    0.07958029955625534, 0.16093020141124725, 0.24611230194568634, 0.33791524171829224,
+    0.44070982933044434, 0.5626170039176941, 0.7229568362236023, 1.0], dtype=torch.float32)
+
+# number of blocks the CPU 4-bit routines process at once; bounds the size of temporaries
+CPU_4BIT_CHUNK_BLOCKS = 2**14
+
+
+def quantize_4bit_cpu(A: Tensor, absmax: Tensor, out: Tensor, blocksize: int, quant_type: str) -> None:
+    """
+    Blockwise 4-bit quantization on the CPU.
+
+    Vectorized equivalent of the FP4/NF4 kQuantizeBlockwise kernel. Writes the
+    block absmax into `absmax` and two 4-bit values per byte into `out`.
+    """
+    n = A.numel()
+    A = A.reshape(-1)
+    out = out.view(-1)
+    num_blocks = absmax.numel()
+    for block_start in range(0, num_blocks, CPU_4BIT_CHUNK_BLOCKS):
+        block_end = min(block_start + CPU_4BIT_CHUNK_BLOCKS, num_blocks)
+        start, end = block_start*blocksize, min(block_end*blocksize, n)
+        chunk = A[start:end].float()
+        pad = (block_end - block_start)*blocksize - chunk.numel()
+        if pad > 0:
+            # the CUDA kernel fills partial blocks with zeros
+            chunk = torch.nn.functional.pad(chunk, (0, pad))
+        chunk = chunk.view(-1, blocksize)
+
+        local_absmax = chunk.abs().amax(dim=1)
+        absmax[block_start:block_end] = local_absmax
+        normed = chunk * local_absmax.reciprocal().unsqueeze(1)
+
+        if quant_type == 'fp4':
+            codes = fp4_interval2code[torch.bucketize(normed.abs(), fp4_pivots, out_int32=True).long()]
+            codes |= (normed < 0).int() << 3
+        else:
+            codes = torch.bucketize(normed, nf4_pivots, out_int32=True)
+        # all-zero blocks produce NaN; every comparison in the CUDA search tree is false for NaN
+        codes.masked_fill_(torch.isnan(normed), 0)
+
+        codes = codes.view(-1)[:2*((end - start + 1)//2)]
+        out[start//2:(end + 1)//2] = ((codes[0::2] << 4) | codes[1::2]).to(torch.uint8)
+
+
+def dequantize_4bit_cpu(A: Tensor, absmax: Tensor, out: Tensor, blocksize: int, quant_type: str) -> None:
+    """
+    Blockwise 4-bit dequantization on the CPU.
+
+    Vectorized equivalent of the FP4/NF4 kDequantizeBlockwise kernel.
+    """
+    n = out.numel()
+    A = A.view(-1)
+    out = out.view(-1)
+    code2value = fp4_code2value if quant_type == 'fp4' else nf4_code2value
+    num_blocks = absmax.numel()
+    for block_start in range(0, num_blocks, CPU_4BIT_CHUNK_BLOCKS):
+        block_end = min(block_start + CPU_4BIT_CHUNK_BLOCKS, num_blocks)
+        start, end = block_start*blocksize, min(block_end*blocksize, n)
+        packed = A[start//2:(end + 1)//2]
+        codes = torch.stack([packed >> 4, packed & 0x0F], dim=1).view(-1).long()
+        pad = (block_end - block_start)*blocksize - codes.numel()
+        if pad > 0:
+            codes = torch.nn.functional.pad(codes, (0, pad))
+        vals = code2value[codes].view(-1, blocksize) * absmax[block_start:block_end].float().unsqueeze(1)
+        out[start:end] = vals.view(-1)[:end - start]
+
+
 def quantize_fp4(A: Tensor, absmax: Tensor = None, out: Tensor = None, blocksize=64, compress_statistics=False):
     return quantize_4bit(A, absmax, out, blocksize, compress_statistics, 'fp4')
 
@@ -742,7 +1431,7 @@ def quantize_4bit(A: Tensor, absmax: Tensor = None, out: Tensor = None, blocksiz
     tuple(torch.Tensor, torch.Size, torch.dtype, int):
         The quantization state to undo the quantization.
     """
-    if A.device.type != 'cuda':
+    if A.device.type not in ['cuda', 'cpu']:
         raise NotImplementedError(f'Device type not supported for FP4 quantization: {A.device.type}')
     if quant_type not in ['fp4', 'nf4']:
         raise NotImplementedError(f'4-bit quantization data type {quant_type} is not implemented.')
@@ -761,22 +1450,27 @@ def quantize_4bit(A: Tensor, absmax: Tensor = None, out: Tensor = None, blocksiz
 
     assert blocksize in [4096, 2048, 1024, 512, 256, 128, 64]
 
-    prev_device = pre_call(A.device)
-    is_on_gpu([A, out, absmax])
+    if A.device.type == 'cpu':
+        if A.dtype not in [torch.float32, torch.float16, torch.bfloat16]:
+            raise ValueError(f"Blockwise quantization only supports 16/32-bit floats, but got {A.dtype}")
+        quantize_4bit_cpu(A, absmax, out, blocksize, quant_type)
+    else:
+        prev_device = pre_call(A.device)
+        is_on_gpu([A, out, absmax])
 
-    if A.dtype == torch.float32:
-        if quant_type == 'fp4':
-            lib.cquantize_blockwise_fp32_fp4(get_ptr(None), get_ptr(A), get_ptr(absmax), get_ptr(out), ct.c_int32(blocksize), ct.c_int(n))
-        else:
-            lib.cquantize_blockwise_fp32_nf4(get_ptr(None), get_ptr(A), get_ptr(absmax), get_ptr(out), ct.c_int32(blocksize), ct.c_int(n))
-    elif A.dtype == torch.float16:
-        if quant_type == 'fp4':
-            lib.cquantize_blockwise_fp16_fp4(get_ptr(None), get_ptr(A), get_ptr(absmax), get_ptr(out), ct.c_int32(blocksize), ct.c_int(n))
+        if A.dtype == torch.float32:
+            if quant_type == 'fp4':
+                lib.cquantize_blockwise_fp32_fp4(get_ptr(None), get_ptr(A), get_ptr(absmax), get_ptr(out), ct.c_int32(blocksize), ct.c_int(n))
+            else:
+                lib.cquantize_blockwise_fp32_nf4(get_ptr(None), get_ptr(A), get_ptr(absmax), get_ptr(out), ct.c_int32(blocksize), ct.c_int(n))
+        elif A.dtype == torch.float16:
+            if quant_type == 'fp4':
+                lib.cquantize_blockwise_fp16_fp4(get_ptr(None), get_ptr(A), get_ptr(absmax), get_ptr(out), ct.c_int32(blocksize), ct.c_int(n))
+            else:
+                lib.cquantize_blockwise_fp16_nf4(get_ptr(None), get_ptr(A), get_ptr(absmax), get_ptr(out), ct.c_int32(blocksize), ct.c_int(n))
         else:
-            lib.cquantize_blockwise_fp16_nf4(get_ptr(None), get_ptr(A), get_ptr(absmax), get_ptr(out), ct.c_int32(blocksize), ct.c_int(n))
-    else:
-        raise ValueError(f"Blockwise quantization only supports 16/32-bit floats, but got {A.dtype}")
-    post_call(A.device)
+            raise ValueError(f"Blockwise quantization only supports 16/32-bit floats, but got {A.dtype}")
+        post_call(A.device)
 
     if compress_statistics:
         offset = absmax.mean()
@@ -833,6 +1527,7 @@ def dequantize_4bit(A: Tensor,quant_state: Tuple[Tensor, Tensor] = None, absmax:
         assert absmax is not None and out is not None
         shape = out.shape
         dtype = out.dtype
+        compressed_stats = None
     else:
         absmax, shape, dtype, blocksize, compressed_stats, quant_type = quant_state
 
@@ -848,33 +1543,136 @@ def dequantize_4bit(A: Tensor,quant_state: Tuple[Tensor, Tensor] = None, absmax:
     n = out.numel()
 
 
-    device = pre_call(A.device)
-    is_on_gpu([A, absmax, out])
-    if out.dtype == torch.float32:
-        if quant_type == 'fp4':
-            lib.cdequantize_blockwise_fp32_fp4(get_ptr(None), get_ptr(A), get_ptr(absmax), get_ptr(out), ct.c_int(blocksize), ct.c_int(n))
-        else:
-            lib.cdequantize_blockwise_fp32_nf4(get_ptr(None), get_ptr(A), get_ptr(absmax), get_ptr(out), ct.c_int(blocksize), ct.c_int(n))
-    elif out.dtype == torch.float16:
-        if quant_type == 'fp4':
-            lib.cdequantize_blockwise_fp16_fp4(get_ptr(None), get_ptr(A), get_ptr(absmax), get_ptr(out), ct.c_int(blocksize), ct.c_int(n))
-        else:
-            lib.cdequantize_blockwise_fp16_nf4(get_ptr(None), get_ptr(A), get_ptr(absmax), get_ptr(out), ct.c_int(blocksize), ct.c_int(n))
+    if A.device.type == 'cpu':
+        if out.dtype not in [torch.float32, torch.float16, torch.bfloat16]:
+            raise ValueError(f"Blockwise quantization only supports 16/32-bit floats, but got {out.dtype}")
+        dequantize_4bit_cpu(A, absmax, out, blocksize, quant_type)
     else:
-        raise ValueError(f"Blockwise quantization only supports 16/32-bit floats, but got {A.dtype}")
-    post_call(A.device)
+        device = pre_call(A.device)
+        is_on_gpu([A, absmax, out])
+        if out.dtype == torch.float32:
+            if quant_type == 'fp4':
+                lib.cdequantize_blockwise_fp32_fp4(get_ptr(None), get_ptr(A), get_ptr(absmax), get_ptr(out), ct.c_int(blocksize), ct.c_int(n))
+            else:
+                lib.cdequantize_blockwise_fp32_nf4(get_ptr(None), get_ptr(A), get_ptr(absmax), get_ptr(out), ct.c_int(blocksize), ct.c_int(n))
+        elif out.dtype == torch.float16:
+            if quant_type == 'fp4':
+                lib.cdequantize_blockwise_fp16_fp4(get_ptr(None), get_ptr(A), get_ptr(absmax), get_ptr(out), ct.c_int(blocksize), ct.c_int(n))
+            else:
+                lib.cdequantize_blockwise_fp16_nf4(get_ptr(None), get_ptr(A), get_ptr(absmax), get_ptr(out), ct.c_int(blocksize), ct.c_int(n))
+        else:
+            raise ValueError(f"Blockwise quantization only supports 16/32-bit floats, but got {A.dtype}")
+        post_call(A.device)
 
     is_transposed = (True if A.shape[0] == 1 else False)
     if is_transposed: return out.t()
     else: return out
 
+def quantize_4bit_many(tensors: List[Tensor], blocksize=64, compress_statistics=False, quant_type='fp4') -> Tuple[Tensor, list]:
+    """
+    Quantizes a list of tensors to 4-bit with a single call into the library.
+
+    The tensors are packed into one flat buffer (see concat_blockwise) which is quantized
+    with quantize_4bit, so all tensors share one absmax array.
+
+    Parameters
+    ----------
+    tensors : list(torch.Tensor)
+        The input tensors, all on the same device.
+    blocksize : int
+        The blocksize used in quantization.
+    compress_statistics : bool
+        Quantize the shared absmax array as well.
+    quant_type : str
+        The 4-bit quantization data type {fp4, nf4}
+
+    Returns
+    -------
+    torch.Tensor:
+        The flat 8-bit buffer with the packed 4-bit values of all tensors.
+    list:
+        The quantization state [quant_state, offsets, shapes, dtypes], where quant_state is the state of
+        quantize_4bit for the flat buffer and offsets are the positions of the tensors in it (in values, not bytes).
+    """
+    dtypes = [A.dtype for A in tensors]
+    dtype = dtypes[0] if len(set(dtypes)) == 1 else torch.float32
+    flat, offsets = concat_blockwise(tensors, blocksize, dtype)
+    out, quant_state = quantize_4bit(flat, blocksize=blocksize, compress_statistics=compress_statistics, quant_type=quant_type)
+    return out, [quant_state, offsets, [A.shape for A in tensors], dtypes]
+
+def dequantize_4bit_many(A: Tensor, state: list, out: List[Tensor] = None) -> List[Tensor]:
+    """
+    Dequantizes the flat buffer of quantize_4bit_many with a single call into the library.
+
+    Parameters
+    ----------
+    A : torch.Tensor
+        The flat 8-bit buffer with packed 4-bit values.
+    state : list
+        The quantization state of quantize_4bit_many.
+    out : list(torch.Tensor)
+        Tensors the dequantized values are copied into, e.g. the original tensors.
+
+    Returns
+    -------
+    list(torch.Tensor):
+        The dequantized tensors in their original dtypes.
+    """
+    quant_state, offsets, shapes, dtypes = state
+    flat = dequantize_4bit(A, quant_state)
+    tensors = [flat[offset:offset + prod(shape)].view(shape).to(dtype) for offset, shape, dtype in zip(offsets, shapes, dtypes)]
+    if out is None:
+        return tensors
+    for dst, src in zip(out, tensors):
+        dst.copy_(src)
+    return out
+
+def quant_state_4bit_to_dict(quant_state) -> dict:
+    """
+    Flattens the quantization state of quantize_4bit into a dict.
+
+    Tensors are stored under "absmax" and, for compressed statistics, "nested_offset",
+    "nested_absmax" and "nested_code". All other values are plain Python objects.
+    quant_state_4bit_from_dict undoes the conversion.
+    """
+    absmax, shape, dtype, blocksize, compressed_stats, quant_type = quant_state
+    state = {
+        "absmax": absmax,
+        "shape": list(shape),
+        "dtype": str(dtype).replace("torch.", ""),
+        "blocksize": blocksize,
+        "quant_type": quant_type,
+    }
+    if compressed_stats is not None:
+        offset, state2 = compressed_stats
+        state["nested_offset"] = offset
+        state["nested_absmax"] = state2[0]
+        state["nested_code"] = state2[1]
+        state["nested_blocksize"] = state2[2]
+    return state
+
+def quant_state_4bit_from_dict(state: dict, device=None) -> list:
+    """
+    Builds the quantization state of quantize_4bit from a dict of quant_state_4bit_to_dict.
+
+    The tensors are used as they are unless a device is given.
+    """
+    def to_device(A):
+        return A if device is None else A.to(device)
+
+    compressed_stats = None
+    if "nested_absmax" in state:
+        state2 = [to_device(state["nested_absmax"]), to_device(state["nested_code"]), state["nested_blocksize"], False, None, None]
+        compressed_stats = [to_device(state["nested_offset"]), state2]
+    dtype = state["dtype"]
+    if isinstance(dtype, str):
+        dtype = getattr(torch, dtype)
+    return [to_device(state["absmax"]), torch.Size(state["shape"]), dtype, state["blocksize"], compressed_stats, state["quant_type"]]
+
 
 def quantize(A: Tensor, code: Tensor = None, out: Tensor = None) -> Tensor:
     if code is None:
-        if "dynamic" not in name2qmap:
-            name2qmap["dynamic"] = create_dynamic_map().to(A.device)
-        code = name2qmap["dynamic"]
-        code = code.to(A.device)
+        code = get_codebook(create_dynamic_map, device=A.device)
 
     absmax = torch.abs(A).max()
     inp = A / absmax
@@ -891,10 +1689,7 @@ def dequantize(
 ) -> Tensor:
     assert quant_state is not None or absmax is not None
     if code is None and quant_state is None:
-        if "dynamic" not in name2qmap:
-            name2qmap["dynamic"] = create_dynamic_map().to(A.device)
-        code = name2qmap["dynamic"]
-        code = code.to(A.device)
+        code = get_codebook(create_dynamic_map, device=A.device)
 
     if quant_state is None:
         quant_state = (absmax, code)
@@ -1006,8 +1801,9 @@ def optimizer_update_32bit(
         Optimizer state 2.
     beta2 : float
         Optimizer beta2.
-    gnorm_scale : float
-        The factor to rescale the gradient to the max clip value.
+    gnorm_scale : float or torch.Tensor
+        The factor to rescale the gradient to the max clip value. A tensor is copied to the host,
+        which waits for the device, see scales_to_host to copy the scales of many updates at once.
     unorm_vec : torch.Tensor
         The tensor for the update norm.
     max_unorm : float
@@ -1016,6 +1812,14 @@ def optimizer_update_32bit(
         Whether to skip zero-valued gradients or not (default: False).
     """
 
+    if g.device.type == 'cpu':
+        optimizer_update_32bit_cpu(
+            optimizer_name, [g], [p], [state1], beta1, eps, [step], lr,
+            None if state2 is None else [state2], beta2, weight_decay, [gnorm_scale],
+            None if unorm_vec is None else [unorm_vec], max_unorm, skip_zeros,
+        )
+        return
+
     param_norm = 0.0
     if max_unorm > 0.0:
         param_norm = torch.norm(p.data.float())
@@ -1053,6 +1857,114 @@ def optimizer_update_32bit(
     post_call(prev_device)
 
 
+def optimizer_update_32bit_cpu(
+    optimizer_name: str,
+    gs: list,
+    ps: list,
+    state1s: list,
+    beta1: float,
+    eps: float,
+    steps: list,
+    lr: float,
+    state2s: list = None,
+    beta2: float = 0.0,
+    weight_decay: float = 0.0,
+    gnorm_scales: list = None,
+    unorm_vecs: list = None,
+    max_unorm: float = 0.0,
+    skip_zeros=False,
+) -> None:
+    """
+    Performs an inplace optimizer update of several CPU tensors with 32-bit states at once.
+
+    All tensors are updated in a single multithreaded pass with the same hyperparameters,
+    the arguments are the same as for optimizer_update_32bit but given as a list with one
+    entry per tensor for the gradients, parameters, states, steps, gradient norm scales and
+    update norm vectors. The parameter norms for max_unorm are computed in the same pass.
+    """
+    if optimizer_name not in str2optimizer32bit_cpu:
+        raise NotImplementedError(f'32-bit optimizer not supported on CPU: {optimizer_name}')
+    if len(ps) == 0:
+        return
+
+    num_tensors = len(ps)
+    if gnorm_scales is None:
+        gnorm_scales = [1.0]*num_tensors
+    if max_unorm > 0.0 and unorm_vecs is None:
+        raise ValueError('max_unorm > 0.0 requires an update norm vector for each tensor!')
+
+    dtype = gs[0].dtype
+    tensors = gs + ps + state1s + (state2s or []) + (unorm_vecs or [])
+    for t in tensors:
+        if t.device.type != 'cpu' or not t.is_contiguous():
+            raise ValueError(f'All tensors need to be contiguous CPU tensors, but found a tensor on {t.device} (contiguous={t.is_contiguous()})!')
+    for g, p, state1 in zip(gs, ps, state1s):
+        if g.dtype != dtype or p.dtype != dtype or state1.dtype != torch.float32:
+            raise ValueError(f"Gradient+optimizer bit data type combination not supported: grad {g.dtype}, parameter {p.dtype}, optimizer {state1.dtype}")
+
+    if dtype == torch.float32:
+        optim_func = str2optimizer32bit_cpu[optimizer_name][0]
+    elif dtype == torch.float16:
+        optim_func = str2optimizer32bit_cpu[optimizer_name][1]
+    elif dtype == torch.bfloat16:
+        optim_func = str2optimizer32bit_cpu[optimizer_name][2]
+    else:
+        raise ValueError(f"Gradient+optimizer bit data type combination not supported: grad {dtype}, optimizer {state1s[0].dtype}")
+
+    set_cpu_threads()
+    optim_func(
+        ct.c_int32(num_tensors),
+        get_ptr_array(gs),
+        get_ptr_array(ps),
+        get_ptr_array(state1s),
+        get_ptr_array(state2s),
+        get_ptr_array(unorm_vecs if max_unorm > 0.0 else None),
+        (ct.c_longlong*num_tensors)(*[p.numel() for p in ps]),
+        (ct.c_int32*num_tensors)(*steps),
+        (ct.c_float*num_tensors)(*scales_to_host(gnorm_scales)),
+        ct.c_float(max_unorm),
+        ct.c_float(beta1),
+        ct.c_float(beta2),
+        ct.c_float(eps),
+        ct.c_float(weight_decay),
+        ct.c_float(lr),
+        ct.c_bool(skip_zeros),
+    )
+
+
+def optimizer_update_32bit_multi(
+    optimizer_name: str,
+    gs: list,
+    ps: list,
+    state1s: list,
+    beta1: float,
+    eps: float,
+    steps: list,
+    lr: float,
+    state2s: list = None,
+    beta2: float = 0.0,
+    weight_decay: float = 0.0,
+    gnorm_scales: list = None,
+    unorm_vecs: list = None,
+    max_unorm: float = 0.0,
+    skip_zeros=False,
+) -> None:
+    """
+    Performs an inplace optimizer update of a list of tensors with 32-bit optimizer states.
+
+    Same as optimizer_update_32bit, but all tensors are updated with a single call. The tensors
+    have to be on the CPU, have the same data type and share the hyperparameters, the
+    gradients, parameters, states, steps, gradient norm scales and update norm vectors are given
+    as lists with one entry per tensor.
+    """
+    if len(ps) == 0:
+        return
+    if ps[0].device.type != 'cpu':
+        raise NotImplementedError(f'Multi-tensor 32-bit optimizer updates are only implemented on the CPU, but found a tensor on {ps[0].device}!')
+    optimizer_update_32bit_cpu(optimizer_name, gs, ps, state1s, beta1, eps, steps, lr, state2s, beta2,
+                               weight_decay, gnorm_scales, unorm_vecs, max_unorm, skip_zeros)
+
+
 def optimizer_update_8bit(
     optimizer_name: str,
     g: Tensor,
@@ -1117,8 +2029,9 @@ def optimizer_update_8bit(
         Max value for the next Adam update of the first state.
     new_max2 : torch.Tensor
         Max value for the next Adam update of the second state.
-    gnorm_scale : float
-        The factor to rescale the gradient to the max clip value.
+    gnorm_scale : float or torch.Tensor
+        The factor to rescale the gradient to the max clip value. A tensor is copied to the host,
+        which waits for the device, see scales_to_host to copy the scales of many updates at once.
     unorm_vec : torch.Tensor
         The tensor for the update norm.
     max_unorm : float
@@ -1207,6 +2120,11 @@ def optimizer_update_8bit_blockwise(
 ) -> None:
 
     optim_func = None
+    if g.device.type == 'cpu':
+        optimizer_update_8bit_blockwise_cpu(optimizer_name, g, p, state1, state2, beta1, beta2, eps, step, lr,
+                                            qmap1, qmap2, absmax1, absmax2, weight_decay, gnorm_scale, skip_zeros)
+        return
+
     prev_device = pre_call(g.device)
     is_on_gpu([g, p, state1, state2, qmap1, qmap2, absmax1, absmax2])
     if g.dtype == torch.float32 and state1.dtype == torch.uint8:
@@ -1246,11 +2164,170 @@ def optimizer_update_8bit_blockwise(
     )
     post_call(prev_device)
 
+
+def optimizer_update_8bit_blockwise_cpu(
+    optimizer_name: str,
+    g: Tensor,
+    p: Tensor,
+    state1: Tensor,
+    state2: Tensor,
+    beta1: float,
+    beta2: float,
+    eps: float,
+    step: int,
+    lr: float,
+    qmap1: Tensor,
+    qmap2: Tensor,
+    absmax1: Tensor,
+    absmax2: Tensor,
+    weight_decay: float = 0.0,
+    gnorm_scale: float = 1.0,
+    skip_zeros=False,
+) -> None:
+    """
+    CPU version of optimizer_update_8bit_blockwise.
+
+    Each block of 2048 values is dequantized, updated and requantized in a single pass,
+    blocks are processed in parallel with torch.get_num_threads() threads. Follows the
+    numerics of the CUDA kernels: the parameter update uses the unquantized states and
+    the requantized state1 keeps the sign of its value.
+    """
+    tensors = [g, p, state1, state2, qmap1, qmap2, absmax1, absmax2]
+    for t in tensors:
+        if t is not None and (t.device.type != 'cpu' or not t.is_contiguous()):
+            raise ValueError(f'All tensors need to be contiguous CPU tensors, but found a tensor on {t.device} (contiguous={t.is_contiguous()})!')
+
+    if optimizer_name not in str2optimizer8bit_blockwise_cpu:
+        raise NotImplementedError(f'8-bit blockwise optimizer not supported on CPU: {optimizer_name}')
+    if state1.dtype != torch.uint8 or p.dtype != g.dtype:
+        raise ValueError(
+            f"Gradient+optimizer bit data type combination not supported: grad {g.dtype}, parameter {p.dtype}, optimizer {state1.dtype}"
+        )
+    if g.dtype == torch.float32:
+        optim_func = str2optimizer8bit_blockwise_cpu[optimizer_name][0]
+    elif g.dtype == torch.float16:
+        optim_func = str2optimizer8bit_blockwise_cpu[optimizer_name][1]
+    elif g.dtype == torch.bfloat16:
+        optim_func = str2optimizer8bit_blockwise_cpu[optimizer_name][2]
+    else:
+        raise ValueError(
+            f"Gradient+optimizer bit data type combination not supported: grad {g.dtype}, optimizer {state1.dtype}"
+        )
+
+    set_cpu_threads()
+    optim_func(
+        get_ptr(p),
+        get_ptr(g),
+        get_ptr(state1),
+        get_ptr(state2),
+        ct.c_float(beta1),
+        ct.c_float(beta2),
+        ct.c_float(eps),
+        ct.c_int32(step),
+        ct.c_float(lr),
+        get_ptr(qmap1),
+        get_ptr(qmap2),
+        get_ptr(absmax1),
+        get_ptr(absmax2),
+        ct.c_float(weight_decay),
+        ct.c_float(gnorm_scale),
+        ct.c_bool(skip_zeros),
+        ct.c_longlong(g.numel()),
+    )
+
+
+def optimizer_update_8bit_blockwise_multi(
+    optimizer_name: str,
+    gs: list,
+    ps: list,
+    state1s: list,
+    state2s: list,
+    beta1: float,
+    beta2: float,
+    eps: float,
+    steps: list,
+    lr: float,
+    qmap1s: list,
+    qmap2s: list,
+    absmax1s: list,
+    absmax2s: list,
+    weight_decay: float = 0.0,
+    gnorm_scales: list = None,
+    skip_zeros=False,
+) -> None:
+    """
+    Performs an inplace blockwise 8-bit optimizer update of a list of tensors.
+
+    Same as optimizer_update_8bit_blockwise, but all tensors are updated with a single call.
+    The tensors have to be on the CPU, have the same data type and share the hyperparameters,
+    everything else is given as a list with one entry per tensor (state2s, qmap2s and absmax2s
+    are None for optimizers with a single state). The blocks of all tensors are processed by
+    one parallel loop.
+    """
+    if len(ps) == 0:
+        return
+
+    num_tensors = len(ps)
+    if gnorm_scales is None:
+        gnorm_scales = [1.0]*num_tensors
+
+    dtype = gs[0].dtype
+    for g, p, state1 in zip(gs, ps, state1s):
+        if g.dtype != dtype or p.dtype != dtype or state1.dtype != torch.uint8:
+            raise ValueError(f"Gradient+optimizer bit data type combination not supported: grad {g.dtype}, parameter {p.dtype}, optimizer {state1.dtype}")
+
+    if ps[0].device.type != 'cpu':
+        raise NotImplementedError(f'Multi-tensor 8-bit blockwise optimizer updates are only implemented on the CPU, but found a tensor on {ps[0].device}!')
+    tensors = gs + ps + state1s + qmap1s + absmax1s + (state2s or []) + (qmap2s or []) + (absmax2s or [])
+    for t in tensors:
+        if t.device.type != 'cpu' or not t.is_contiguous():
+            raise ValueError(f'All tensors need to be contiguous CPU tensors, but found a tensor on {t.device} (contiguous={t.is_contiguous()})!')
+    if optimizer_name not in str2optimizer8bit_blockwise_multi_cpu:
+        raise NotImplementedError(f'8-bit blockwise optimizer not supported on CPU: {optimizer_name}')
+    optim_funcs = str2optimizer8bit_blockwise_multi_cpu[optimizer_name]
+
+    if dtype == torch.float32:
+        optim_func = optim_funcs[0]
+    elif dtype == torch.float16:
+        optim_func = optim_funcs[1]
+    elif dtype == torch.bfloat16 and len(optim_funcs) == 3:
+        optim_func = optim_funcs[2]
+    else:
+        raise ValueError(f"Gradient+optimizer bit data type combination not supported: grad {dtype}, optimizer {state1s[0].dtype}")
+
+    set_cpu_threads()
+    optim_func(
+        ct.c_int32(num_tensors),
+        get_ptr_array(ps),
+        get_ptr_array(gs),
+        get_ptr_array(state1s),
+        get_ptr_array(state2s),
+        ct.c_float(beta1),
+        ct.c_float(beta2),
+        ct.c_float(eps),
+        (ct.c_int32*num_tensors)(*steps),
+        ct.c_float(lr),
+        get_ptr_array(qmap1s),
+        get_ptr_array(qmap2s),
+        get_ptr_array(absmax1s),
+        get_ptr_array(absmax2s),
+        ct.c_float(weight_decay),
+        (ct.c_float*num_tensors)(*scales_to_host(gnorm_scales)),
+        ct.c_bool(skip_zeros),
+        (ct.c_longlong*num_tensors)(*[p.numel() for p in ps]),
+    )
+
+
 def percentile_clipping(
     grad: Tensor, gnorm_vec: Tensor, step: int, percentile: int = 5
 ):
     """Applies percentile clipping
 
+    The squared gradient norm of the step is written into the ring buffer gnorm_vec and the
+    clip value is the percentile-th smallest of the last 100 norms, which is selected without
+    sorting the buffer. All results stay on the device of the gradient, so the step does not
+    wait for the device before the update is launched.
+
     grad: torch.Tensor
         The gradient tensor.
     gnorm_vec: torch.Tensor
@@ -1258,38 +2335,67 @@ def percentile_clipping(
     step: int
         The current optimiation steps (number of past gradient norms).
 
+    Returns
+    -------
+    tuple(torch.Tensor, torch.Tensor, torch.Tensor)
+        The gradient norm, the clip value and the factor to rescale the gradient with, which
+        is 1 if the gradient norm is not above the clip value.
     """
-    prev_device = pre_call(grad.device)
-    is_on_gpu([grad, gnorm_vec])
-    if grad.dtype == torch.float32:
+    if grad.device.type == 'cpu':
+        if grad.dtype not in (torch.float32, torch.float16, torch.bfloat16):
+            raise ValueError(f"Gradient type {grad.dtype} not supported!")
+        gnorm = grad.float().square().sum()
+        if step == 1:
+            # initialize with the same norm for all positions
+            gnorm_vec.fill_(gnorm)
+        else:
+            gnorm_vec[step % 100] = gnorm
+    elif grad.dtype == torch.float32:
+        prev_device = pre_call(grad.device)
+        is_on_gpu([grad, gnorm_vec])
         lib.cpercentile_clipping_g32(
             get_ptr(grad),
             get_ptr(gnorm_vec),
             ct.c_int32(step),
             ct.c_int32(grad.numel()),
         )
+        post_call(prev_device)
     elif grad.dtype == torch.float16:
+        prev_device = pre_call(grad.device)
+        is_on_gpu([grad, gnorm_vec])
         lib.cpercentile_clipping_g16(
             get_ptr(grad),
             get_ptr(gnorm_vec),
             ct.c_int32(step),
             ct.c_int32(grad.numel()),
         )
+        post_call(prev_device)
     else:
         raise ValueError(f"Gradient type {grad.dtype} not supported!")
-    post_call(prev_device)
 
     current_gnorm = torch.sqrt(gnorm_vec[step % 100])
-    vals, idx = torch.sort(gnorm_vec)
-    clip_value = torch.sqrt(vals[percentile])
-    gnorm_scale = 1.0
-
-    if current_gnorm > clip_value:
-        gnorm_scale = clip_value / current_gnorm
+    clip_value = torch.sqrt(torch.kthvalue(gnorm_vec, percentile + 1).values)
+    gnorm_scale = torch.where(
+        current_gnorm > clip_value, clip_value / current_gnorm, torch.ones_like(current_gnorm)
+    )
 
     return current_gnorm, clip_value, gnorm_scale
 
 
+def scales_to_host(scales: list) -> list:
+    """
+    Returns the floats of a list of scalars, which can be python numbers or one-element tensors.
+
+    The tensors are copied to the host with one transfer for all of them, so a fused update waits
+    for the device once and not once per tensor.
+    """
+    tensors = [scale for scale in scales if isinstance(scale, Tensor)]
+    if len(tensors) == 0:
+        return [float(scale) for scale in scales]
+    values = iter(torch.stack([scale.reshape(()).float() for scale in tensors]).tolist())
+    return [next(values) if isinstance(scale, Tensor) else float(scale) for scale in scales]
+
+
 def histogram_scatter_add_2d(
     histogram: Tensor, index1: Tensor, index2: Tensor, source: Tensor
 ):
@@ -1310,7 +2416,7 @@ def histogram_scatter_add_2d(
     lib.chistogram_scatter_add_2d(get_ptr(histogram), get_ptr(index1), get_ptr(index2), get_ptr(source), maxdim1, n)
 
 def check_matmul(A, B, out, transposed_A, transposed_B, expected_type=torch.int8):
-    if not torch.cuda.is_initialized(): torch.cuda.init()
+    if A.device.type == 'cuda' and not torch.cuda.is_initialized(): torch.cuda.init()
     if A.dtype != expected_type or B.dtype != expected_type:
         raise TypeError(
             f"Expected torch.int8 input tensors A and B, but got {A.dtype} and {B.dtype}"
@@ -1516,6 +2622,34 @@ def cutlass3_gemm(
 
 
 
+def igemm_cpu(A: Tensor, Bt: Tensor, out: Tensor) -> Tensor:
+    """
+    Int8 matrix multiplication with int32 accumulation on the CPU: out = A @ Bt^T.
+
+    A is [m, k] or [batch, m, k], Bt is [n, k] or [batch, n, k] and out [m, n] or [batch, m, n].
+    Views are used as they are if their rows are contiguous, e.g. the transpose of a row-major
+    matrix for Bt. The library computes blocks of rows of out in parallel.
+    """
+    if A.stride(-1) != 1:
+        A = A.contiguous()
+    if Bt.stride(-1) != 1:
+        Bt = Bt.contiguous()
+    C = out if out.is_contiguous() else torch.empty(out.shape, dtype=torch.int32)
+
+    m, k = A.shape[-2:]
+    n = Bt.shape[-2]
+    batch = A.shape[0] if A.dim() == 3 else 1
+    strideA = A.stride(0) if A.dim() == 3 else 0
+    strideB = Bt.stride(0) if Bt.dim() == 3 else 0
+    set_cpu_threads()
+    lib.cigemm_cpu(get_ptr(A), get_ptr(Bt), get_ptr(C), ct.c_longlong(m), ct.c_longlong(n), ct.c_longlong(k),
+                   ct.c_longlong(A.stride(-2)), ct.c_longlong(Bt.stride(-2)), ct.c_longlong(n),
+                   ct.c_longlong(strideA), ct.c_longlong(strideB), ct.c_longlong(m*n), ct.c_longlong(batch))
+    if C is not out:
+        out.copy_(C)
+    return out
+
+
 def igemm(
     A: Tensor,
     B: Tensor,
@@ -1530,6 +2664,14 @@ def igemm(
         if A.shape[0] == B.shape[0] and A.shape[2] == B.shape[1]:
             return batched_igemm(A, B, out)
 
+    if A.device.type == 'cpu':
+        if len(A.shape) == 3 and len(B.shape) == 3:
+            # bsi,bso->io
+            A = A.reshape(-1, A.shape[2]).t()
+            B = B.reshape(-1, B.shape[2])
+        igemm_cpu(A.reshape(-1, A.shape[-1]), B.t(), out.view(-1, out.shape[-1]))
+        return out
+
     sA = A.shape
     sB = B.shape
     if transposed_A and len(sA) == 2:
@@ -1620,6 +2762,9 @@ def batched_igemm(
     if out is None:
         out = torch.zeros(size=sout, dtype=torch.int32, device=A.device)
 
+    if A.device.type == 'cpu':
+        return igemm_cpu(A, B.transpose(1, 2), out)
+
     if B.is_contiguous():
         lda = B.stride()[1]
         transposed_A = False
@@ -1708,6 +2853,20 @@ def igemmlt(A, B, SA, SB, out=None, Sout=None, dtype=torch.int32):
     elif shapeA[1] == 0 and dimsA == 3:
         return torch.empty(tuple(shapeA[:2] + [shapeB[0]]), device=A.device, dtype=torch.float16)
 
+    if A.device.type == 'cpu':
+        # the tiled col32/col_turing/col_ampere layouts only exist on the GPU, on the CPU all matrices are row-major
+        if SA[1] != "row" or SB[1] != "row":
+            raise ValueError(f"igemmlt on the CPU expects row-major matrices, but got the formats {SA[1]} and {SB[1]}")
+        if dtype != torch.int32:
+            raise NotImplementedError(f"igemmlt on the CPU only supports int32 outputs, but got {dtype}")
+        if shapeA[-1] != shapeB[-1]:
+            raise ValueError(f"Matmullt only supports A @ B^T. Inner matrix dimensions do not match: A @ B = {shapeA} @ {shapeB}")
+        shape_out = tuple(shapeA[:-1]) + (shapeB[0],)
+        if out is None:
+            out = torch.empty(shape_out, dtype=dtype)
+        igemm_cpu(A.reshape(-1, shapeA[-1]), B, out.view(-1, shapeB[0]))
+        return out, (shape_out, "row")
+
     if dimsA == 2 and out is None:
         out, Sout = get_transform_buffer(
             (shapeA[0], shapeB[0]), dtype, A.device, "col32", "row"
@@ -1796,7 +2955,7 @@ def mm_dequant(
     bias=None
 ):
     assert A.dtype == torch.int32
-    if bias is not None: assert bias.dtype == torch.float16
+    if bias is not None and A.device.type != 'cpu': assert bias.dtype == torch.float16
     out_shape = quant_state[0]
     if len(out_shape) == 3:
         out_shape = (out_shape[0] * out_shape[1], out_shape[2])
@@ -1818,6 +2977,26 @@ def mm_dequant(
         new_col_stats.shape[0] == col_stats.shape[0]
     ), f"{new_col_stats.shape} vs {col_stats.shape}"
 
+    if A.device.type == 'cpu':
+        # the row and column scaling and the bias are applied in the same pass over A
+        A = A.contiguous()
+        row_stats = row_stats.float().contiguous()
+        col_stats = col_stats.float().contiguous()
+        if bias is not None:
+            bias = bias.float().contiguous()
+        args = (get_ptr(A), get_ptr(row_stats), get_ptr(col_stats), get_ptr(out), get_ptr(bias),
+                ct.c_longlong(out_shape[0]), ct.c_longlong(out_shape[1]))
+        set_cpu_threads()
+        if out.dtype == torch.float16:
+            lib.cdequant_mm_int32_fp16_cpu(*args)
+        elif out.dtype == torch.bfloat16:
+            lib.cdequant_mm_int32_bf16_cpu(*args)
+        elif out.dtype == torch.float32:
+            lib.cdequant_mm_int32_fp32_cpu(*args)
+        else:
+            raise ValueError(f"mm_dequant only supports 16/32-bit float outputs, but got {out.dtype}")
+        return out
+
     prev_device = pre_call(A.device)
     ptrA = get_ptr(A)
     ptrOut = get_ptr(out)
@@ -1836,10 +3015,34 @@ def mm_dequant(
     return out
 
 
+def colrow_absmax_cpu(A, row_stats, col_stats, nnz_row_ptr=None, out_row=None, threshold=0.0):
+    """
+    Row and column absmax of a row-major fp32/fp16/bf16 matrix on the CPU.
+
+    Values with an absolute value of at least threshold are outliers: they are excluded from the
+    statistics and the number of outliers of row i is written to nnz_row_ptr[i+1]. If out_row is
+    given, each row is also quantized to int8 with its absmax while it is still in cache.
+    """
+    cols = A.shape[-1]
+    rows = A.numel() // cols if cols > 0 else 0
+    if A.dtype == torch.float32:
+        func = lib.ccolrow_absmax_fp32_cpu
+    elif A.dtype == torch.float16:
+        func = lib.ccolrow_absmax_fp16_cpu
+    elif A.dtype == torch.bfloat16:
+        func = lib.ccolrow_absmax_bf16_cpu
+    else:
+        raise ValueError(f"Row/column quantization only supports 16/32-bit floats, but got {A.dtype}")
+
+    set_cpu_threads()
+    func(get_ptr(A), get_ptr(row_stats), get_ptr(col_stats), get_ptr(nnz_row_ptr), get_ptr(out_row),
+         ct.c_float(threshold), ct.c_longlong(rows), ct.c_longlong(cols))
+    return row_stats, col_stats, nnz_row_ptr
+
+
 def get_colrow_absmax(
     A, row_stats=None, col_stats=None, nnz_block_ptr=None, threshold=0.0
 ):
-    assert A.dtype == torch.float16
     device = A.device
 
     cols = A.shape[-1]
@@ -1848,6 +3051,20 @@ def get_colrow_absmax(
     else:
         rows = A.shape[0]
 
+    if device.type == 'cpu':
+        # on the CPU nnz_block_ptr holds the offsets of the outliers of each row instead of each tile
+        if row_stats is None:
+            row_stats = torch.empty((rows,), dtype=torch.float32)
+        if col_stats is None:
+            col_stats = torch.empty((cols,), dtype=torch.float32)
+        if nnz_block_ptr is None and threshold > 0.0:
+            nnz_block_ptr = torch.zeros((rows + 1,), dtype=torch.int32)
+        colrow_absmax_cpu(A.contiguous(), row_stats, col_stats, nnz_block_ptr, threshold=threshold)
+        if threshold > 0.0:
+            nnz_block_ptr.cumsum_(0)
+        return row_stats, col_stats, nnz_block_ptr
+
+    assert A.dtype == torch.float16
     col_tiles = (cols + 255) // 256
     tiled_rows = ((rows + 15) // 16) * 16
     if row_stats is None:
@@ -1969,10 +3186,76 @@ def coo_zeros(rows, cols, nnz, device, dtype=torch.half):
     return COOSparseTensor(rows, cols, nnz, rowidx, colidx, values)
 
 
+def double_quant_cpu(A, col_stats=None, row_stats=None, out_col=None, out_row=None, threshold=0.0):
+    """
+    Row-wise and column-wise int8 quantization with the outlier decomposition of LLM.int8() on the CPU.
+
+    The statistics, the outlier counts and the row-wise quantization are computed in one pass over A,
+    the column-wise quantization and the extraction of the outliers in a second one.
+    A can be fp32, fp16 or bf16, the values of the outliers are stored as fp16.
+    """
+    A = A.contiguous()
+    cols = A.shape[-1]
+    rows = A.numel() // cols
+
+    if out_col is None:
+        out_col = torch.empty(A.shape, dtype=torch.int8)
+    if out_row is None:
+        out_row = torch.empty(A.shape, dtype=torch.int8)
+
+    nnz_row_ptr = torch.zeros((rows + 1,), dtype=torch.int32) if threshold > 0.0 else None
+    quantize_rows = row_stats is None or col_stats is None
+    if quantize_rows:
+        row_stats = torch.empty((rows,), dtype=torch.float32)
+        col_stats = torch.empty((cols,), dtype=torch.float32)
+        colrow_absmax_cpu(A, row_stats, col_stats, nnz_row_ptr, out_row, threshold)
+    elif threshold > 0.0:
+        # only the outliers need to be counted
+        colrow_absmax_cpu(A, torch.empty((rows,)), torch.empty((cols,)), nnz_row_ptr, threshold=threshold)
+    row_stats = row_stats.float().contiguous()
+    col_stats = col_stats.float().contiguous()
+
+    coo_tensor = None
+    if threshold > 0.0:
+        nnz_row_ptr.cumsum_(0)
+        nnz = nnz_row_ptr[-1].item()
+        if nnz > 0:
+            coo_tensor = coo_zeros(rows, cols, nnz, A.device)
+        else:
+            threshold = 0.0
+
+    if A.dtype == torch.float32:
+        func = lib.cdouble_rowcol_quant_fp32_cpu
+    elif A.dtype == torch.float16:
+        func = lib.cdouble_rowcol_quant_fp16_cpu
+    else:
+        func = lib.cdouble_rowcol_quant_bf16_cpu
+
+    set_cpu_threads()
+    func(
+        get_ptr(A),
+        get_ptr(row_stats),
+        get_ptr(col_stats),
+        get_ptr(out_col),
+        None if quantize_rows else get_ptr(out_row),
+        None if coo_tensor is None else get_ptr(coo_tensor.rowidx),
+        None if coo_tensor is None else get_ptr(coo_tensor.colidx),
+        None if coo_tensor is None else get_ptr(coo_tensor.values),
+        get_ptr(nnz_row_ptr) if coo_tensor is not None else None,
+        ct.c_float(threshold),
+        ct.c_longlong(rows),
+        ct.c_longlong(cols),
+    )
+
+    return out_row, out_col, row_stats, col_stats, coo_tensor
+
+
 def double_quant(
     A, col_stats=None, row_stats=None, out_col=None, out_row=None, threshold=0.0
 ):
     device = A.device
+    if device.type == 'cpu':
+        return double_quant_cpu(A, col_stats, row_stats, out_col, out_row, threshold)
     assert A.dtype == torch.half
     assert device.type == "cuda"
     prev_device = pre_call(A.device)
@@ -2066,6 +3349,8 @@ def double_quant(
 
 
 def transform(A, to_order, from_order='row', out=None, transpose=False, state=None, ld=None):
+    if A.device.type == 'cpu':
+        return transform_cpu(A, to_order, from_order, out, transpose, state)
     prev_device = pre_call(A.device)
     if state is None: state = (A.shape, from_order)
     else: from_order = state[1]
@@ -2109,6 +3394,29 @@ def transform(A, to_order, from_order='row', out=None, transpose=False, state=No
     return out, new_state
 
 
+def transform_cpu(A, to_order, from_order='row', out=None, transpose=False, state=None):
+    """The CPU only has the row-major layout (see igemmlt), so the only transform is the transpose."""
+    if state is None: state = (A.shape, from_order)
+    else: from_order = state[1]
+    if to_order != "row" or from_order != "row":
+        raise NotImplementedError(f'Transform function not implemented on the CPU: From {from_order} to {to_order}')
+
+    shape = state[0]
+    if transpose:
+        rows = shape[0] * shape[1] if len(shape) == 3 else shape[0]
+        result = A.reshape(rows, shape[-1]).t()
+        new_state = ((shape[-1], rows), to_order)
+    else:
+        result = A
+        new_state = (shape, to_order)
+
+    if out is None:
+        out = result.contiguous()
+    else:
+        out.copy_(result)
+    return out, new_state
+
+
 def spmm_coo(cooA, B, out=None):
     if out is None:
         out = torch.empty(
@@ -2364,6 +3672,8 @@ def dequant_min_max(xq, A, B, SA, SB, dtype=torch.half):
 def extract_outliers(A, SA, idx):
     shapeA = SA[0]
     formatA = SA[1]
+    if A.device.type == 'cpu' and formatA == "row":
+        return A.view(shapeA)[:, idx.long()].contiguous()
     assert formatA in ["col_turing", "col_ampere"]
     assert A.device.type == "cuda"
 
@@ -137,20 +137,80 @@ class Embedding(torch.nn.Embedding):
         return emb
 
 class Params4bit(torch.nn.Parameter):
-    def __new__(cls, data=None, requires_grad=True, quant_state=None, blocksize=64, compress_statistics=True, quant_type='fp4'):
+    # memory-minimal: the nested absmax of compressed statistics is decoded in every forward pass
+    # latency-minimal: the decoded absmax is kept, which costs 4 bytes per block
+    absmax_cache_policies = ["memory-minimal", "latency-minimal"]
+
+    def __new__(cls, data=None, requires_grad=True, quant_state=None, blocksize=64, compress_statistics=True, quant_type='fp4', absmax_cache_policy='memory-minimal'):
         if data is None:
             data = torch.empty(0)
+        if absmax_cache_policy not in cls.absmax_cache_policies:
+            raise ValueError(f"Invalid absmax cache policy: {absmax_cache_policy}, expected one of {cls.absmax_cache_policies}")
 
         self = torch.Tensor._make_subclass(cls, data, requires_grad)
         self.blocksize = blocksize
         self.compress_statistics = compress_statistics
         self.quant_type = quant_type
         self.quant_state = quant_state
+        self.absmax_cache_policy = absmax_cache_policy
+        self.decoded_quant_state = None
         self.data = data
         return self
 
+    def get_quant_state(self):
+        """
+        Returns the quantization state for the dequantization of the weight.
+
+        With the latency-minimal policy and compressed statistics, this is a state with the
+        decoded absmax, so that dequantize_4bit skips decoding it. The decoded absmax is
+        computed once and again only if the quantization state changes.
+        """
+        s = self.quant_state
+        if s is None or s[-2] is None or self.absmax_cache_policy != "latency-minimal":
+            return s
+
+        cached = self.decoded_quant_state
+        if cached is not None and cached[0] is s and cached[1] is s[0] and cached[2] == s[0]._version:
+            return cached[3]
+
+        offset, state2 = s[-2]
+        absmax = bnb.functional.dequantize_blockwise(s[0], state2)
+        absmax += offset
+        decoded = [absmax, s[1], s[2], s[3], None, s[5]]
+        self.decoded_quant_state = (s, s[0], s[0]._version, decoded)
+        return decoded
+
+    @classmethod
+    def from_prequantized(cls, data, quant_state, requires_grad=False):
+        """
+        Wraps packed 4-bit data and its quantization state without quantizing again.
+
+        quant_state is the state of quantize_4bit or a dict of quant_state_4bit_to_dict.
+        The data is used as it is, so memory-mapped weights stay memory-mapped.
+        """
+        if isinstance(quant_state, dict):
+            quant_state = bnb.functional.quant_state_4bit_from_dict(quant_state)
+        absmax, shape, dtype, blocksize, compressed_stats, quant_type = quant_state
+        return cls(data, requires_grad=requires_grad, quant_state=quant_state, blocksize=blocksize,
+                   compress_statistics=compressed_stats is not None, quant_type=quant_type)
+
     def cuda(self, device):
+        if self.quant_state is not None:
+            # already quantized, only the packed data and the quantization state are moved
+            return self.to(device="cuda" if device is None else device)
         w = self.data.contiguous().half().cuda(device)
+        return self._quantize(w)
+
+    def quantize(self):
+        """
+        Quantizes the weight where it is, e.g. offline on the CPU, so that the packed weight can be
+        saved or moved to the GPU later. Does nothing if the weight is quantized already.
+        """
+        if self.quant_state is not None:
+            return self
+        return self._quantize(self.data.contiguous().half())
+
+    def _quantize(self, w):
         w_4bit, quant_state = bnb.functional.quantize_4bit(w, blocksize=self.blocksize, compress_statistics=self.compress_statistics, quant_type=self.quant_type)
         self.data = w_4bit
         self.quant_state = quant_state
@@ -172,7 +232,7 @@ class Params4bit(torch.nn.Parameter):
     def to(self, *args, **kwargs):
         device, dtype, non_blocking, convert_to_format = torch._C._nn._parse_to(*args, **kwargs)
 
-        if (device is not None and device.type == "cuda" and self.data.device.type == "cpu"):
+        if (device is not None and device.type == "cuda" and self.data.device.type == "cpu" and self.quant_state is None):
             return self.cuda(device)
         else:
             s = self.quant_state
@@ -194,7 +254,7 @@ class Params4bit(torch.nn.Parameter):
             new_param = Params4bit(super().to(device=device, dtype=dtype, non_blocking=non_blocking),
                                   requires_grad=self.requires_grad, quant_state=self.quant_state,
                                    blocksize=self.blocksize, compress_statistics=self.compress_statistics,
-                                   quant_type=self.quant_type)
+                                   quant_type=self.quant_type, absmax_cache_policy=self.absmax_cache_policy)
 
             return new_param
 
@@ -204,6 +264,48 @@ class Linear4bit(nn.Linear):
         self.weight = Params4bit(self.weight.data, requires_grad=False, compress_statistics=compress_statistics, quant_type=quant_type)
         self.compute_dtype = compute_dtype
 
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        super()._save_to_state_dict(destination, prefix, keep_vars)
+
+        # the packed weight is saved as the weight, the quantization state as extra data:
+        # its tensors under weight.{name} and everything else as JSON under weight.quant_state
+        quant_state = getattr(self.weight, "quant_state", None)
+        if quant_state is not None:
+            metadata = {}
+            for name, value in bnb.functional.quant_state_4bit_to_dict(quant_state).items():
+                if isinstance(value, torch.Tensor):
+                    destination[prefix + "weight." + name] = value if keep_vars else value.detach()
+                else:
+                    metadata[name] = value
+            destination[prefix + "weight.quant_state"] = bnb.utils.pack_dict_to_tensor(metadata)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict,
+                              missing_keys, unexpected_keys, error_msgs):
+        weight_key = prefix + "weight"
+        quant_state_key = weight_key + ".quant_state"
+        quant_state_keys = []
+        if quant_state_key in state_dict:
+            # quantized checkpoint: the packed weight replaces the weight without a quantization pass
+            device = self.weight.device
+            quant_state = bnb.utils.unpack_tensor_to_dict(state_dict[quant_state_key])
+            quant_state_keys.append(quant_state_key)
+            for name in ["absmax", "nested_offset", "nested_absmax", "nested_code"]:
+                key = weight_key + "." + name
+                if key in state_dict:
+                    quant_state[name] = state_dict[key].to(device, copy=True)
+                    quant_state_keys.append(key)
+            if weight_key in state_dict:
+                packed = torch.empty_like(state_dict[weight_key], device=device)
+                policy = getattr(self.weight, "absmax_cache_policy", "memory-minimal")
+                self.weight = Params4bit.from_prequantized(packed, quant_state)
+                self.weight.absmax_cache_policy = policy
+
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                                      error_msgs)
+        for key in quant_state_keys:
+            if key in unexpected_keys:
+                unexpected_keys.remove(key)
+
     def forward(self, x: torch.Tensor):
         # weights are cast automatically as Int8Params, but the bias has to be cast manually
         if self.bias is not None and self.bias.dtype != x.dtype:
@@ -216,7 +318,7 @@ class Linear4bit(nn.Linear):
             x = x.to(self.compute_dtype)
 
         bias = None if self.bias is None else self.bias.to(self.compute_dtype)
-        out = bnb.matmul_4bit(x, self.weight.t(), bias=bias, quant_state=self.weight.quant_state)
+        out = bnb.matmul_4bit(x, self.weight.t(), bias=bias, quant_state=self.weight.get_quant_state())
 
         out = out.to(inp_dtype)
 
@@ -248,19 +350,48 @@ class Int8Params(torch.nn.Parameter):
             data = torch.empty(0)
         return torch.Tensor._make_subclass(cls, data, requires_grad)
 
+    @classmethod
+    def from_prequantized(cls, CB, SCB, requires_grad=False):
+        """Wraps an int8 row-major weight and its row statistics without quantizing again."""
+        param = cls(CB, requires_grad=requires_grad, has_fp16_weights=False)
+        param.CB = CB
+        param.SCB = SCB
+        return param
+
     def cuda(self, device):
         if self.has_fp16_weights:
             return super().cuda(device)
-        else:
-            # we store the 8-bit rows-major weight
-            # we convert this weight to the turning/ampere weight during the first inference pass
-            B = self.data.contiguous().half().cuda(device)
-            CB, CBt, SCB, SCBt, coo_tensorB = bnb.functional.double_quant(B)
-            del CBt
-            del SCBt
+        elif self.data.dtype == torch.int8 and self.SCB is not None:
+            # already quantized, only the weight and its statistics are moved
+            CB = self.data.cuda(device)
             self.data = CB
             setattr(self, "CB", CB)
-            setattr(self, "SCB", SCB)
+            setattr(self, "SCB", self.SCB.cuda(device))
+        else:
+            self.data = self.data.contiguous().half().cuda(device)
+            self.quantize()
+
+        return self
+
+    def quantize(self):
+        """
+        Quantizes the weight where it is, e.g. on the CPU to run inference there or to save the int8
+        weight. Does nothing for fp16 weights or if the weight is quantized already.
+        """
+        if self.has_fp16_weights or self.SCB is not None or self.data.dtype == torch.int8:
+            return self
+        # we store the 8-bit rows-major weight
+        # we convert this weight to the turning/ampere weight during the first inference pass
+        # the CPU kernels quantize fp32/bf16 weights directly
+        B = self.data.contiguous()
+        if B.device.type != "cpu":
+            B = B.half()
+        CB, CBt, SCB, SCBt, coo_tensorB = bnb.functional.double_quant(B)
+        del CBt
+        del SCBt
+        self.data = CB
+        setattr(self, "CB", CB)
+        setattr(self, "SCB", SCB)
 
         return self
 
@@ -364,7 +495,8 @@ class Linear8bitLt(nn.Linear):
                 if self.weight.SCB is None:
                     # buffers not yet initialized, can't call them directly without
                     raise RuntimeError("Loading a quantized checkpoint into non-quantized Linear8bitLt is "
-                                       "not supported. Please call module.cuda() before module.load_state_dict()")
+                                       "not supported. Please call module.cuda() or module.weight.quantize() "
+                                       "before module.load_state_dict()")
 
                 input_param = state_dict[key]
                 self.weight.SCB.copy_(input_param)
@@ -378,6 +510,9 @@ class Linear8bitLt(nn.Linear):
 
     def forward(self, x: torch.Tensor):
         self.state.is_training = self.training
+        if not self.state.has_fp16_weights and self.weight.dtype != torch.int8:
+            # the weight was not moved to the GPU, e.g. for inference on the CPU
+            self.weight.quantize()
         if self.weight.CB is not None:
             self.init_8bit_state()
 
@@ -412,7 +547,7 @@ class OutlierAwareLinear(nn.Linear):
         if self.outlier_dim is None:
             tracer = OutlierTracer.get_instance()
             if not tracer.is_initialized():
-                print('Please use OutlierTracer.initialize(model) before using the OutlierAwareLinear layer')
+                print('Please use OutlierTracer.initialize(model), calibrate(model, batches) or load_profile(path, model) before using the OutlierAwareLinear layer')
             outlier_idx = tracer.get_outliers(self.weight)
             #print(outlier_idx, tracer.get_hvalue(self.weight))
             self.outlier_dim = outlier_idx
@@ -462,3 +597,100 @@ class SwitchBackLinearBnb(nn.Linear):
             self.init_8bit_state()
 
         out = bnb.matmul_mixed(x.half(), self.weight.half(), bias=None, state=self.state) + self.bias
+
+
+def _quantized_weight_key(name):
+    return f"{name}.weight" if name else "weight"
+
+
+def save_quantized(module, path):
+    """
+    Saves the quantized weights of all Linear4bit and Linear8bitLt layers of a module into a file.
+
+    The packed weights and their quantization state are stored in a format that load_quantized
+    memory-maps, so loading needs neither the 16-bit weights nor a quantization pass. Other
+    parameters and buffers are not saved, use the module state_dict for those.
+
+    Parameters:
+        module (`torch.nn.Module`):
+            The module with quantized layers, e.g. after `.cuda()`. Weights which are not quantized
+            yet are quantized where they are, see `Params4bit.quantize` and `Int8Params.quantize`.
+        path (`str`):
+            The file to write.
+    """
+    tensors, metadata = {}, {}
+    for name, submodule in module.named_modules():
+        key = _quantized_weight_key(name)
+        if isinstance(submodule, Linear4bit):
+            # weights which were not moved to the GPU yet are quantized offline
+            submodule.weight.quantize()
+            tensors[key] = submodule.weight.data
+            quant_state = bnb.functional.quant_state_4bit_to_dict(submodule.weight.quant_state)
+            info = {"type": "4bit", "quant_state": {}, "tensors": []}
+            for k, v in quant_state.items():
+                if isinstance(v, torch.Tensor):
+                    tensors[f"{key}.{k}"] = v
+                    info["tensors"].append(k)
+                else:
+                    info["quant_state"][k] = v
+            metadata[key] = info
+        elif isinstance(submodule, Linear8bitLt) and not submodule.state.has_fp16_weights:
+            state = submodule.state
+            if state.SCB is None:
+                # weights which were not moved to the GPU yet are quantized offline
+                submodule.weight.quantize()
+            if submodule.weight.SCB is not None:
+                CB, SCB = submodule.weight.data, submodule.weight.SCB
+            elif state.SCB is not None and state.CB is not None:
+                CB, SCB = state.CB, state.SCB
+            elif state.SCB is not None and state.CxB is not None:
+                CB, SCB = undo_layout(state.CxB, state.tile_indices), state.SCB
+            else:
+                raise ValueError(f"The int8 weight of {key} is missing.")
+            tensors[key] = CB
+            tensors[f"{key}.SCB"] = SCB
+            metadata[key] = {"type": "int8"}
+    bnb.utils.save_packed_tensors(path, tensors, metadata)
+
+
+def load_quantized(module, path, device=None):
+    """
+    Loads quantized weights saved with save_quantized into the layers of a module.
+
+    The weights are memory-mapped and wrapped into Params4bit and Int8Params without copies
+    and without a quantization pass, so loading is bounded by reading the pages of the file.
+    Linear8bitLt layers have to be created with has_fp16_weights=False.
+
+    Parameters:
+        module (`torch.nn.Module`):
+            The module with the same Linear4bit and Linear8bitLt layers as the saved one.
+        path (`str`):
+            The file written by save_quantized.
+        device (`torch.device`, *optional*):
+            Moves the loaded weights to this device, by default they stay memory-mapped on the CPU.
+    """
+    tensors, metadata = bnb.utils.load_packed_tensors(path)
+    for name, submodule in module.named_modules():
+        key = _quantized_weight_key(name)
+        if key not in metadata:
+            continue
+        info = metadata[key]
+        if info["type"] == "4bit":
+            if not isinstance(submodule, Linear4bit):
+                raise ValueError(f"{key} holds a 4-bit weight, but the module is a {type(submodule).__name__}.")
+            quant_state = dict(info["quant_state"])
+            for k in info["tensors"]:
+                quant_state[k] = tensors[f"{key}.{k}"]
+            weight = Params4bit.from_prequantized(tensors[key], quant_state)
+            weight.absmax_cache_policy = getattr(submodule.weight, "absmax_cache_policy", "memory-minimal")
+        else:
+            if not isinstance(submodule, Linear8bitLt) or submodule.state.has_fp16_weights:
+                raise ValueError(f"{key} holds an int8 weight, which needs a Linear8bitLt with has_fp16_weights=False.")
+            weight = Int8Params.from_prequantized(tensors[key], tensors[f"{key}.SCB"])
+            # drops the weight in the turing/ampere layout of a previous forward pass
+            submodule.state.CB = None
+            submodule.state.SCB = None
+            submodule.state.CxB = None
+        if device is not None:
+            weight = weight.to(device)
+        submodule.weight = weight
@@ -1,3 +1,4 @@
+import importlib
 import torch
 import torch.nn as nn
 import time
@@ -5,12 +6,23 @@ from functools import partial
 
 from bitsandbytes.triton.triton_utils import is_triton_available
 
-from bitsandbytes.triton.dequantize_rowwise import dequantize_rowwise
-from bitsandbytes.triton.quantize_rowwise import quantize_rowwise
-from bitsandbytes.triton.quantize_columnwise_and_transpose import quantize_columnwise_and_transpose
-from bitsandbytes.triton.int8_matmul_rowwise_dequantize import int8_matmul_rowwise_dequantize
-from bitsandbytes.triton.quantize_global import quantize_global, quantize_global_transpose
-from bitsandbytes.triton.int8_matmul_mixed_dequanitze import int8_matmul_mixed_dequanitze
+
+def lazy_kernel(module, name):
+    """Returns a wrapper which imports the triton kernel `name` from bitsandbytes.triton.`module` on its first call."""
+    def kernel(*args, **kwargs):
+        return getattr(importlib.import_module(f"bitsandbytes.triton.{module}"), name)(*args, **kwargs)
+    kernel.__name__ = name
+    return kernel
+
+
+# importing the kernels imports and probes triton, so it is deferred to the first forward pass
+dequantize_rowwise = lazy_kernel("dequantize_rowwise", "dequantize_rowwise")
+quantize_rowwise = lazy_kernel("quantize_rowwise", "quantize_rowwise")
+quantize_columnwise_and_transpose = lazy_kernel("quantize_columnwise_and_transpose", "quantize_columnwise_and_transpose")
+int8_matmul_rowwise_dequantize = lazy_kernel("int8_matmul_rowwise_dequantize", "int8_matmul_rowwise_dequantize")
+quantize_global = lazy_kernel("quantize_global", "quantize_global")
+quantize_global_transpose = lazy_kernel("quantize_global", "quantize_global_transpose")
+int8_matmul_mixed_dequanitze = lazy_kernel("int8_matmul_mixed_dequanitze", "int8_matmul_mixed_dequanitze")
 
 
 class _switchback_global(torch.autograd.Function):
@@ -2,6 +2,8 @@
 #
 # This source code is licensed under the MIT license found in the
 # LICENSE file in the root directory of this source tree.
+import os
+import weakref
 from collections import abc as container_abcs
 from collections import defaultdict
 from copy import deepcopy
@@ -18,6 +20,44 @@ class MockArgs:
             setattr(self, key, initial_data[key])
 
 
+class ParamGroup(dict):
+    """
+    A param_group which keeps track of changes to its hyperparameters.
+
+    Every assignment, for example the learning rate update of an LR scheduler, increments
+    `version` and records it as the version of the changed key. Optimizer8bit.get_config uses
+    this to update the cached per-parameter configs of a group only for the keys that changed.
+    In-place changes of a value, e.g. `group["betas"][0] = 0.8`, are not tracked.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.version = 0
+        self.key_versions = {}
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.version += 1
+        self.key_versions[key] = self.version
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.version += 1
+        self.key_versions[key] = self.version
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+
 class GlobalOptimManager:
     _instance = None
 
@@ -30,6 +70,8 @@ class GlobalOptimManager:
         self.optimizer = None
         self.uses_config_override = False
         self.module_weight_config_triple = []
+        # incremented with every change of the config overrides
+        self.version = 0
 
     @classmethod
     def get_instance(cls):
@@ -49,6 +91,7 @@ class GlobalOptimManager:
                     self.index2config[(group_index, p_index)] = self.pid2config[
                         id(p)
                     ]
+        self.version += 1
 
     def override_config(
         self, parameters, key=None, value=None, key_value_dict=None
@@ -86,9 +129,11 @@ class GlobalOptimManager:
                     self.pid2config[id(p)].update(key_value_dict)
                 else:
                     self.pid2config[id(p)] = key_value_dict
+        self.version += 1
 
     def register_module_override(self, module, param_name, config):
         self.module_weight_config_triple.append((module, param_name, config))
+        self.version += 1
 
 
 class Optimizer8bit(torch.optim.Optimizer):
@@ -98,8 +143,18 @@ class Optimizer8bit(torch.optim.Optimizer):
         self.name2qmap = {}
         self.is_paged = is_paged
         self.page_mng = F.GlobalPageManager.get_instance()
+        # the paged states of this optimizer, the page manager forgets them when the optimizer is deleted
+        self.paged_buffers = []
+        weakref.finalize(self, self.page_mng.unregister, id(self), self.paged_buffers)
 
         self.mng = GlobalOptimManager.get_instance()
+        # update CPU parameters with the same config in buckets instead of one by one
+        self.fused_step = True
+        self.step_plans = {}
+        # param -> percentile clipping scale of the current step, see clip_gradients
+        self.gnorm_scales = {}
+        # (gindex, pindex) -> (manager version, group version, resolved config)
+        self.config_cache = {}
         self.non_castable_tensor_keys = {
                 "qmap1",
                 "qmap2",
@@ -118,13 +173,60 @@ class Optimizer8bit(torch.optim.Optimizer):
         if optim_bits == 8:
             self.fill_qmap()
 
+    def add_param_group(self, param_group):
+        super().add_param_group(param_group)
+        self.param_groups[-1] = ParamGroup(self.param_groups[-1])
+
     def fill_qmap(self):
-        self.name2qmap["dynamic"] = F.create_dynamic_map(signed=True)
-        self.name2qmap["udynamic"] = F.create_dynamic_map(signed=False)
+        self.name2qmap["dynamic"] = F.get_codebook(F.create_dynamic_map, signed=True)
+        self.name2qmap["udynamic"] = F.get_codebook(F.create_dynamic_map, signed=False)
 
     def __setstate__(self, state):
         super().__setstate__(state)
 
+    def pack_qmap(self, qmap, qmaps):
+        """
+        Returns the name of the quantization map qmap in qmaps and adds it if it is missing.
+
+        qmaps maps names to the quantization maps of a checkpoint, which are stored once and
+        referenced by name in the parameter states. Equal maps share one name, the maps of
+        name2qmap keep their name.
+        """
+        for name, packed in qmaps.items():
+            if packed is qmap:
+                return name
+        for name, packed in qmaps.items():
+            if packed.shape == qmap.shape and torch.equal(packed, qmap.to(packed.device)):
+                return name
+        name = f"qmap{len(qmaps)}"
+        for registered_name, registered in self.name2qmap.items():
+            if registered.shape == qmap.shape and torch.equal(registered.to(qmap.device), qmap):
+                name = registered_name
+                break
+        qmaps[name] = qmap
+        return name
+
+    def state_dict(self):
+        r"""Returns the state of the optimizer as a :class:`dict`.
+
+        The quantization maps are stored once in ``state_dict["qmaps"]`` and the parameter
+        states reference them by name.
+        """
+        state_dict = super().state_dict()
+        qmaps = {}
+        packed_state = {}
+        for k, v in state_dict["state"].items():
+            if "qmap1" in v or "qmap2" in v:
+                v = dict(v)
+                for key in ("qmap1", "qmap2"):
+                    if isinstance(v.get(key), torch.Tensor):
+                        v[key] = self.pack_qmap(v[key], qmaps)
+            packed_state[k] = v
+        state_dict["state"] = packed_state
+        if qmaps:
+            state_dict["qmaps"] = qmaps
+        return state_dict
+
     def load_state_dict(self, state_dict):
         r"""Loads the optimizer state.
 
@@ -132,11 +234,14 @@ class Optimizer8bit(torch.optim.Optimizer):
             state_dict (dict): optimizer state. Should be an object returned
                 from a call to :meth:`state_dict`.
         """
-        # deepcopy, to be consistent with module API
-        state_dict = deepcopy(state_dict)
-        # Validate the state_dict
+        # the loaded state is a copy, to be consistent with module API, but instead of a
+        # deepcopy of the whole state_dict, each tensor is copied once while it is cast
         groups = self.param_groups
-        saved_groups = state_dict["param_groups"]
+        saved_groups = [
+            deepcopy({k: v for k, v in g.items() if k != "params"}) for g in state_dict["param_groups"]
+        ]
+        for g, saved in zip(saved_groups, state_dict["param_groups"]):
+            g["params"] = saved["params"]
 
         if len(groups) != len(saved_groups):
             raise ValueError(
@@ -160,21 +265,33 @@ class Optimizer8bit(torch.optim.Optimizer):
             )
         }
 
+        # tensors shared between parameters, like the quantization maps, stay shared
+        copies = {}
+
+        def copy_tensor(value, **kwargs):
+            key = (id(value), tuple(kwargs.items()))
+            if key not in copies:
+                copies[key] = (value, value.to(copy=True, **kwargs))
+            return copies[key][1]
+
         def cast(param, value):
             r"""Make a deep copy of value, casting all tensors to device of param."""
             if isinstance(value, torch.Tensor):
                 # Floating-point types are a bit special here. They are the only ones
                 # that are assumed to always match the type of params.
                 if param.is_floating_point() and value.dtype != torch.uint8:
-                    value = value.to(param.dtype)
-                return value
+                    return copy_tensor(value, dtype=param.dtype)
+                return copy_tensor(value)
             elif isinstance(value, dict):
+                new_value = {}
                 for k, v in value.items():
                     if k in self.non_castable_tensor_keys:
-                        value[k] = v.to(param.device)
+                        new_value[k] = copy_tensor(v, device=param.device)
                     else:
-                        value[k] = cast(param, v)
+                        new_value[k] = cast(param, v)
 
+                return new_value
+            elif isinstance(value, str):
                 return value
             elif isinstance(value, container_abcs.Iterable):
                 return type(value)(cast(param, v) for v in value)
@@ -184,13 +301,23 @@ class Optimizer8bit(torch.optim.Optimizer):
         # Copy state assigned to params (and cast tensors to appropriate types).
         # State that is not assigned to params is copied as is (needed for
         # backward compatibility).
+        # checkpoints without state_dict["qmaps"] store a copy of the quantization
+        # maps in every parameter state, equal maps are loaded only once
+        qmaps = dict(state_dict.get("qmaps", {}))
         state = defaultdict(dict)
         for k, v in state_dict["state"].items():
             if k in id_map:
                 param = id_map[k]
+                if "qmap1" in v or "qmap2" in v:
+                    v = dict(v)
+                    for key in ("qmap1", "qmap2"):
+                        if isinstance(v.get(key), torch.Tensor):
+                            v[key] = qmaps[self.pack_qmap(v[key], qmaps)]
+                        elif isinstance(v.get(key), str):
+                            v[key] = qmaps[v[key]]
                 state[param] = cast(param, v)
             else:
-                state[k] = v
+                state[k] = deepcopy(v)
 
         # Update parameter groups, setting their 'params' value
         def update_group(group, new_group):
@@ -198,9 +325,117 @@ class Optimizer8bit(torch.optim.Optimizer):
             return new_group
 
         param_groups = [
-            update_group(g, ng) for g, ng in zip(groups, saved_groups)
+            ParamGroup(update_group(g, ng)) for g, ng in zip(groups, saved_groups)
         ]
         self.__setstate__({"state": state, "param_groups": param_groups})
+        self.step_plans = {}
+        self.config_cache = {}
+        # the loaded states are not paged
+        self.page_mng.unregister(id(self), self.paged_buffers)
+        self.paged_buffers.clear()
+
+    def save_state_shards(self, path):
+        """
+        Saves the optimizer state into the directory path with one file per parameter.
+
+        Each parameter state is moved to the CPU and written on its own, so saving needs host
+        memory for the largest parameter state only. Quantization maps shared between parameters
+        are stored once in the index file. Load with load_state_shards.
+
+        Parameters
+        ----------
+        path : str
+            The directory of the shards, it is created if it does not exist.
+        """
+        os.makedirs(path, exist_ok=True)
+        qmaps, shards = {}, {}
+        param_groups = []
+        index = 0
+        for group in self.param_groups:
+            packed = {k: v for k, v in group.items() if k != "params"}
+            packed["params"] = list(range(index, index + len(group["params"])))
+            param_groups.append(packed)
+            for p in group["params"]:
+                state = self.state.get(p)
+                if state:
+                    shard = {}
+                    for k, v in state.items():
+                        if k in ("qmap1", "qmap2"):
+                            shard[k] = self.pack_qmap(v, qmaps)
+                        elif isinstance(v, torch.Tensor):
+                            shard[k] = v.cpu()
+                        else:
+                            shard[k] = v
+                    shards[index] = f"state_{index}.pt"
+                    torch.save(shard, os.path.join(path, shards[index]))
+                    del shard
+                index += 1
+
+        torch.save(
+            {
+                "param_groups": param_groups,
+                "qmaps": {name: qmap.cpu() for name, qmap in qmaps.items()},
+                "shards": shards,
+            },
+            os.path.join(path, "index.pt"),
+        )
+
+    def load_state_shards(self, path):
+        """
+        Loads an optimizer state saved with save_state_shards, one parameter at a time.
+
+        The state of each parameter is copied into its existing buffers, which are allocated
+        with init_state first for parameters without state, so paged states stay paged and
+        loading needs host memory for the largest parameter state only.
+
+        Parameters
+        ----------
+        path : str
+            The directory of the shards.
+        """
+        index = torch.load(os.path.join(path, "index.pt"))
+        saved_groups = index["param_groups"]
+        if len(self.param_groups) != len(saved_groups):
+            raise ValueError(
+                "loaded state dict has a different number of "
+                "parameter groups"
+            )
+        if any(len(g["params"]) != len(s["params"]) for g, s in zip(self.param_groups, saved_groups)):
+            raise ValueError(
+                "loaded state dict contains a parameter group "
+                "that doesn't match the size of optimizer's group"
+            )
+
+        qmaps = {}
+        for gindex, (group, saved_group) in enumerate(zip(self.param_groups, saved_groups)):
+            group.update({k: v for k, v in saved_group.items() if k != "params"})
+            for pindex, (p, saved_index) in enumerate(zip(group["params"], saved_group["params"])):
+                if saved_index not in index["shards"]:
+                    self.state.pop(p, None)
+                    continue
+                shard = torch.load(os.path.join(path, index["shards"][saved_index]), map_location="cpu")
+                if len(self.state[p]) == 0:
+                    self.init_state(group, p, gindex, pindex)
+                state = self.state[p]
+                for k, v in shard.items():
+                    if k in ("qmap1", "qmap2"):
+                        if (v, p.device) not in qmaps:
+                            qmaps[(v, p.device)] = index["qmaps"][v].to(p.device)
+                        state[k] = qmaps[(v, p.device)]
+                    elif isinstance(v, torch.Tensor):
+                        if k not in self.non_castable_tensor_keys and p.is_floating_point() and v.dtype != torch.uint8:
+                            v = v.to(p.dtype)
+                        current = state.get(k)
+                        if isinstance(current, torch.Tensor) and current.shape == v.shape and current.dtype == v.dtype:
+                            current.copy_(v)
+                        else:
+                            state[k] = v.to(p.device)
+                    else:
+                        state[k] = v
+                del shard
+
+        self.step_plans = {}
+        self.config_cache = {}
 
     def to_gpu(self):
         for gindex, group in enumerate(self.param_groups):
@@ -256,19 +491,42 @@ class Optimizer8bit(torch.optim.Optimizer):
             self.to_gpu()  # needed for fairseq pure fp16 training
             self.initialized = True
 
-        #if self.is_paged: self.page_mng.prefetch_all()
+        # buckets bypass update_step, so optimizers which override it update one parameter at a time
+        builtin_update_step = type(self).update_step in (Optimizer2State.update_step, Optimizer1State.update_step)
+        fused_step = self.fused_step and builtin_update_step
         for gindex, group in enumerate(self.param_groups):
+            pindices = []
             for pindex, p in enumerate(group["params"]):
                 if p.grad is None:
                     continue
                 state = self.state[p]
                 if len(state) == 0:
                     self.init_state(group, p, gindex, pindex)
-
-                self.prefetch_state(p)
-                self.update_step(group, p, gindex, pindex)
-                torch.cuda.synchronize()
-        if self.is_paged:
+                pindices.append(pindex)
+
+            if not fused_step:
+                if builtin_update_step:
+                    self.clip_gradients(gindex, group, pindices)
+                for pindex in pindices:
+                    p = group["params"][pindex]
+                    self.prefetch_state(p)
+                    self.update_step(group, p, gindex, pindex)
+                    self.release_state(p)
+            else:
+                plan = self.get_step_plan(gindex, group, pindices)
+                # buckets compute their scales in update_step_multi
+                self.clip_gradients(gindex, group, [pindex for kind, params in plan if kind == "single" for pindex, config in params])
+                for kind, params in plan:
+                    for pindex, config in params:
+                        self.prefetch_state(group["params"][pindex])
+                    if kind == "single":
+                        for pindex, config in params:
+                            self.update_step(group, group["params"][pindex], gindex, pindex)
+                    else:
+                        self.update_step_multi(kind, group, gindex, params)
+                    for pindex, config in params:
+                        self.release_state(group["params"][pindex])
+        if self.is_paged and torch.cuda.is_available():
             # all paged operation are asynchronous, we need
             # to sync to make sure all tensors are in the right state
             torch.cuda.synchronize()
@@ -277,6 +535,25 @@ class Optimizer8bit(torch.optim.Optimizer):
         return loss
 
     def get_config(self, gindex, pindex, group):
+        """
+        Returns the config of a parameter: the group hyperparameters, the optimizer args and the overrides.
+
+        Resolved configs are cached. A change of the config overrides resolves the config again,
+        a change of the group hyperparameters, like the lr of an LR scheduler, only updates the
+        changed keys in place. The returned dict is shared and must not be modified.
+        """
+        version = getattr(group, "version", None)
+        cached = self.config_cache.get((gindex, pindex))
+        if version is not None and cached is not None and cached[0] == self.mng.version:
+            config = cached[2]
+            if cached[1] != version:
+                overrides = self.mng.index2config.get((gindex, pindex), {})
+                for key in ("betas", "eps", "weight_decay", "lr"):
+                    if group.key_versions.get(key, 0) > cached[1] and key not in overrides:
+                        config[key] = group[key]
+                self.config_cache[(gindex, pindex)] = (self.mng.version, version, config)
+            return config
+
         config = {}
         config["betas"] = group["betas"]
         config["eps"] = group["eps"]
@@ -291,6 +568,8 @@ class Optimizer8bit(torch.optim.Optimizer):
 
         if (gindex, pindex) in self.mng.index2config:
             config.update(self.mng.index2config[(gindex, pindex)])
+        if version is not None:
+            self.config_cache[(gindex, pindex)] = (self.mng.version, version, config)
         return config
 
     def init_state(self, group, p, gindex, pindex):
@@ -301,25 +580,191 @@ class Optimizer8bit(torch.optim.Optimizer):
             "The update_step method needs to be overridden"
         )
 
+    def clip_gradients(self, gindex, group, pindices):
+        """
+        Computes the percentile clipping scales of the parameters before their update_step.
+
+        The scales are computed on the device of the gradients and copied to the host with one
+        transfer for all parameters, instead of one for each update.
+        """
+        ps, scales = [], []
+        for pindex in pindices:
+            p = group["params"][pindex]
+            config = self.get_config(gindex, pindex, group)
+            if config["percentile_clipping"] < 100:
+                state = self.state[p]
+                current_gnorm, clip_value, gnorm_scale = F.percentile_clipping(
+                    p.grad, state["gnorm_vec"], state["step"] + 1, config["percentile_clipping"]
+                )
+                ps.append(p)
+                scales.append(gnorm_scale)
+        for p, gnorm_scale in zip(ps, F.scales_to_host(scales)):
+            self.gnorm_scales[p] = gnorm_scale
+
+    def get_gnorm_scale(self, p, step, config):
+        """Returns the percentile clipping scale of p, computed by clip_gradients or on its own."""
+        if config["percentile_clipping"] >= 100:
+            return 1.0
+        if p in self.gnorm_scales:
+            return self.gnorm_scales.pop(p)
+        current_gnorm, clip_value, gnorm_scale = F.percentile_clipping(
+            p.grad, self.state[p]["gnorm_vec"], step, config["percentile_clipping"]
+        )
+        return gnorm_scale
+
+    def get_update_kind(self, p, config):
+        """Returns how p is updated: with other parameters ("32bit", "8bit_blockwise") or on its own ("single")."""
+        state = self.state[p]
+        # the multi-tensor kernels are CPU only
+        if p.device.type != "cpu" or not p.is_contiguous():
+            return "single"
+
+        if state["state1"].dtype == torch.float32:
+            kind = "32bit"
+            optimizers = F.str2optimizer32bit_cpu
+        elif state["state1"].dtype == torch.uint8 and config["block_wise"]:
+            kind = "8bit_blockwise"
+            optimizers = F.str2optimizer8bit_blockwise_multi_cpu
+        else:
+            return "single"
+        return kind if self.optimizer_name in optimizers else "single"
+
+    def get_step_plan(self, gindex, group, pindices):
+        """
+        Splits the parameters of a group into buckets which are updated with one call each.
+
+        Parameters in a bucket share the update kind, device, data type and all hyperparameters of
+        the fused update. The plan only depends on the parameters with gradients and the config
+        overrides, so it is rebuilt only if one of them changes. Changes of the group
+        hyperparameters apply to all parameters of a bucket which do not override them and reach
+        the cached configs through get_config, so they keep the plan.
+        """
+        key = (tuple(pindices), self.mng.version)
+        if getattr(group, "version", None) is None:
+            key += (group["lr"], tuple(group["betas"]), group["eps"], group["weight_decay"])
+        cached = self.step_plans.get(gindex)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        buckets = {}
+        for pindex in pindices:
+            p = group["params"][pindex]
+            config = self.get_config(gindex, pindex, group)
+            kind = self.get_update_kind(p, config)
+            if kind == "single":
+                bucket_key = (kind, pindex)
+            else:
+                bucket_key = (
+                    kind,
+                    p.device,
+                    p.dtype,
+                    tuple(config["betas"]),
+                    config["eps"],
+                    config["weight_decay"],
+                    config["lr"],
+                    config["max_unorm"],
+                    config["skip_zeros"],
+                    frozenset(self.mng.index2config.get((gindex, pindex), {})),
+                )
+            if bucket_key not in buckets:
+                buckets[bucket_key] = (kind, [])
+            buckets[bucket_key][1].append((pindex, config))
+
+        plan = list(buckets.values())
+        self.step_plans[gindex] = (key, plan)
+        return plan
+
+    @torch.no_grad()
+    def update_step_multi(self, kind, group, gindex, params):
+        """Updates a bucket of (pindex, config) from get_step_plan with one fused call."""
+        config = self.get_config(gindex, params[0][0], group)
+        ps, grads, steps, gnorm_scales = [], [], [], []
+        for pindex, pconfig in params:
+            p = group["params"][pindex]
+            state = self.state[p]
+            state["step"] += 1
+            if pconfig["percentile_clipping"] < 100:
+                current_gnorm, clip_value, gnorm_scale = F.percentile_clipping(
+                    p.grad, state["gnorm_vec"], state["step"], pconfig["percentile_clipping"]
+                )
+            else:
+                gnorm_scale = 1.0
+            ps.append(p)
+            grads.append(p.grad.contiguous())
+            steps.append(state["step"])
+            gnorm_scales.append(gnorm_scale)
+
+        states = [self.state[p] for p in ps]
+        two_state = "state2" in states[0]
+        if kind == "32bit":
+            F.optimizer_update_32bit_multi(
+                self.optimizer_name,
+                grads,
+                ps,
+                [state["state1"] for state in states],
+                config["betas"][0],
+                config["eps"],
+                steps,
+                config["lr"],
+                [state["state2"] for state in states] if two_state else None,
+                config["betas"][1],
+                config["weight_decay"],
+                gnorm_scales,
+                [state["unorm_vec"] for state in states] if config["max_unorm"] > 0.0 else None,
+                max_unorm=config["max_unorm"],
+                skip_zeros=config["skip_zeros"],
+            )
+        elif kind == "8bit_blockwise":
+            F.optimizer_update_8bit_blockwise_multi(
+                self.optimizer_name,
+                grads,
+                ps,
+                [state["state1"] for state in states],
+                [state["state2"] for state in states] if two_state else None,
+                config["betas"][0],
+                config["betas"][1],
+                config["eps"],
+                steps,
+                config["lr"],
+                [state["qmap1"] for state in states],
+                [state["qmap2"] for state in states] if two_state else None,
+                [state["absmax1"] for state in states],
+                [state["absmax2"] for state in states] if two_state else None,
+                config["weight_decay"],
+                gnorm_scales,
+                skip_zeros=config["skip_zeros"],
+            )
+        else:
+            raise ValueError(f"Unknown update kind: {kind}")
+
     def get_state_buffer(self, p, dtype=torch.float32):
         if not self.is_paged or p.numel() < 1e5:
             return torch.zeros_like(p, dtype=dtype, device=p.device)
+        elif p.device.type == "cpu":
+            # > 1 MB, paged by the operating system to a memory-mapped file which starts zeroed
+            buff = F.get_mmap_paged(*p.shape, dtype=dtype)
+            self.page_mng.paged_tensors.append(buff)
+            self.paged_buffers.append(buff)
+            return buff
         else:
             # > 1 MB
             buff = F.get_paged(*p.shape, dtype=dtype, device=p.device)
             F.fill(buff, 0)
             self.page_mng.paged_tensors.append(buff)
+            self.paged_buffers.append(buff)
             return buff
 
     def prefetch_state(self, p):
+        """Acquires the paged states of p from the page manager, which prefetches the states updated next."""
         if self.is_paged:
             state = self.state[p]
-            s1 = state['state1']
-            is_paged = getattr(s1, 'is_paged', False)
-            if is_paged:
-                F.prefetch_tensor(state['state1'])
-                if 'state2' in state:
-                    F.prefetch_tensor(state['state2'])
+            paged = [state[k] for k in ("state1", "state2") if getattr(state.get(k), "is_paged", False)]
+            if len(paged) > 0:
+                self.page_mng.acquire((id(self), id(p)), paged, owner=id(self))
+
+    def release_state(self, p):
+        if self.is_paged:
+            self.page_mng.release((id(self), id(p)))
 
 
 class Optimizer2State(Optimizer8bit):
@@ -402,14 +847,8 @@ class Optimizer2State(Optimizer8bit):
             state["state2"] = self.get_state_buffer(p, dtype=torch.float32)
         elif dtype == torch.uint8:
             if state["step"] == 0:
-                if "dynamic" not in self.name2qmap:
-                    self.fill_qmap()
-                self.name2qmap["dynamic"] = self.name2qmap["dynamic"].to(
-                    p.device
-                )
-                self.name2qmap["udynamic"] = self.name2qmap["udynamic"].to(
-                    p.device
-                )
+                self.name2qmap["dynamic"] = F.get_codebook(F.create_dynamic_map, signed=True, device=p.device)
+                self.name2qmap["udynamic"] = F.get_codebook(F.create_dynamic_map, signed=False, device=p.device)
 
             state["state1"] = self.get_state_buffer(p, dtype=torch.uint8)
             state["qmap1"] = self.name2qmap["dynamic"]
@@ -458,12 +897,7 @@ class Optimizer2State(Optimizer8bit):
         state["step"] += 1
         step = state["step"]
 
-        if config["percentile_clipping"] < 100:
-            current_gnorm, clip_value, gnorm_scale = F.percentile_clipping(
-                grad, state["gnorm_vec"], step, config["percentile_clipping"]
-            )
-        else:
-            gnorm_scale = 1.0
+        gnorm_scale = self.get_gnorm_scale(p, step, config)
 
         if state["state1"].dtype == torch.float:
             F.optimizer_update_32bit(
@@ -610,11 +1044,7 @@ class Optimizer1State(Optimizer8bit):
             state["state1"] = self.get_state_buffer(p, dtype=torch.float32)
         elif dtype == torch.uint8:
             if state["step"] == 0:
-                if "dynamic" not in self.name2qmap:
-                    self.fill_qmap()
-                self.name2qmap["dynamic"] = self.name2qmap["dynamic"].to(
-                    p.device
-                )
+                self.name2qmap["dynamic"] = F.get_codebook(F.create_dynamic_map, signed=True, device=p.device)
 
             state["state1"] = self.get_state_buffer(p, dtype=torch.uint8)
             state["qmap1"] = self.name2qmap["dynamic"]
@@ -651,12 +1081,7 @@ class Optimizer1State(Optimizer8bit):
         state["step"] += 1
         step = state["step"]
 
-        if config["percentile_clipping"] < 100:
-            current_gnorm, clip_value, gnorm_scale = F.percentile_clipping(
-                grad, state["gnorm_vec"], step, config["percentile_clipping"]
-            )
-        else:
-            gnorm_scale = 1.0
+        gnorm_scale = self.get_gnorm_scale(p, step, config)
 
         if state["state1"].dtype == torch.float:
             F.optimizer_update_32bit(
@@ -28,8 +28,8 @@ class LinearFP8Mixed(nn.Linear):
 
     def forward(self, x: torch.Tensor):
         if self.fw_code is None:
-            self.bw_code = bnb.functional.create_fp8_map(True, 5, 2, 8).to(x.device)
-            self.fw_code = bnb.functional.create_fp8_map(True, 4, 3, 8).to(x.device)
+            self.bw_code = bnb.functional.get_codebook(bnb.functional.create_fp8_map, True, 5, 2, 8, device=x.device)
+            self.fw_code = bnb.functional.get_codebook(bnb.functional.create_fp8_map, True, 4, 3, 8, device=x.device)
 
         out = bnb.research.matmul_fp8_mixed(x, self.weight.t(), fw_code=self.fw_code, bw_code=self.bw_code, bsz=self.bsz, bsz2=self.bsz2)
         if self.bias is not None:
@@ -54,8 +54,8 @@ class LinearFP8Global(nn.Linear):
 
     def forward(self, x: torch.Tensor):
         if self.fw_code is None:
-            self.bw_code = bnb.functional.create_fp8_map(True, 5, 2, 8).to(x.device)
-            self.fw_code = bnb.functional.create_fp8_map(True, 4, 3, 8).to(x.device)
+            self.bw_code = bnb.functional.get_codebook(bnb.functional.create_fp8_map, True, 5, 2, 8, device=x.device)
+            self.fw_code = bnb.functional.get_codebook(bnb.functional.create_fp8_map, True, 4, 3, 8, device=x.device)
 
         out = bnb.matmul_fp8_global(x, self.weight.t(), fw_code=self.fw_code, bw_code=self.bw_code, bsz=self.bsz, bsz2=self.bsz2)
         if self.bias is not None:
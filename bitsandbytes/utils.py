@@ -1,8 +1,14 @@
+import json
+import math
 import shlex
+import struct
 import subprocess
+import numpy as np
 import torch
 from typing import Tuple
 
+import bitsandbytes as bnb
+
 def outlier_hook(module, input):
     assert isinstance(module, torch.nn.Linear)
     tracer = OutlierTracer.get_instance()
@@ -35,6 +41,59 @@ def outlier_hook(module, input):
         for hook in tracer.hooks:
             hook.remove()
 
+def calibration_hook(module, input):
+    tracer = OutlierTracer.get_instance()
+    name = tracer.module2name[module]
+    if name not in tracer.calibration_stats:
+        tracer.calibration_stats[name] = HiddenDimStats()
+    tracer.calibration_stats[name].update(input[0].detach())
+
+
+class HiddenDimStats(object):
+    """
+    Running mean, standard deviation and absolute maximum per hidden dimension over a stream of batches.
+
+    Batches are merged with the parallel variance update of Chan et al., so the statistics are exact
+    for any number of batches, and they stay on the device of the inputs.
+    """
+    def __init__(self, count=0, mean=None, m2=None, absmax=None):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        self.absmax = absmax
+
+    def update(self, x):
+        x = x.reshape(-1, x.shape[-1]).float()
+        n = x.shape[0]
+        if n == 0:
+            return
+        mean = x.mean(0)
+        m2 = (x - mean).square().sum(0)
+        absmax = x.abs().amax(0)
+        if self.count == 0:
+            self.count, self.mean, self.m2, self.absmax = n, mean, m2, absmax
+            return
+        if self.mean.device != x.device:
+            # loaded statistics are on the cpu
+            self.mean, self.m2, self.absmax = self.mean.to(x.device), self.m2.to(x.device), self.absmax.to(x.device)
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean = self.mean + delta*(n/total)
+        self.m2 = self.m2 + m2 + delta.square()*(self.count*n/total)
+        self.absmax = torch.maximum(self.absmax, absmax)
+        self.count = total
+
+    @property
+    def std(self):
+        return (self.m2/max(self.count - 1, 1)).sqrt()
+
+    def outlier_dims(self, zscore=3.0, threshold=6.0):
+        """Hidden dimensions with a std zscore above zscore or values with a magnitude above threshold."""
+        std = self.std
+        zstd = (std - std.mean())/std.std()
+        idx = torch.where((zstd > zscore) | (self.absmax > threshold))[0]
+        return idx
+
 
 class OutlierTracer(object):
     _instance = None
@@ -65,12 +124,147 @@ class OutlierTracer(object):
         if not self.is_initialized():
             print('Outlier tracer is not initialized...')
             return None
+        # calibrated profiles are keyed by module name
+        name = getattr(self, 'param2name', {}).get(weight)
+        name2outlier_idx = getattr(self, 'name2outlier_idx', {})
+        if name is not None and name in name2outlier_idx:
+            return name2outlier_idx[name]
         hvalue = self.get_hvalue(weight)
-        if hvalue in self.hvalue2outlier_idx:
+        if hvalue in getattr(self, 'hvalue2outlier_idx', {}):
             return self.hvalue2outlier_idx[hvalue]
         else:
             return None
 
+    def track_modules(self, model):
+        self.module2name = {}
+        self.param2name = {}
+        for n, m in model.named_modules():
+            if isinstance(m, torch.nn.Linear):
+                self.module2name[m] = n
+                self.param2name[m.weight] = n
+
+    def start_calibration(self, model, resume=False):
+        """
+        Starts to accumulate the statistics of the inputs of all linear layers of the model.
+
+        Unlike initialize, which decides the outlier dimensions from a single forward pass, the statistics
+        are collected over all forward passes until finish_calibration is called. With resume=True the
+        statistics of the last calibration or of a loaded profile are updated instead of started anew.
+        """
+        self.track_modules(model)
+        if not resume or not hasattr(self, 'calibration_stats'):
+            self.calibration_stats = {}
+        self.calibration_hooks = [m.register_forward_pre_hook(calibration_hook) for m in self.module2name]
+
+    def finish_calibration(self, zscore=3.0, threshold=6.0):
+        """
+        Removes the calibration hooks and decides the outlier dimensions of each layer from its statistics.
+
+        Parameters:
+            zscore (`float`):
+                Hidden dimensions with a standard deviation zscore above this value are outliers.
+            threshold (`float`):
+                Hidden dimensions with inputs of a magnitude above this value are outliers.
+
+        Returns:
+            `Dict[str, torch.Tensor]`: The outlier dimensions for each module name.
+        """
+        for hook in getattr(self, 'calibration_hooks', []):
+            hook.remove()
+        self.calibration_hooks = []
+        self.name2outlier_idx = {
+            name: stats.outlier_dims(zscore, threshold) for name, stats in self.calibration_stats.items()
+        }
+        self.initialized = True
+        return self.name2outlier_idx
+
+    @torch.no_grad()
+    def calibrate(self, model, batches, zscore=3.0, threshold=6.0, resume=False):
+        """
+        Runs the model on batches of inputs and decides the outlier dimensions of all linear layers.
+
+        Parameters:
+            model (`torch.nn.Module`):
+                The model.
+            batches (`Iterable`):
+                The inputs, tuples are passed as positional and dicts as keyword arguments.
+            zscore (`float`), threshold (`float`):
+                See finish_calibration.
+            resume (`bool`):
+                See start_calibration.
+
+        Returns:
+            `Dict[str, torch.Tensor]`: The outlier dimensions for each module name.
+        """
+        self.start_calibration(model, resume)
+        try:
+            for batch in batches:
+                if isinstance(batch, dict):
+                    model(**batch)
+                elif isinstance(batch, (tuple, list)):
+                    model(*batch)
+                else:
+                    model(batch)
+        finally:
+            outliers = self.finish_calibration(zscore, threshold)
+        return outliers
+
+    def save_profile(self, path):
+        """
+        Saves the outlier dimensions and the statistics of the calibration into a file.
+
+        Parameters:
+            path (`str`):
+                The file to write.
+        """
+        tensors, modules = {}, {}
+        for name, outlier_idx in self.name2outlier_idx.items():
+            tensors[f"{name}.outlier_idx"] = outlier_idx
+            stats = getattr(self, 'calibration_stats', {}).get(name)
+            if stats is not None and stats.count > 0:
+                tensors[f"{name}.mean"] = stats.mean
+                tensors[f"{name}.m2"] = stats.m2
+                tensors[f"{name}.absmax"] = stats.absmax
+            modules[name] = {"count": 0 if stats is None else stats.count}
+        save_packed_tensors(path, tensors, {"type": "outlier_profile", "modules": modules})
+
+    def load_profile(self, path, model=None):
+        """
+        Loads a profile saved with save_profile, so layers get their outlier dimensions without a calibration pass.
+
+        The statistics are loaded as well, so calibrate or start_calibration with resume=True continue
+        the calibration. If a model is given, the outlier dimensions are assigned to its OutlierAwareLinear
+        layers right away, which then need neither the tracer nor hooks in the forward pass.
+
+        Parameters:
+            path (`str`):
+                The file written by save_profile.
+            model (`torch.nn.Module`, *optional*):
+                The model with the same module names as the calibrated one.
+
+        Returns:
+            `Dict[str, torch.Tensor]`: The outlier dimensions for each module name.
+        """
+        tensors, metadata = load_packed_tensors(path)
+        if metadata.get("type") != "outlier_profile":
+            raise ValueError(f"{path} is not an outlier profile written by save_profile.")
+        self.name2outlier_idx = {}
+        self.calibration_stats = {}
+        for name, info in metadata["modules"].items():
+            self.name2outlier_idx[name] = tensors[f"{name}.outlier_idx"].clone()
+            if info["count"] > 0:
+                self.calibration_stats[name] = HiddenDimStats(
+                    info["count"], tensors[f"{name}.mean"].clone(), tensors[f"{name}.m2"].clone(), tensors[f"{name}.absmax"].clone()
+                )
+        self.initialized = True
+
+        if model is not None:
+            self.track_modules(model)
+            for m, name in self.module2name.items():
+                if isinstance(m, bnb.nn.OutlierAwareLinear) and name in self.name2outlier_idx:
+                    m.outlier_dim = self.name2outlier_idx[name].to(m.weight.device)
+        return self.name2outlier_idx
+
     @classmethod
     def get_instance(cls):
         if cls._instance is None:
@@ -197,3 +391,270 @@ def replace_linear(model, linear_replacement, skip_modules=["lm_head"], copy_wei
                if func is not None: func(module)
     return model
 
+
+# quantization configs compared by quantization_report: the 4-bit data types of Linear4bit and the
+# row-wise int8 quantization of Linear8bitLt
+QUANTIZATION_CANDIDATES = [
+    {"quant_type": quant_type, "blocksize": blocksize, "compress_statistics": compress_statistics}
+    for quant_type in ["nf4", "fp4"] for blocksize in [64, 128, 256] for compress_statistics in [True, False]
+] + [{"quant_type": "int8"}]
+
+
+def quantization_error(A, A2):
+    """
+    Returns the signal-to-quantization-noise ratio in dB and the maximum absolute error of A2 as an approximation of A.
+    """
+    error = A.float() - A2.float()
+    noise = error.square().sum().item()
+    signal = A.float().square().sum().item()
+    if noise == 0.0:
+        sqnr = math.inf
+    elif signal == 0.0:
+        sqnr = -math.inf
+    else:
+        sqnr = 10 * math.log10(signal / noise)
+    max_error = error.abs().max().item() if error.numel() > 0 else 0.0
+    return sqnr, max_error
+
+
+def quantize_weight(weight, config):
+    """
+    Quantizes and dequantizes a weight on the CPU as a Linear4bit or Linear8bitLt layer with the given config would.
+
+    Returns the dequantized weight and the number of bytes of the quantized weight and its statistics.
+    """
+    F = bnb.functional
+    weight = weight.detach().cpu().float()
+    n = weight.numel()
+    if config["quant_type"] == "int8":
+        CB, _, SCB, _, _ = F.double_quant(weight)
+        return CB.float() * SCB.unsqueeze(1) / 127.0, n + 4 * SCB.numel()
+
+    packed, quant_state = F.quantize_4bit(weight, blocksize=config["blocksize"], compress_statistics=config["compress_statistics"],
+                                          quant_type=config["quant_type"])
+    num_bytes = packed.numel() + quant_state[0].numel() * quant_state[0].element_size()
+    if quant_state[4] is not None:
+        offset, state2 = quant_state[4]
+        num_bytes += offset.numel() * offset.element_size() + state2[0].numel() * state2[0].element_size()
+    return F.dequantize_4bit(packed, quant_state), num_bytes
+
+
+def quantization_report(model, candidates=None, skip_modules=["lm_head"]):
+    """
+    Measures the quantization error and memory of each nn.Linear of a model for each candidate config.
+
+    The weights are quantized on the CPU, the model itself is not changed.
+
+    Parameters:
+        model (`torch.nn.Module`):
+            The model with the nn.Linear layers to quantize.
+        candidates (`List[dict]`, *optional*, defaults to `QUANTIZATION_CANDIDATES`):
+            The configs to compare. A config is either `{"quant_type": "int8"}` or a dict with
+            the `quant_type` ("fp4" or "nf4"), `blocksize` and `compress_statistics` of a 4-bit weight.
+        skip_modules (`List[str]`, *optional*, defaults to `lm_head`):
+            List of modules names not to quantize, as in replace_linear.
+
+    Returns:
+        `dict`: For the name of each layer, a list of dicts with the `config`, the `bytes` of the quantized
+        weight, its `sqnr` in dB and its `max_error`, sorted by bytes. The entry with config None is the
+        16-bit weight.
+    """
+    candidates = QUANTIZATION_CANDIDATES if candidates is None else candidates
+    report = {}
+    for name, module in model.named_modules():
+        if not isinstance(module, torch.nn.Linear) or name.rpartition(".")[2] in skip_modules:
+            continue
+        results = [{"config": None, "bytes": 2 * module.weight.numel(), "sqnr": math.inf, "max_error": 0.0}]
+        for config in candidates:
+            dequantized, num_bytes = quantize_weight(module.weight, config)
+            sqnr, max_error = quantization_error(module.weight.detach().cpu(), dequantized)
+            results.append({"config": dict(config), "bytes": num_bytes, "sqnr": sqnr, "max_error": max_error})
+        report[name] = sorted(results, key=lambda result: result["bytes"])
+    return report
+
+
+def quantization_plan(report, min_sqnr=None, max_error=None):
+    """
+    Selects the config with the least memory for each layer of a quantization_report within the error bounds.
+
+    The layers are independent, so this minimizes the memory of the model. Layers for which no
+    config meets the bounds are kept in 16-bit (config None).
+
+    Parameters:
+        report (`dict`):
+            The result of quantization_report.
+        min_sqnr (`float`, *optional*):
+            The minimum signal-to-quantization-noise ratio in dB of each layer.
+        max_error (`float`, *optional*):
+            The maximum absolute error of each weight.
+
+    Returns:
+        `Tuple[dict, int]`: The config of each layer and the total bytes of the planned weights.
+    """
+    plan = {}
+    total_bytes = 0
+    for name, results in report.items():
+        for result in results:
+            if result["config"] is None:
+                fallback = result
+                continue
+            if min_sqnr is not None and result["sqnr"] < min_sqnr:
+                continue
+            if max_error is not None and result["max_error"] > max_error:
+                continue
+            break
+        else:
+            result = fallback
+        plan[name] = result["config"]
+        total_bytes += result["bytes"]
+    return plan, total_bytes
+
+
+def apply_quantization_plan(model, plan, compute_dtype=None):
+    """
+    Replaces the nn.Linear layers of a model as planned by quantization_plan.
+
+    Layers with a 4-bit config become Linear4bit, layers with the int8 config Linear8bitLt with int8
+    weights, layers with config None are kept. The weights are quantized right away on the device of
+    the model.
+    """
+    for name, config in plan.items():
+        if config is None:
+            continue
+        parent_name, _, child_name = name.rpartition(".")
+        parent = model.get_submodule(parent_name) if parent_name else model
+        module = getattr(parent, child_name)
+
+        # replace_linear replaces the child of a container that only holds this layer
+        container = torch.nn.Module()
+        container.add_module(child_name, module)
+        if config["quant_type"] == "int8":
+            replace_linear(container, lambda *args: bnb.nn.Linear8bitLt(*args, has_fp16_weights=False), skip_modules=[])
+            new_module = getattr(container, child_name)
+            new_module.weight = bnb.nn.Int8Params(module.weight.data, requires_grad=False, has_fp16_weights=False).quantize()
+        else:
+            replace_linear(container, lambda *args: bnb.nn.Linear4bit(*args, compute_dtype=compute_dtype,
+                           compress_statistics=config["compress_statistics"], quant_type=config["quant_type"]), skip_modules=[])
+            new_module = getattr(container, child_name)
+            new_module.weight = bnb.nn.Params4bit(module.weight.data, requires_grad=False, blocksize=config["blocksize"],
+                                                  compress_statistics=config["compress_statistics"], quant_type=config["quant_type"]).quantize()
+        if module.bias is not None:
+            new_module.bias = module.bias
+        setattr(parent, child_name, new_module)
+    return model
+
+
+def pack_dict_to_tensor(source_dict):
+    """
+    Packs a JSON serializable dict into a uint8 tensor, so that it can be stored in a state_dict.
+
+    Parameters:
+        source_dict (`dict`):
+            The dict to pack.
+
+    Returns:
+        `torch.Tensor`: The UTF-8 encoded JSON of the dict.
+    """
+    json_bytes = json.dumps(source_dict).encode("utf-8")
+    return torch.tensor(list(json_bytes), dtype=torch.uint8)
+
+
+def unpack_tensor_to_dict(tensor_data):
+    """
+    Unpacks a dict packed with pack_dict_to_tensor.
+
+    Parameters:
+        tensor_data (`torch.Tensor`):
+            The uint8 tensor of pack_dict_to_tensor.
+
+    Returns:
+        `dict`: The unpacked dict.
+    """
+    return json.loads(bytes(tensor_data.cpu().tolist()).decode("utf-8"))
+
+
+PACKED_TENSORS_MAGIC = b"BNBPACK1"
+# tensor data is aligned so that the memory-mapped bytes can be viewed as any dtype
+PACKED_TENSORS_ALIGNMENT = 64
+
+
+def _align(offset):
+    return (offset + PACKED_TENSORS_ALIGNMENT - 1) // PACKED_TENSORS_ALIGNMENT * PACKED_TENSORS_ALIGNMENT
+
+
+def save_packed_tensors(path, tensors, metadata=None):
+    """
+    Saves tensors into a file which load_packed_tensors can memory-map.
+
+    The file holds a JSON header with the dtype, shape and offset of each tensor and the
+    metadata, followed by the raw bytes of the tensors.
+
+    Parameters:
+        path (`str`):
+            The file to write.
+        tensors (`Dict[str, torch.Tensor]`):
+            The tensors to save, they are copied to the CPU one at a time.
+        metadata (`dict`, *optional*):
+            JSON serializable data stored with the tensors.
+    """
+    header = {"metadata": metadata if metadata is not None else {}, "tensors": {}}
+    offset = 0
+    for name, tensor in tensors.items():
+        nbytes = tensor.numel() * tensor.element_size()
+        header["tensors"][name] = {
+            "dtype": str(tensor.dtype).replace("torch.", ""),
+            "shape": list(tensor.shape),
+            "offset": offset,
+            "nbytes": nbytes,
+        }
+        offset = _align(offset + nbytes)
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_start = _align(len(PACKED_TENSORS_MAGIC) + 8 + len(header_bytes))
+
+    with open(path, "wb") as f:
+        f.write(PACKED_TENSORS_MAGIC)
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for name, tensor in tensors.items():
+            f.seek(data_start + header["tensors"][name]["offset"])
+            data = tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8)
+            f.write(memoryview(data.numpy()))
+        # the last tensor might be empty, the file has to cover all offsets
+        f.truncate(data_start + offset)
+
+
+def load_packed_tensors(path):
+    """
+    Memory-maps a file written by save_packed_tensors.
+
+    The tensors are CPU tensors backed by a copy-on-write mapping of the file, so loading
+    copies no data, pages are read from disk on first access and changes to the tensors
+    do not modify the file.
+
+    Parameters:
+        path (`str`):
+            The file to load.
+
+    Returns:
+        `Tuple[Dict[str, torch.Tensor], dict]`: The tensors and the metadata.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(PACKED_TENSORS_MAGIC)) != PACKED_TENSORS_MAGIC:
+            raise ValueError(f"{path} is not a file written by save_packed_tensors.")
+        header_length = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_length).decode("utf-8"))
+    data_start = _align(len(PACKED_TENSORS_MAGIC) + 8 + header_length)
+
+    data = None
+    tensors = {}
+    for name, info in header["tensors"].items():
+        dtype = getattr(torch, info["dtype"])
+        if info["nbytes"] == 0:
+            tensors[name] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        if data is None:
+            data = np.memmap(path, dtype=np.uint8, mode="c")
+        start = data_start + info["offset"]
+        buffer = torch.from_numpy(np.asarray(data[start:start + info["nbytes"]]))
+        tensors[name] = buffer.view(dtype).view(info["shape"])
+    return tensors, header["metadata"]
@@ -1,5 +1,6 @@
 #include <common.h>
 #include <float.h>
+#include <algorithm>
 
 void *quantize_block(void *arguments) {
     // 1. find absmax in block
@@ -21,7 +22,11 @@ void *quantize_block(void *arguments) {
         // 2. divide input value by absmax to normalize into [-1.0, 1.0]
         // 3. do binary search to find the closest value
         float normed_value = args->A[i] / absmax_block;
-        long long idx = args->bin_searcher->scalar(normed_value);
+        long long idx;
+        if (args->bin_searcher != NULL)
+            idx = args->bin_searcher->scalar(normed_value);
+        else
+            idx = std::max((long long) (std::upper_bound(args->code, args->code + 256, normed_value) - args->code) - 1, 0LL);
 
         // 4. check minimal distance
         // The binary search returns always the value to the left, which might not be the closest value
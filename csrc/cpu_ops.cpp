@@ -1,73 +1,1258 @@
 #include <BinSearch.h>
 #include <pthread.h>
 #include <common.h>
+#include <cpu_ops.h>
+#include <string.h>
+#include <math.h>
 
 using namespace BinSearch;
 
-void dequantize_cpu(float *code, unsigned char *A, float *absmax, float *out, long long blocksize, long long n) {
-    for (long long block_idx = 0; block_idx < n; block_idx += blocksize) {
-        long long valid_items = n - block_idx >= blocksize ? blocksize : n - block_idx;
-        long long block_end = block_idx + valid_items;
-        for (long long i = block_idx; i < block_end; i++)
-            out[i] = code[A[i]] * absmax[block_idx / blocksize];
+//==============================================================================
+//                              CPU THREAD POOL
+//==============================================================================
+
+// A persistent pool of worker threads. A job is a range of items which is split
+// into chunks of chunk_size items. Workers and the calling thread grab chunks
+// until the range is exhausted. Threads are only created (or destroyed) if the
+// requested number of threads changes, a job itself allocates nothing.
+struct cpu_thread_pool
+{
+    pthread_t *threads;
+    int num_workers;
+    unsigned long long base_generation;
+
+    // the current job
+    cpu_task_func func;
+    void *ctx;
+    long long num_items;
+    long long chunk_size;
+    long long next_item;
+    unsigned long long generation;
+    int busy_workers;
+    bool shutdown;
+};
+
+static cpu_thread_pool pool = {NULL, 0, 0, NULL, NULL, 0, 1, 0, 0, 0, false};
+static pthread_mutex_t pool_mutex = PTHREAD_MUTEX_INITIALIZER;
+static pthread_cond_t work_available = PTHREAD_COND_INITIALIZER;
+static pthread_cond_t work_done = PTHREAD_COND_INITIALIZER;
+// serializes jobs and pool resizes if multiple threads call into the library
+static pthread_mutex_t dispatch_mutex = PTHREAD_MUTEX_INITIALIZER;
+static int requested_threads = 1;
+static bool atfork_registered = false;
+
+static void run_chunks()
+{
+    while(true)
+    {
+        long long start = __atomic_fetch_add(&pool.next_item, pool.chunk_size, __ATOMIC_RELAXED);
+        if(start >= pool.num_items){ break; }
+        long long end = pool.num_items - start > pool.chunk_size ? start + pool.chunk_size : pool.num_items;
+        pool.func(pool.ctx, start, end);
     }
 }
 
-void quantize_cpu(float *code, float *A, float *absmax, unsigned char *out, long long blocksize, long long n)
+static void *worker_loop(void *arguments)
+{
+    pthread_mutex_lock(&pool_mutex);
+    unsigned long long seen_generation = pool.base_generation;
+    while(true)
+    {
+        while(!pool.shutdown && pool.generation == seen_generation)
+            pthread_cond_wait(&work_available, &pool_mutex);
+        if(pool.shutdown){ break; }
+
+        seen_generation = pool.generation;
+        pthread_mutex_unlock(&pool_mutex);
+
+        run_chunks();
+
+        pthread_mutex_lock(&pool_mutex);
+        pool.busy_workers -= 1;
+        if(pool.busy_workers == 0)
+            pthread_cond_signal(&work_done);
+    }
+    pthread_mutex_unlock(&pool_mutex);
+
+    return NULL;
+}
+
+static void reset_pool_after_fork()
+{
+    // only the forking thread survives in the child, forget about the workers
+    pool.threads = NULL;
+    pool.num_workers = 0;
+    pool.busy_workers = 0;
+    pool.shutdown = false;
+    pthread_mutex_init(&pool_mutex, NULL);
+    pthread_mutex_init(&dispatch_mutex, NULL);
+    pthread_cond_init(&work_available, NULL);
+    pthread_cond_init(&work_done, NULL);
+}
+
+static void resize_pool(int num_workers)
+{
+    if(num_workers == pool.num_workers){ return; }
+
+    if(!atfork_registered)
+    {
+        pthread_atfork(NULL, NULL, &reset_pool_after_fork);
+        atfork_registered = true;
+    }
+
+    if(pool.num_workers > 0)
+    {
+        pthread_mutex_lock(&pool_mutex);
+        pool.shutdown = true;
+        pthread_cond_broadcast(&work_available);
+        pthread_mutex_unlock(&pool_mutex);
+
+        for(int i = 0; i < pool.num_workers; i++)
+            pthread_join(pool.threads[i], NULL);
+        free(pool.threads);
+        pool.threads = NULL;
+        pool.num_workers = 0;
+        pool.shutdown = false;
+    }
+
+    pool.base_generation = pool.generation;
+    pool.threads = (pthread_t *) malloc(sizeof(pthread_t) * num_workers);
+    for(int i = 0; i < num_workers; i++)
+    {
+        if(pthread_create(&pool.threads[i], NULL, &worker_loop, NULL) != 0){ break; }
+        pool.num_workers += 1;
+    }
+}
+
+void set_num_threads_cpu(int num_threads)
+{
+    __atomic_store_n(&requested_threads, num_threads > 0 ? num_threads : 1, __ATOMIC_RELAXED);
+}
+
+void parallel_for_cpu(long long num_items, long long chunk_size, cpu_task_func func, void *ctx)
+{
+    if(num_items <= 0){ return; }
+    if(chunk_size < 1){ chunk_size = 1; }
+
+    int num_threads = __atomic_load_n(&requested_threads, __ATOMIC_RELAXED);
+    if(num_threads <= 1 || num_items <= chunk_size)
+    {
+        func(ctx, 0, num_items);
+        return;
+    }
+
+    pthread_mutex_lock(&dispatch_mutex);
+    resize_pool(num_threads - 1);
+    if(pool.num_workers == 0)
+    {
+        // could not create any worker
+        pthread_mutex_unlock(&dispatch_mutex);
+        func(ctx, 0, num_items);
+        return;
+    }
+
+    pthread_mutex_lock(&pool_mutex);
+    pool.func = func;
+    pool.ctx = ctx;
+    pool.num_items = num_items;
+    pool.chunk_size = chunk_size;
+    pool.next_item = 0;
+    pool.busy_workers = pool.num_workers;
+    pool.generation += 1;
+    pthread_cond_broadcast(&work_available);
+    pthread_mutex_unlock(&pool_mutex);
+
+    // the calling thread works on the job too
+    run_chunks();
+
+    pthread_mutex_lock(&pool_mutex);
+    while(pool.busy_workers > 0)
+        pthread_cond_wait(&work_done, &pool_mutex);
+    pthread_mutex_unlock(&pool_mutex);
+    pthread_mutex_unlock(&dispatch_mutex);
+}
+
+// number of blocks per chunk such that a chunk holds at least CPU_CHUNK_ITEMS values
+static long long blocks_per_chunk(long long blocksize)
+{
+    long long blocks = CPU_CHUNK_ITEMS / blocksize;
+    return blocks > 0 ? blocks : 1;
+}
+
+//==============================================================================
+//                           BLOCKWISE QUANTIZATION
+//==============================================================================
+
+struct quantize_task_args
+{
+    BinAlgo<Scalar, float, Direct2> *bin_searcher;
+    float *code;
+    float *A;
+    float *absmax;
+    unsigned char *out;
+    long long blocksize;
+    long long n;
+};
+
+static void quantize_blocks(void *ctx, long long block_start, long long block_end)
+{
+    struct quantize_task_args *task = (quantize_task_args *) ctx;
+    struct quantize_block_args arg;
+    arg.bin_searcher = task->bin_searcher;
+    arg.code = task->code;
+    arg.A = task->A;
+    arg.absmax = task->absmax;
+    arg.out = task->out;
+    arg.blocksize = task->blocksize;
+
+    for(long long block = block_start; block < block_end; block++)
+    {
+        arg.block_idx = block*task->blocksize;
+        arg.block_end = task->n - arg.block_idx >= task->blocksize ? arg.block_idx + task->blocksize : task->n;
+        arg.threadidx = block;
+        quantize_block(&arg);
+    }
+}
+
+// float to 16-bit float conversions with round-to-nearest-even, the same rounding
+// that PyTorch and the CUDA kernels use when storing a float into a half/bfloat16
+static inline unsigned short float_to_half(float value)
+{
+    unsigned int x;
+    memcpy(&x, &value, sizeof(x));
+    unsigned short sign = (x >> 16) & 0x8000;
+    unsigned int abs_x = x & 0x7FFFFFFF;
+
+    // inf and nan
+    if(abs_x >= 0x7F800000){ return sign | 0x7C00 | (abs_x > 0x7F800000 ? 0x0200 : 0); }
+    // rounds to a value larger than 65504
+    if(abs_x >= 0x477FF000){ return sign | 0x7C00; }
+    // subnormal half values
+    if(abs_x < 0x38800000)
+    {
+        // everything up to half of the smallest subnormal (2^-25) rounds to zero
+        if(abs_x <= 0x33000000){ return sign; }
+        unsigned int mantissa = (abs_x & 0x007FFFFF) | 0x00800000;
+        int shift = 126 - (int)(abs_x >> 23);
+        unsigned int result = mantissa >> shift;
+        unsigned int remainder = mantissa & ((1u << shift) - 1);
+        unsigned int halfway = 1u << (shift - 1);
+        if(remainder > halfway || (remainder == halfway && (result & 1))){ result += 1; }
+        return sign | result;
+    }
+
+    // normal values: rebias the exponent from 127 to 15 and round the mantissa to 10 bits
+    unsigned int result = (abs_x >> 13) - (112 << 10);
+    unsigned int remainder = abs_x & 0x1FFF;
+    if(remainder > 0x1000 || (remainder == 0x1000 && (result & 1))){ result += 1; }
+    return sign | result;
+}
+
+static inline unsigned short float_to_bfloat16(float value)
 {
+    unsigned int x;
+    memcpy(&x, &value, sizeof(x));
+    // quiet nan
+    if((x & 0x7FFFFFFF) > 0x7F800000){ return (x >> 16) | 0x0040; }
+    return (x + 0x7FFF + ((x >> 16) & 1)) >> 16;
+}
+
+static inline float float_to_float(float value){ return value; }
+
+static inline float half_to_float(unsigned short value)
+{
+    unsigned int sign = ((unsigned int) value & 0x8000) << 16;
+    unsigned int exponent = (value >> 10) & 0x1F;
+    unsigned int mantissa = value & 0x3FF;
+    unsigned int x;
+
+    if(exponent == 0x1F){ x = sign | 0x7F800000 | (mantissa << 13); }
+    else if(exponent != 0){ x = sign | ((exponent + 112) << 23) | (mantissa << 13); }
+    else if(mantissa == 0){ x = sign; }
+    else
+    {
+        // subnormal half values are normal floats, normalize the mantissa
+        int shift = 0;
+        while((mantissa & 0x400) == 0){ mantissa <<= 1; shift++; }
+        x = sign | ((unsigned int)(113 - shift) << 23) | ((mantissa & 0x3FF) << 13);
+    }
+
+    float result;
+    memcpy(&result, &x, sizeof(result));
+    return result;
+}
 
-    // the default code is has range [-0.993, 1.0] which can cause an error in the binary search algorithm used below
-    code[0] = -1.0f;
+static inline float bfloat16_to_float(unsigned short value)
+{
+    unsigned int x = ((unsigned int) value) << 16;
+    float result;
+    memcpy(&result, &x, sizeof(result));
+    return result;
+}
+
+struct dequantize_task_args
+{
+    float *code;
+    unsigned char *A;
+    float *absmax;
+    void *out;
+    long long blocksize;
+    long long n;
+};
+
+template <typename T, T (*CONVERT)(float)> static void dequantize_blocks(void *ctx, long long block_start, long long block_end)
+{
+    struct dequantize_task_args *task = (dequantize_task_args *) ctx;
+    T *out = (T *) task->out;
+    for(long long block = block_start; block < block_end; block++)
+    {
+        long long block_idx = block*task->blocksize;
+        long long block_end_idx = task->n - block_idx >= task->blocksize ? block_idx + task->blocksize : task->n;
+        float local_absmax = task->absmax[block];
+        for (long long i = block_idx; i < block_end_idx; i++)
+            out[i] = CONVERT(task->code[task->A[i]] * local_absmax);
+    }
+}
 
+template <typename T, T (*CONVERT)(float)> static void dequantize_cpu_impl(float *code, unsigned char *A, float *absmax, T *out, long long blocksize, long long n)
+{
     long long num_blocks = n / blocksize;
     num_blocks += n % blocksize == 0 ? 0 : 1;
 
+    struct dequantize_task_args task = {code, A, absmax, (void *) out, blocksize, n};
+    parallel_for_cpu(num_blocks, blocks_per_chunk(blocksize), &dequantize_blocks<T, CONVERT>, &task);
+}
+
+void dequantize_cpu(float *code, unsigned char *A, float *absmax, float *out, long long blocksize, long long n)
+{ dequantize_cpu_impl<float, float_to_float>(code, A, absmax, out, blocksize, n); }
+
+void dequantize_cpu_fp16(float *code, unsigned char *A, float *absmax, unsigned short *out, long long blocksize, long long n)
+{ dequantize_cpu_impl<unsigned short, float_to_half>(code, A, absmax, out, blocksize, n); }
+
+void dequantize_cpu_bf16(float *code, unsigned char *A, float *absmax, unsigned short *out, long long blocksize, long long n)
+{ dequantize_cpu_impl<unsigned short, float_to_bfloat16>(code, A, absmax, out, blocksize, n); }
+
+void quantize_cpu(float *code, float *A, float *absmax, unsigned char *out, long long blocksize, long long n)
+{
+
+    // the code can be shared between tensors, so it is not modified in place
     const uint32 elements_code = 256;
-    BinAlgo<Scalar, float, Direct2> bin_searcher(code, elements_code);
+    float search_code[elements_code];
+    memcpy(search_code, code, sizeof(search_code));
+
+    long long num_blocks = n / blocksize;
+    num_blocks += n % blocksize == 0 ? 0 : 1;
+
+    struct quantize_task_args task = {NULL, search_code, A, absmax, out, blocksize, n};
+    if(search_code[0] < 0.0f)
+    {
+        // the default code is has range [-0.993, 1.0] which can cause an error in the binary search algorithm used below
+        search_code[0] = -1.0f;
+        BinAlgo<Scalar, float, Direct2> bin_searcher(search_code, elements_code);
+        task.bin_searcher = &bin_searcher;
+        parallel_for_cpu(num_blocks, blocks_per_chunk(blocksize), &quantize_blocks, &task);
+    }
+    else
+    {
+        // with -1 in front, the tiny gaps of unsigned codes near 0 are below float precision for
+        // the direct search, so these use a plain binary search
+        parallel_for_cpu(num_blocks, blocks_per_chunk(blocksize), &quantize_blocks, &task);
+    }
+}
+
+//==============================================================================
+//                         8-BIT BLOCKWISE OPTIMIZERS
+//==============================================================================
+
+// CPU port of kOptimizerStatic8bit2StateBlockwise and kOptimizerStatic8bit1StateBlockwise.
+// Each block of OPTIMIZER_BLOCKSIZE_CPU values is dequantized, updated and requantized
+// with a fresh absmax in one pass while it is hot in the cache.
+
+#define OPTIMIZER_BLOCKSIZE_CPU 2048
+
+typedef enum CpuOptimizer_t
+{
+    CPU_ADAM = 0,
+    CPU_MOMENTUM = 1,
+    CPU_RMSPROP = 2,
+    CPU_ADAGRAD = 4,
+    CPU_LION = 5,
+} CpuOptimizer_t;
+
+struct optimizer_8bit_task_args
+{
+    void *p;
+    void *g;
+    unsigned char *state1;
+    unsigned char *state2;
+    float beta1;
+    float beta2;
+    float eps;
+    int step;
+    float lr;
+    float *quantiles1;
+    float *quantiles2;
+    float *absmax1;
+    float *absmax2;
+    float weight_decay;
+    float gnorm_scale;
+    bool skip_zeros;
+    long long n;
+};
+
+// same binary search with midpoint rounding as quantize_2D in kernels.cu
+template <int SIGNED> static inline unsigned char quantize_2D_cpu(const float *code, float x)
+{
+    int pivot = 127;
+    int upper_pivot = 255;
+    int lower_pivot = 0;
+
+    float lower = SIGNED ? -1.0f : 0.0f;
+    float upper = 1.0f;
+    float val = code[pivot];
+
+    for(int i = 64; i > 0; i>>=1)
+    {
+        if(x > val)
+        {
+            lower_pivot = pivot;
+            lower = val;
+            pivot += i;
+        }
+        else
+        {
+            upper_pivot = pivot;
+            upper = val;
+            pivot -= i;
+        }
+        val = code[pivot];
+    }
+
+    if(x > val)
+        return x > (upper+val)*0.5f ? upper_pivot : pivot;
+    else
+        return x < (lower+val)*0.5f ? lower_pivot : pivot;
+}
+
+// requantizes state1 and makes sure the quantized value keeps the sign of the update
+static inline unsigned char quantize_signed_state(const float *code, float value, float absmax)
+{
+    unsigned char c = quantize_2D_cpu<1>(code, value/absmax);
+    if(signbit(code[c]) != signbit(value))
+    {
+        if(value > 0.0f)
+            c += 1;
+        else
+            c -= 1;
+    }
+    return c;
+}
+
+template <typename T, float (*LOAD)(T), T (*STORE)(float)> static void optimizer_2state_blocks(void *ctx, long long block_start, long long block_end)
+{
+    struct optimizer_8bit_task_args *task = (optimizer_8bit_task_args *) ctx;
+    T *p = (T *) task->p;
+    T *g = (T *) task->g;
+    const float beta1 = task->beta1;
+    const float beta2 = task->beta2;
+    const float correction1 = 1.0f - powf(beta1, task->step);
+    const float correction2 = sqrtf(1.0f - powf(beta2, task->step));
+    const float step_size = -task->lr*correction2/correction1;
+    const float decay = 1.0f - (task->lr*task->weight_decay);
+
+    float s1_vals[OPTIMIZER_BLOCKSIZE_CPU];
+    float s2_vals[OPTIMIZER_BLOCKSIZE_CPU];
+
+    for(long long block = block_start; block < block_end; block++)
+    {
+        long long block_idx = block*OPTIMIZER_BLOCKSIZE_CPU;
+        long long valid_items = task->n - block_idx >= OPTIMIZER_BLOCKSIZE_CPU ? OPTIMIZER_BLOCKSIZE_CPU : task->n - block_idx;
+        float absmax1 = task->absmax1[block];
+        float absmax2 = task->absmax2[block];
+        float new_absmax1 = 0.0f;
+        float new_absmax2 = 0.0f;
+
+        for(long long j = 0; j < valid_items; j++)
+        {
+            long long i = block_idx + j;
+            float g_val = LOAD(g[i]);
+            if(!isnan(g_val) && !isinf(g_val))
+            {
+                g_val *= task->gnorm_scale;
+                s2_vals[j] = task->quantiles2[task->state2[i]]*absmax2;
+                s2_vals[j] = (s2_vals[j]*beta2) + ((1.0f-beta2)*g_val*g_val);
+                s1_vals[j] = task->quantiles1[task->state1[i]]*absmax1;
+                s1_vals[j] = (s1_vals[j]*beta1) + ((1.0f-beta1)*g_val);
+
+                // the parameter update uses the unquantized states
+                float p_val = LOAD(p[i]) + (step_size*(s1_vals[j]/(sqrtf(s2_vals[j])+(correction2*task->eps))));
+                if(task->weight_decay > 0.0f)
+                    p_val = p_val*decay;
+                p[i] = STORE(p_val);
+            }
+            else
+            {
+                s1_vals[j] = 0.0f;
+                s2_vals[j] = 0.0f;
+            }
+            new_absmax1 = fmaxf(new_absmax1, fabsf(s1_vals[j]));
+            new_absmax2 = fmaxf(new_absmax2, fabsf(s2_vals[j]));
+        }
+
+        task->absmax1[block] = new_absmax1;
+        task->absmax2[block] = new_absmax2;
+        for(long long j = 0; j < valid_items; j++)
+        {
+            long long i = block_idx + j;
+            task->state1[i] = quantize_signed_state(task->quantiles1, s1_vals[j], new_absmax1);
+            task->state2[i] = quantize_2D_cpu<0>(task->quantiles2, s2_vals[j]/new_absmax2);
+        }
+    }
+}
+
+template <typename T, float (*LOAD)(T), T (*STORE)(float), int OPTIMIZER> static void optimizer_1state_blocks(void *ctx, long long block_start, long long block_end)
+{
+    struct optimizer_8bit_task_args *task = (optimizer_8bit_task_args *) ctx;
+    T *p = (T *) task->p;
+    T *g = (T *) task->g;
+    const float beta1 = task->beta1;
+    const float beta2 = task->beta2;
+    const float lr = task->lr;
+    const float weight_decay = task->weight_decay;
+
+    float s1_vals[OPTIMIZER_BLOCKSIZE_CPU];
+
+    for(long long block = block_start; block < block_end; block++)
+    {
+        long long block_idx = block*OPTIMIZER_BLOCKSIZE_CPU;
+        long long valid_items = task->n - block_idx >= OPTIMIZER_BLOCKSIZE_CPU ? OPTIMIZER_BLOCKSIZE_CPU : task->n - block_idx;
+        float absmax1 = task->absmax1[block];
+        float new_absmax1 = 0.0f;
+
+        for(long long j = 0; j < valid_items; j++)
+        {
+            long long i = block_idx + j;
+            // skipped values keep their state, it is only requantized with the new absmax
+            s1_vals[j] = task->quantiles1[task->state1[i]]*absmax1;
+
+            float g_raw = LOAD(g[i]);
+            if(!task->skip_zeros || g_raw != 0.0f)
+            {
+                float g_val = g_raw*task->gnorm_scale;
+                float p_val = LOAD(p[i]);
+                if(weight_decay > 0.0f)
+                {
+                    if(OPTIMIZER == CPU_LION)
+                        p_val = p_val*(1.0f-lr*weight_decay);
+                    else
+                        g_val += p_val*weight_decay;
+                }
+
+                switch(OPTIMIZER)
+                {
+                    case CPU_MOMENTUM:
+                        s1_vals[j] = task->step == 1 ? g_val : (s1_vals[j]*beta1) + g_val;
+                        p_val = p_val - lr*s1_vals[j];
+                        break;
+                    case CPU_LION:
+                    {
+                        float update = s1_vals[j]*beta1 + ((1.0f-beta1)*g_val);
+                        s1_vals[j] = s1_vals[j]*beta2 + ((1.0f-beta2)*g_val);
+                        p_val = p_val - lr*(float)((0.0f < update) - (update < 0.0f));
+                        break;
+                    }
+                    case CPU_RMSPROP:
+                        s1_vals[j] = s1_vals[j]*beta1 + ((1.0f-beta1)*(g_val*g_val));
+                        // like the CUDA kernel, the step uses the unscaled gradient
+                        p_val = p_val - lr*(g_raw/(sqrtf(s1_vals[j])+task->eps));
+                        break;
+                    case CPU_ADAGRAD:
+                        s1_vals[j] = s1_vals[j] + (g_val*g_val);
+                        p_val = p_val - lr*(g_raw/(sqrtf(s1_vals[j])+task->eps));
+                        break;
+                }
+                p[i] = STORE(p_val);
+            }
+            new_absmax1 = fmaxf(new_absmax1, fabsf(s1_vals[j]));
+        }
+
+        task->absmax1[block] = new_absmax1;
+        for(long long j = 0; j < valid_items; j++)
+            task->state1[block_idx + j] = quantize_signed_state(task->quantiles1, s1_vals[j], new_absmax1);
+    }
+}
+
+// a range of items (values or blocks) of one tensor of a multi-tensor update
+struct tensor_chunk
+{
+    int tensor;
+    long long start;
+    long long end;
+};
+
+// splits num_tensors tensors with n[t] items into chunks of at most chunk_size items, returns the number of chunks
+static long long make_tensor_chunks(int num_tensors, long long *n, long long chunk_size, tensor_chunk **chunks)
+{
+    long long num_chunks = 0;
+    for(int t = 0; t < num_tensors; t++)
+        num_chunks += (n[t] + chunk_size - 1)/chunk_size;
+
+    *chunks = (tensor_chunk *) malloc(sizeof(tensor_chunk)*(num_chunks > 0 ? num_chunks : 1));
+    long long c = 0;
+    for(int t = 0; t < num_tensors; t++)
+    {
+        for(long long start = 0; start < n[t]; start += chunk_size)
+        {
+            (*chunks)[c].tensor = t;
+            (*chunks)[c].start = start;
+            (*chunks)[c].end = n[t] - start > chunk_size ? start + chunk_size : n[t];
+            c++;
+        }
+    }
+    return num_chunks;
+}
+
+struct optimizer_8bit_multi_task_args
+{
+    optimizer_8bit_task_args *tensors;
+    tensor_chunk *chunks;
+};
+
+template <typename T, float (*LOAD)(T), T (*STORE)(float), int OPTIMIZER> static void optimizer_8bit_multi_chunks(void *ctx, long long chunk_start, long long chunk_end)
+{
+    struct optimizer_8bit_multi_task_args *task = (optimizer_8bit_multi_task_args *) ctx;
+    for(long long c = chunk_start; c < chunk_end; c++)
+    {
+        tensor_chunk chunk = task->chunks[c];
+        if(OPTIMIZER == CPU_ADAM)
+            optimizer_2state_blocks<T, LOAD, STORE>(&task->tensors[chunk.tensor], chunk.start, chunk.end);
+        else
+            optimizer_1state_blocks<T, LOAD, STORE, OPTIMIZER>(&task->tensors[chunk.tensor], chunk.start, chunk.end);
+    }
+}
+
+// the blocks of all tensors are processed by a single parallel loop, so many small tensors still use all threads
+template <typename T, float (*LOAD)(T), T (*STORE)(float), int OPTIMIZER> static void optimizer_8bit_blockwise_multi_cpu(int num_tensors, T** p, T** g,
+                unsigned char** state1, unsigned char** state2, float beta1, float beta2, float eps, int* step, float lr,
+                float** quantiles1, float** quantiles2, float** absmax1, float** absmax2, float weight_decay, float* gnorm_scale, bool skip_zeros, long long* n)
+{
+    optimizer_8bit_task_args *tensors = (optimizer_8bit_task_args *) malloc(sizeof(optimizer_8bit_task_args)*(num_tensors > 0 ? num_tensors : 1));
+    long long *num_blocks = (long long *) malloc(sizeof(long long)*(num_tensors > 0 ? num_tensors : 1));
+    for(int t = 0; t < num_tensors; t++)
+    {
+        optimizer_8bit_task_args tensor = {(void *) p[t], (void *) g[t], state1[t], state2 == NULL ? NULL : state2[t], beta1, beta2, eps, step[t], lr,
+                                           quantiles1[t], quantiles2 == NULL ? NULL : quantiles2[t], absmax1[t], absmax2 == NULL ? NULL : absmax2[t],
+                                           weight_decay, gnorm_scale[t], skip_zeros, n[t]};
+        tensors[t] = tensor;
+        num_blocks[t] = n[t] / OPTIMIZER_BLOCKSIZE_CPU;
+        num_blocks[t] += n[t] % OPTIMIZER_BLOCKSIZE_CPU == 0 ? 0 : 1;
+    }
+
+    tensor_chunk *chunks;
+    long long num_chunks = make_tensor_chunks(num_tensors, num_blocks, blocks_per_chunk(OPTIMIZER_BLOCKSIZE_CPU), &chunks);
+    struct optimizer_8bit_multi_task_args task = {tensors, chunks};
+    parallel_for_cpu(num_chunks, 1, &optimizer_8bit_multi_chunks<T, LOAD, STORE, OPTIMIZER>, &task);
+
+    free(chunks);
+    free(num_blocks);
+    free(tensors);
+}
+
+template <typename T, float (*LOAD)(T), T (*STORE)(float), int OPTIMIZER> static void optimizer_8bit_blockwise_cpu(T* p, T* g,
+                unsigned char* state1, unsigned char* state2, float beta1, float beta2, float eps, int step, float lr,
+                float* quantiles1, float* quantiles2, float* absmax1, float* absmax2, float weight_decay, float gnorm_scale, bool skip_zeros, long long n)
+{
+    optimizer_8bit_blockwise_multi_cpu<T, LOAD, STORE, OPTIMIZER>(1, &p, &g, &state1, &state2, beta1, beta2, eps, &step, lr,
+                                                                 &quantiles1, &quantiles2, &absmax1, &absmax2, weight_decay, &gnorm_scale, skip_zeros, &n);
+}
+
+#define MAKE_BLOCKWISE8_CPU(fname, optim_name, gtype, gbits, load, store) \
+void fname##_8bit_blockwise_grad_##gbits##_cpu(gtype* p, gtype* g, \
+                unsigned char* state1, unsigned char* state2, float beta1, float beta2, float eps, int step, float lr, \
+                float* quantiles1, float* quantiles2, float* absmax1, float* absmax2, float weight_decay, const float gnorm_scale, bool skip_zeros, long long n) \
+{ \
+    optimizer_8bit_blockwise_cpu<gtype, load, store, optim_name>(p, g, state1, state2, beta1, beta2, eps, step, lr, quantiles1, quantiles2, absmax1, absmax2, weight_decay, gnorm_scale, skip_zeros, n); \
+} \
+void fname##_8bit_blockwise_grad_multi_##gbits##_cpu(int num_tensors, gtype** p, gtype** g, \
+                unsigned char** state1, unsigned char** state2, float beta1, float beta2, float eps, int* step, float lr, \
+                float** quantiles1, float** quantiles2, float** absmax1, float** absmax2, float weight_decay, float* gnorm_scale, bool skip_zeros, long long* n) \
+{ \
+    optimizer_8bit_blockwise_multi_cpu<gtype, load, store, optim_name>(num_tensors, p, g, state1, state2, beta1, beta2, eps, step, lr, quantiles1, quantiles2, absmax1, absmax2, weight_decay, gnorm_scale, skip_zeros, n); \
+} \
+
+MAKE_BLOCKWISE8_CPU(adam, CPU_ADAM, float, fp32, float_to_float, float_to_float)
+MAKE_BLOCKWISE8_CPU(adam, CPU_ADAM, unsigned short, fp16, half_to_float, float_to_half)
+MAKE_BLOCKWISE8_CPU(adam, CPU_ADAM, unsigned short, bf16, bfloat16_to_float, float_to_bfloat16)
+MAKE_BLOCKWISE8_CPU(momentum, CPU_MOMENTUM, float, fp32, float_to_float, float_to_float)
+MAKE_BLOCKWISE8_CPU(momentum, CPU_MOMENTUM, unsigned short, fp16, half_to_float, float_to_half)
+MAKE_BLOCKWISE8_CPU(momentum, CPU_MOMENTUM, unsigned short, bf16, bfloat16_to_float, float_to_bfloat16)
+MAKE_BLOCKWISE8_CPU(rmsprop, CPU_RMSPROP, float, fp32, float_to_float, float_to_float)
+MAKE_BLOCKWISE8_CPU(rmsprop, CPU_RMSPROP, unsigned short, fp16, half_to_float, float_to_half)
+MAKE_BLOCKWISE8_CPU(rmsprop, CPU_RMSPROP, unsigned short, bf16, bfloat16_to_float, float_to_bfloat16)
+MAKE_BLOCKWISE8_CPU(adagrad, CPU_ADAGRAD, float, fp32, float_to_float, float_to_float)
+MAKE_BLOCKWISE8_CPU(adagrad, CPU_ADAGRAD, unsigned short, fp16, half_to_float, float_to_half)
+MAKE_BLOCKWISE8_CPU(adagrad, CPU_ADAGRAD, unsigned short, bf16, bfloat16_to_float, float_to_bfloat16)
+MAKE_BLOCKWISE8_CPU(lion, CPU_LION, float, fp32, float_to_float, float_to_float)
+MAKE_BLOCKWISE8_CPU(lion, CPU_LION, unsigned short, fp16, half_to_float, float_to_half)
+MAKE_BLOCKWISE8_CPU(lion, CPU_LION, unsigned short, bf16, bfloat16_to_float, float_to_bfloat16)
+
+//==============================================================================
+//                      32-BIT MULTI-TENSOR OPTIMIZERS
+//==============================================================================
+
+// CPU port of kOptimizer32bit2State/kOptimizer32bit1State (and their max_unorm
+// preconditioning kernels) which updates all tensors of a parameter group in one
+// call. The work is split into chunks which never cross a tensor boundary, norms
+// are reduced per chunk and summed in chunk order so that the result does not
+// depend on the number of threads.
+
+struct optimizer_32bit_task_args
+{
+    tensor_chunk *chunks;
+    void **p;
+    void **g;
+    float **state1;
+    float **state2;
+    int *step;
+    float *gnorm_scale;
+    float *update_scale;
+    float beta1;
+    float beta2;
+    float eps;
+    float weight_decay;
+    float lr;
+    bool skip_zeros;
+    // per chunk partial sums of the squared parameters and the update norm
+    float *param_norms;
+    float *unorms;
+};
+
+// sum of squares of the parameters and, before the update, the squared update norm
+template <typename T, float (*LOAD)(T), int OPTIMIZER, bool UNORM> static void optimizer_32bit_norm_chunks(void *ctx, long long chunk_start, long long chunk_end)
+{
+    struct optimizer_32bit_task_args *task = (optimizer_32bit_task_args *) ctx;
+    for(long long c = chunk_start; c < chunk_end; c++)
+    {
+        tensor_chunk chunk = task->chunks[c];
+        T *p = (T *) task->p[chunk.tensor];
+        T *g = (T *) task->g[chunk.tensor];
+        float *state1 = task->state1[chunk.tensor];
+        float *state2 = OPTIMIZER == CPU_ADAM ? task->state2[chunk.tensor] : NULL;
+        const int step = task->step[chunk.tensor];
+        const float gnorm_scale = task->gnorm_scale[chunk.tensor];
+        const float beta1 = task->beta1;
+        const float beta2 = task->beta2;
+        const float correction1 = 1.0f/(1.0f - powf(beta1, step));
+        const float correction2 = 1.0f/(1.0f - powf(beta2, step));
+
+        float param_norm = 0.0f;
+        float unorm = 0.0f;
+        for(long long i = chunk.start; i < chunk.end; i++)
+        {
+            float p_val = LOAD(p[i]);
+            param_norm += p_val*p_val;
+            if(!UNORM){ continue; }
+
+            float g_val = gnorm_scale*LOAD(g[i]);
+            float s1 = state1[i];
+            switch(OPTIMIZER)
+            {
+                case CPU_ADAM:
+                {
+                    float s2 = state2[i]*beta2 + ((1.0f-beta2)*(g_val*g_val));
+                    s1 = s1*beta1 + ((1.0f-beta1)*g_val);
+                    s1 = (s1*correction1)/(sqrtf(s2*correction2)+task->eps);
+                    unorm += s1*s1;
+                    break;
+                }
+                case CPU_MOMENTUM:
+                    s1 = step == 1 ? g_val : s1*beta1 + g_val;
+                    unorm += s1*s1;
+                    break;
+                case CPU_LION:
+                    // like the CUDA kernel this sums the (updated) momentum
+                    unorm += s1*beta2 + ((1.0f-beta2)*g_val);
+                    break;
+                case CPU_RMSPROP:
+                    s1 = s1*beta1 + ((1.0f-beta1)*g_val*g_val);
+                    s1 = g_val/(sqrtf(s1)+task->eps);
+                    unorm += s1*s1;
+                    break;
+                case CPU_ADAGRAD:
+                    s1 = s1 + g_val*g_val;
+                    s1 = g_val/(sqrtf(s1)+task->eps);
+                    unorm += s1*s1;
+                    break;
+            }
+        }
+        task->param_norms[c] = param_norm;
+        task->unorms[c] = unorm;
+    }
+}
+
+template <typename T, float (*LOAD)(T), T (*STORE)(float), int OPTIMIZER> static void optimizer_32bit_update_chunks(void *ctx, long long chunk_start, long long chunk_end)
+{
+    struct optimizer_32bit_task_args *task = (optimizer_32bit_task_args *) ctx;
+    const float beta1 = task->beta1;
+    const float beta2 = task->beta2;
+    const float eps = task->eps;
+    const float lr = task->lr;
+    const float weight_decay = task->weight_decay;
+
+    for(long long c = chunk_start; c < chunk_end; c++)
+    {
+        tensor_chunk chunk = task->chunks[c];
+        T *p = (T *) task->p[chunk.tensor];
+        T *g = (T *) task->g[chunk.tensor];
+        float *state1 = task->state1[chunk.tensor];
+        float *state2 = OPTIMIZER == CPU_ADAM ? task->state2[chunk.tensor] : NULL;
+        const int step = task->step[chunk.tensor];
+        const float gnorm_scale = task->gnorm_scale[chunk.tensor];
+        const float update_scale = task->update_scale[chunk.tensor];
+        const float correction1 = 1.0f - powf(beta1, step);
+        const float correction2 = sqrtf(1.0f - powf(beta2, step));
+        const float step_size = -lr*correction2/correction1;
+
+        for(long long i = chunk.start; i < chunk.end; i++)
+        {
+            float g_val = gnorm_scale*LOAD(g[i]);
+            float p_val = LOAD(p[i]);
+            if(OPTIMIZER != CPU_ADAM && weight_decay > 0.0f)
+                g_val = g_val + p_val*weight_decay;
+            if(task->skip_zeros && g_val == 0.0f){ continue; }
+
+            float s1 = state1[i];
+            switch(OPTIMIZER)
+            {
+                case CPU_ADAM:
+                {
+                    s1 = s1*beta1 + ((1.0f-beta1)*g_val);
+                    float s2 = state2[i]*beta2 + ((1.0f-beta2)*(g_val*g_val));
+                    p_val = p_val + (update_scale*step_size*(s1/(sqrtf(s2)+(eps*correction2))));
+                    if(weight_decay > 0.0f)
+                        p_val = p_val*(1.0f-(lr*weight_decay));
+                    state2[i] = s2;
+                    break;
+                }
+                case CPU_MOMENTUM:
+                    s1 = step == 1 ? g_val : s1*beta1 + g_val;
+                    p_val = p_val + update_scale*(-lr*s1);
+                    break;
+                case CPU_LION:
+                {
+                    float update = s1*beta1 + ((1.0f-beta1)*g_val);
+                    p_val = p_val - update_scale*(lr*(float)((0.0f < update) - (update < 0.0f)));
+                    s1 = s1*beta2 + ((1.0f-beta2)*g_val);
+                    break;
+                }
+                case CPU_RMSPROP:
+                    s1 = s1*beta1 + ((1.0f-beta1)*g_val*g_val);
+                    p_val = p_val - update_scale*(lr*(g_val/(sqrtf(s1)+eps)));
+                    break;
+                case CPU_ADAGRAD:
+                    // the CUDA kernel does not scale the adagrad update either
+                    s1 = s1 + g_val*g_val;
+                    p_val = p_val - lr*(g_val/(sqrtf(s1)+eps));
+                    break;
+            }
+            state1[i] = s1;
+            p[i] = STORE(p_val);
+        }
+    }
+}
+
+template <typename T, float (*LOAD)(T), int OPTIMIZER, bool UNORM> static void optimizer_32bit_reduce_norms(optimizer_32bit_task_args *task, long long num_chunks, int num_tensors, float *param_norm, float **unorm)
+{
+    parallel_for_cpu(num_chunks, 1, &optimizer_32bit_norm_chunks<T, LOAD, OPTIMIZER, UNORM>, task);
+    for(int t = 0; t < num_tensors; t++)
+    {
+        param_norm[t] = 0.0f;
+        if(UNORM){ unorm[t][0] = 0.0f; }
+    }
+    for(long long c = 0; c < num_chunks; c++)
+    {
+        param_norm[task->chunks[c].tensor] += task->param_norms[c];
+        if(UNORM){ unorm[task->chunks[c].tensor][0] += task->unorms[c]; }
+    }
+}
+
+template <typename T, float (*LOAD)(T), T (*STORE)(float), int OPTIMIZER> static void optimizer_32bit_multi_cpu(int num_tensors, T** g, T** p,
+                float** state1, float** state2, float** unorm, long long* n, int* step, float* gnorm_scale, float max_unorm,
+                float beta1, float beta2, float eps, float weight_decay, float lr, bool skip_zeros)
+{
+    tensor_chunk *chunks;
+    long long num_chunks = make_tensor_chunks(num_tensors, n, CPU_CHUNK_ITEMS, &chunks);
+    if(num_chunks == 0)
+    {
+        free(chunks);
+        return;
+    }
 
-    int thread_wave_size = 256;
-    // we chunk the thresds into waves of 256 since the max limit is
-    // between 16k and 64k on Linux (we reach this when running BLOOM-176B with a large batch size)
-    for(long long offset = 0; offset < num_blocks; offset+=thread_wave_size)
+    float *partials = (float *) malloc(sizeof(float)*2*num_chunks);
+    float *tensor_stats = (float *) malloc(sizeof(float)*2*num_tensors);
+    float *param_norm = tensor_stats;
+    float *update_scale = tensor_stats + num_tensors;
+    for(int t = 0; t < num_tensors; t++)
+        update_scale[t] = 1.0f;
+
+    struct optimizer_32bit_task_args task = {chunks, (void **) p, (void **) g, state1, state2, step, gnorm_scale, update_scale,
+                                             beta1, beta2, eps, weight_decay, lr, skip_zeros, partials, partials + num_chunks};
+
+    if(max_unorm > 0.0f)
     {
-      long long valid_chunks = num_blocks - offset >= thread_wave_size ? thread_wave_size : num_blocks - offset;
-      pthread_t *threads = (pthread_t *) malloc(sizeof(pthread_t) * valid_chunks);
+        // lion computes the update norm of the next step after its update
+        if(OPTIMIZER == CPU_LION)
+            optimizer_32bit_reduce_norms<T, LOAD, OPTIMIZER, false>(&task, num_chunks, num_tensors, param_norm, unorm);
+        else
+            optimizer_32bit_reduce_norms<T, LOAD, OPTIMIZER, true>(&task, num_chunks, num_tensors, param_norm, unorm);
+
+        for(int t = 0; t < num_tensors; t++)
+        {
+            float norm = sqrtf(param_norm[t]);
+            float current_unorm = sqrtf(unorm[t][0]);
+            // the 1-state kernels add eps to the maximum update norm
+            float max_norm = OPTIMIZER == CPU_ADAM ? max_unorm*norm : max_unorm*norm + eps;
+            update_scale[t] = current_unorm > max_norm ? max_norm/current_unorm : 1.0f;
+        }
+    }
+
+    parallel_for_cpu(num_chunks, 1, &optimizer_32bit_update_chunks<T, LOAD, STORE, OPTIMIZER>, &task);
+
+    if(max_unorm > 0.0f && OPTIMIZER == CPU_LION)
+        optimizer_32bit_reduce_norms<T, LOAD, OPTIMIZER, true>(&task, num_chunks, num_tensors, param_norm, unorm);
+
+    free(tensor_stats);
+    free(partials);
+    free(chunks);
+}
+
+#define MAKE_32BIT_MULTI_CPU(fname, optim_name, gtype, gbits, load, store) \
+void fname##32bit_grad_multi_##gbits##_cpu(int num_tensors, gtype** g, gtype** p, \
+                float** state1, float** state2, float** unorm, long long* n, int* step, float* gnorm_scale, float max_unorm, \
+                float beta1, float beta2, float eps, float weight_decay, float lr, bool skip_zeros) \
+{ \
+    optimizer_32bit_multi_cpu<gtype, load, store, optim_name>(num_tensors, g, p, state1, state2, unorm, n, step, gnorm_scale, max_unorm, beta1, beta2, eps, weight_decay, lr, skip_zeros); \
+} \
 
-      struct quantize_block_args **args = (quantize_block_args **) malloc(valid_chunks * sizeof(quantize_block_args *));
+MAKE_32BIT_MULTI_CPU(adam, CPU_ADAM, float, fp32, float_to_float, float_to_float)
+MAKE_32BIT_MULTI_CPU(adam, CPU_ADAM, unsigned short, fp16, half_to_float, float_to_half)
+MAKE_32BIT_MULTI_CPU(adam, CPU_ADAM, unsigned short, bf16, bfloat16_to_float, float_to_bfloat16)
+MAKE_32BIT_MULTI_CPU(momentum, CPU_MOMENTUM, float, fp32, float_to_float, float_to_float)
+MAKE_32BIT_MULTI_CPU(momentum, CPU_MOMENTUM, unsigned short, fp16, half_to_float, float_to_half)
+MAKE_32BIT_MULTI_CPU(momentum, CPU_MOMENTUM, unsigned short, bf16, bfloat16_to_float, float_to_bfloat16)
+MAKE_32BIT_MULTI_CPU(rmsprop, CPU_RMSPROP, float, fp32, float_to_float, float_to_float)
+MAKE_32BIT_MULTI_CPU(rmsprop, CPU_RMSPROP, unsigned short, fp16, half_to_float, float_to_half)
+MAKE_32BIT_MULTI_CPU(rmsprop, CPU_RMSPROP, unsigned short, bf16, bfloat16_to_float, float_to_bfloat16)
+MAKE_32BIT_MULTI_CPU(adagrad, CPU_ADAGRAD, float, fp32, float_to_float, float_to_float)
+MAKE_32BIT_MULTI_CPU(adagrad, CPU_ADAGRAD, unsigned short, fp16, half_to_float, float_to_half)
+MAKE_32BIT_MULTI_CPU(adagrad, CPU_ADAGRAD, unsigned short, bf16, bfloat16_to_float, float_to_bfloat16)
+MAKE_32BIT_MULTI_CPU(lion, CPU_LION, float, fp32, float_to_float, float_to_float)
+MAKE_32BIT_MULTI_CPU(lion, CPU_LION, unsigned short, fp16, half_to_float, float_to_half)
+MAKE_32BIT_MULTI_CPU(lion, CPU_LION, unsigned short, bf16, bfloat16_to_float, float_to_bfloat16)
 
-      for(long long i = 0; i < valid_chunks; i++)
-          args[i] = (quantize_block_args *) malloc(sizeof(quantize_block_args));
+//==============================================================================
+//                                INT8 MATMUL
+//==============================================================================
+
+// rows of C per chunk and columns of C per panel: the panel of B, CPU_IGEMM_PANEL_COLS rows of k values,
+// stays in cache while all rows of a chunk use it
+#define CPU_IGEMM_CHUNK_ROWS 16
+#define CPU_IGEMM_PANEL_COLS 64
+// 1.0f/(127.0f*127.0f) as in kdequant_mm_int32_fp16
+#define CPU_MM_DEQUANT_CONST 6.200012e-05f
+
+struct igemm_task_args
+{
+    const signed char *A;
+    const signed char *B;
+    int *C;
+    long long m;
+    long long n;
+    long long k;
+    long long lda;
+    long long ldb;
+    long long ldc;
+    long long strideA;
+    long long strideB;
+    long long strideC;
+    long long row_chunks;
+};
+
+// four rows of A share each load of the row of B
+static inline void dot4_int8(const signed char *a0, const signed char *a1, const signed char *a2, const signed char *a3,
+                             const signed char *b, long long k, int *out)
+{
+    int acc0 = 0, acc1 = 0, acc2 = 0, acc3 = 0;
+    for(long long p = 0; p < k; p++)
+    {
+        int bp = b[p];
+        acc0 += a0[p]*bp;
+        acc1 += a1[p]*bp;
+        acc2 += a2[p]*bp;
+        acc3 += a3[p]*bp;
+    }
+    out[0] = acc0; out[1] = acc1; out[2] = acc2; out[3] = acc3;
+}
 
-      int chunks_processed = 0;
-      for(long long block_idx = offset*blocksize; block_idx < n; block_idx += blocksize)
-      {
-          long long valid_items = n - block_idx >= blocksize ? blocksize : n - block_idx;
-          long long block_end = block_idx + valid_items;
+static inline int dot_int8(const signed char *a, const signed char *b, long long k)
+{
+    int acc = 0;
+    for(long long p = 0; p < k; p++)
+        acc += a[p]*b[p];
+    return acc;
+}
 
-          struct quantize_block_args *arg = args[chunks_processed];
-          arg->bin_searcher = &bin_searcher;
-          arg->code = code;
-          arg->A = A;
-          arg->absmax = absmax;
-          arg->out = out;
-          arg->block_end = block_end;
-          arg->block_idx = block_idx;
-          arg->threadidx = block_idx / blocksize;
-          arg->blocksize = blocksize;
+static void igemm_chunks(void *ctx, long long chunk_start, long long chunk_end)
+{
+    igemm_task_args *task = (igemm_task_args *) ctx;
+    int out[4];
+    for(long long chunk = chunk_start; chunk < chunk_end; chunk++)
+    {
+        long long batch = chunk / task->row_chunks;
+        long long row_start = (chunk % task->row_chunks)*CPU_IGEMM_CHUNK_ROWS;
+        long long row_end = row_start + CPU_IGEMM_CHUNK_ROWS < task->m ? row_start + CPU_IGEMM_CHUNK_ROWS : task->m;
+        const signed char *A = task->A + batch*task->strideA;
+        const signed char *B = task->B + batch*task->strideB;
+        int *C = task->C + batch*task->strideC;
 
-          pthread_create(&threads[chunks_processed], NULL, &quantize_block, (void *) arg);
-          chunks_processed += 1;
-          if(chunks_processed == valid_chunks){ break; }
-      }
+        for(long long col_start = 0; col_start < task->n; col_start += CPU_IGEMM_PANEL_COLS)
+        {
+            long long col_end = col_start + CPU_IGEMM_PANEL_COLS < task->n ? col_start + CPU_IGEMM_PANEL_COLS : task->n;
+            long long i = row_start;
+            for(; i + 4 <= row_end; i += 4)
+            {
+                const signed char *a = A + i*task->lda;
+                for(long long j = col_start; j < col_end; j++)
+                {
+                    dot4_int8(a, a + task->lda, a + 2*task->lda, a + 3*task->lda, B + j*task->ldb, task->k, out);
+                    for(int r = 0; r < 4; r++)
+                        C[(i + r)*task->ldc + j] = out[r];
+                }
+            }
+            for(; i < row_end; i++)
+                for(long long j = col_start; j < col_end; j++)
+                    C[i*task->ldc + j] = dot_int8(A + i*task->lda, B + j*task->ldb, task->k);
+        }
+    }
+}
 
-      for (int i = 0; i < valid_chunks; i++)
-          int err = pthread_join(threads[i], NULL);
+void igemm_cpu(const signed char *A, const signed char *B, int *C, long long m, long long n, long long k,
+               long long lda, long long ldb, long long ldc, long long strideA, long long strideB, long long strideC, long long batch)
+{
+    igemm_task_args task = {A, B, C, m, n, k, lda, ldb, ldc, strideA, strideB, strideC, (m + CPU_IGEMM_CHUNK_ROWS - 1)/CPU_IGEMM_CHUNK_ROWS};
+    // small products run on the calling thread
+    long long ops_per_chunk = CPU_IGEMM_CHUNK_ROWS*n*k;
+    long long chunk_size = ops_per_chunk > 0 ? CPU_CHUNK_ITEMS*16/ops_per_chunk : 1;
+    parallel_for_cpu(batch*task.row_chunks, chunk_size, &igemm_chunks, &task);
+}
 
-      free(threads);
-      for (int i = 0; i < valid_chunks; i++)
-          free(args[i]);
-      free(args);
+struct dequant_mm_task_args
+{
+    const int *A;
+    const float *row_stats;
+    const float *col_stats;
+    void *out;
+    const float *bias;
+    long long cols;
+};
 
+template <typename T, T (*STORE)(float)> static void dequant_mm_rows(void *ctx, long long row_start, long long row_end)
+{
+    dequant_mm_task_args *task = (dequant_mm_task_args *) ctx;
+    T *out = (T *) task->out;
+    for(long long i = row_start; i < row_end; i++)
+    {
+        const int *a = task->A + i*task->cols;
+        float row_stat = task->row_stats[i];
+        T *o = out + i*task->cols;
+        for(long long j = 0; j < task->cols; j++)
+        {
+            float bias = task->bias == NULL ? 0.0f : task->bias[j];
+            o[j] = STORE((a[j]*CPU_MM_DEQUANT_CONST*row_stat*task->col_stats[j]) + bias);
+        }
     }
+}
 
+template <typename T, T (*STORE)(float)> static void dequant_mm_cpu_impl(const int *A, const float *row_stats, const float *col_stats, T *out, const float *bias, long long rows, long long cols)
+{
+    dequant_mm_task_args task = {A, row_stats, col_stats, out, bias, cols};
+    long long rows_per_chunk = cols > 0 ? CPU_CHUNK_ITEMS/cols : 1;
+    parallel_for_cpu(rows, rows_per_chunk, &dequant_mm_rows<T, STORE>, &task);
 }
+
+void dequant_mm_int32_fp32_cpu(const int *A, const float *row_stats, const float *col_stats, float *out, const float *bias, long long rows, long long cols)
+{ dequant_mm_cpu_impl<float, float_to_float>(A, row_stats, col_stats, out, bias, rows, cols); }
+void dequant_mm_int32_fp16_cpu(const int *A, const float *row_stats, const float *col_stats, unsigned short *out, const float *bias, long long rows, long long cols)
+{ dequant_mm_cpu_impl<unsigned short, float_to_half>(A, row_stats, col_stats, out, bias, rows, cols); }
+void dequant_mm_int32_bf16_cpu(const int *A, const float *row_stats, const float *col_stats, unsigned short *out, const float *bias, long long rows, long long cols)
+{ dequant_mm_cpu_impl<unsigned short, float_to_bfloat16>(A, row_stats, col_stats, out, bias, rows, cols); }
+
+//==============================================================================
+//                        ROW/COLUMN INT8 QUANTIZATION
+//==============================================================================
+
+// at least this many rows per chunk so that merging the column maxima of a chunk stays cheap
+#define CPU_COLROW_CHUNK_ROWS 16
+
+struct colrow_absmax_task_args
+{
+    const void *A;
+    float *row_stats;
+    float *col_stats;
+    int *nnz_row_ptr;
+    signed char *out_row;
+    float threshold;
+    long long cols;
+};
+
+// atomic max for non-negative floats, which are ordered like their bit patterns
+static inline void atomic_max_nonnegative(float *address, float value)
+{
+    int *bits = (int *) address;
+    int new_bits;
+    memcpy(&new_bits, &value, sizeof(int));
+    int old_bits = __atomic_load_n(bits, __ATOMIC_RELAXED);
+    while(old_bits < new_bits && !__atomic_compare_exchange_n(bits, &old_bits, new_bits, true, __ATOMIC_RELAXED, __ATOMIC_RELAXED));
+}
+
+static inline signed char quantize_int8(float value, float scale)
+{
+    return (signed char) rintf(value*scale);
+}
+
+template <typename T, float (*LOAD)(T), int SPARSE_DECOMP> static void colrow_absmax_rows(void *ctx, long long row_start, long long row_end)
+{
+    colrow_absmax_task_args *task = (colrow_absmax_task_args *) ctx;
+    long long cols = task->cols;
+    float threshold = task->threshold;
+    float *col_absmax = (float *) calloc(cols > 0 ? cols : 1, sizeof(float));
+
+    for(long long i = row_start; i < row_end; i++)
+    {
+        const T *a = (const T *) task->A + i*cols;
+        float row_absmax = 0.0f;
+        int nnz = 0;
+        for(long long j = 0; j < cols; j++)
+        {
+            float value = fabsf(LOAD(a[j]));
+            if(SPARSE_DECOMP && value >= threshold)
+            {
+                nnz += 1;
+                continue;
+            }
+            row_absmax = fmaxf(row_absmax, value);
+            col_absmax[j] = fmaxf(col_absmax[j], value);
+        }
+        task->row_stats[i] = row_absmax;
+        if(SPARSE_DECOMP)
+            task->nnz_row_ptr[i + 1] = nnz;
+
+        // the row is still in cache
+        if(task->out_row != NULL)
+        {
+            signed char *out = task->out_row + i*cols;
+            float scale = row_absmax > 0.0f ? 127.0f/row_absmax : 0.0f;
+            for(long long j = 0; j < cols; j++)
+            {
+                float value = LOAD(a[j]);
+                out[j] = SPARSE_DECOMP && fabsf(value) >= threshold ? 0 : quantize_int8(value, scale);
+            }
+        }
+    }
+
+    for(long long j = 0; j < cols; j++)
+        atomic_max_nonnegative(&task->col_stats[j], col_absmax[j]);
+    free(col_absmax);
+}
+
+template <typename T, float (*LOAD)(T)> static void colrow_absmax_cpu_impl(const T *A, float *row_stats, float *col_stats, int *nnz_row_ptr, signed char *out_row, float threshold, long long rows, long long cols)
+{
+    colrow_absmax_task_args task = {A, row_stats, col_stats, nnz_row_ptr, out_row, threshold, cols};
+    for(long long j = 0; j < cols; j++)
+        col_stats[j] = 0.0f;
+    long long rows_per_chunk = cols > 0 ? CPU_CHUNK_ITEMS/cols : 1;
+    rows_per_chunk = rows_per_chunk > CPU_COLROW_CHUNK_ROWS ? rows_per_chunk : CPU_COLROW_CHUNK_ROWS;
+    if(threshold > 0.0f)
+    {
+        nnz_row_ptr[0] = 0;
+        parallel_for_cpu(rows, rows_per_chunk, &colrow_absmax_rows<T, LOAD, 1>, &task);
+    }
+    else
+        parallel_for_cpu(rows, rows_per_chunk, &colrow_absmax_rows<T, LOAD, 0>, &task);
+}
+
+struct double_rowcol_quant_task_args
+{
+    const void *A;
+    const float *row_stats;
+    const float *col_scales;
+    signed char *out_col;
+    signed char *out_row;
+    int *rowidx;
+    int *colidx;
+    unsigned short *val;
+    const int *nnz_row_ptr;
+    float threshold;
+    long long cols;
+};
+
+template <typename T, float (*LOAD)(T), int SPARSE_DECOMP> static void double_rowcol_quant_rows(void *ctx, long long row_start, long long row_end)
+{
+    double_rowcol_quant_task_args *task = (double_rowcol_quant_task_args *) ctx;
+    long long cols = task->cols;
+    float threshold = task->threshold;
+    for(long long i = row_start; i < row_end; i++)
+    {
+        const T *a = (const T *) task->A + i*cols;
+        signed char *out_col = task->out_col + i*cols;
+        signed char *out_row = task->out_row == NULL ? NULL : task->out_row + i*cols;
+        float row_scale = task->row_stats[i] > 0.0f ? 127.0f/task->row_stats[i] : 0.0f;
+        // outliers are written in row-major order, so the coordinates come out sorted by row
+        long long nnz_idx = SPARSE_DECOMP ? task->nnz_row_ptr[i] : 0;
+        for(long long j = 0; j < cols; j++)
+        {
+            float value = LOAD(a[j]);
+            if(SPARSE_DECOMP && fabsf(value) >= threshold)
+            {
+                out_col[j] = 0;
+                if(out_row != NULL)
+                    out_row[j] = 0;
+                task->rowidx[nnz_idx] = (int) i;
+                task->colidx[nnz_idx] = (int) j;
+                task->val[nnz_idx] = float_to_half(value);
+                nnz_idx += 1;
+                continue;
+            }
+            out_col[j] = quantize_int8(value, task->col_scales[j]);
+            if(out_row != NULL)
+                out_row[j] = quantize_int8(value, row_scale);
+        }
+    }
+}
+
+template <typename T, float (*LOAD)(T)> static void double_rowcol_quant_cpu_impl(const T *A, const float *row_stats, const float *col_stats, signed char *out_col, signed char *out_row,
+                int *rowidx, int *colidx, unsigned short *val, const int *nnz_row_ptr, float threshold, long long rows, long long cols)
+{
+    float *col_scales = (float *) malloc(sizeof(float)*(cols > 0 ? cols : 1));
+    for(long long j = 0; j < cols; j++)
+        col_scales[j] = col_stats[j] > 0.0f ? 127.0f/col_stats[j] : 0.0f;
+
+    double_rowcol_quant_task_args task = {A, row_stats, col_scales, out_col, out_row, rowidx, colidx, val, nnz_row_ptr, threshold, cols};
+    long long rows_per_chunk = cols > 0 ? CPU_CHUNK_ITEMS/cols : 1;
+    if(threshold > 0.0f)
+        parallel_for_cpu(rows, rows_per_chunk, &double_rowcol_quant_rows<T, LOAD, 1>, &task);
+    else
+        parallel_for_cpu(rows, rows_per_chunk, &double_rowcol_quant_rows<T, LOAD, 0>, &task);
+    free(col_scales);
+}
+
+#define MAKE_COLROW_QUANT_CPU(dtype, dbits, load) \
+void colrow_absmax_##dbits##_cpu(const dtype *A, float *row_stats, float *col_stats, int *nnz_row_ptr, signed char *out_row, float threshold, long long rows, long long cols) \
+{ colrow_absmax_cpu_impl<dtype, load>(A, row_stats, col_stats, nnz_row_ptr, out_row, threshold, rows, cols); } \
+void double_rowcol_quant_##dbits##_cpu(const dtype *A, const float *row_stats, const float *col_stats, signed char *out_col, signed char *out_row, \
+                int *rowidx, int *colidx, unsigned short *val, const int *nnz_row_ptr, float threshold, long long rows, long long cols) \
+{ double_rowcol_quant_cpu_impl<dtype, load>(A, row_stats, col_stats, out_col, out_row, rowidx, colidx, val, nnz_row_ptr, threshold, rows, cols); } \
+
+MAKE_COLROW_QUANT_CPU(float, fp32, float_to_float)
+MAKE_COLROW_QUANT_CPU(unsigned short, fp16, half_to_float)
+MAKE_COLROW_QUANT_CPU(unsigned short, bf16, bfloat16_to_float)
@@ -3,8 +3,79 @@
 
 #include <iostream>
 #include <stdio.h>
+#include <stdlib.h>
+
+// minimum number of values a thread processes at once; smaller inputs run on the calling thread
+#define CPU_CHUNK_ITEMS 16384
+
+typedef void (*cpu_task_func)(void *ctx, long long start, long long end);
+
+void set_num_threads_cpu(int num_threads);
+void parallel_for_cpu(long long num_items, long long chunk_size, cpu_task_func func, void *ctx);
 
 void quantize_cpu(float *code, float *A, float *absmax, unsigned char *out, long long blocksize, long long n);
 void dequantize_cpu(float *code, unsigned char *A, float *absmax, float *out, long long blocksize, long long n);
+// 16-bit outputs are passed as raw bits: IEEE half and bfloat16 respectively
+void dequantize_cpu_fp16(float *code, unsigned char *A, float *absmax, unsigned short *out, long long blocksize, long long n);
+void dequantize_cpu_bf16(float *code, unsigned char *A, float *absmax, unsigned short *out, long long blocksize, long long n);
+
+// 8-bit blockwise optimizer updates of one or num_tensors tensors, 16-bit parameters and gradients are passed as raw bits
+#define MAKE_BLOCKWISE8_CPU_DECL(fname, gtype, gbits) \
+void fname##_8bit_blockwise_grad_##gbits##_cpu(gtype* p, gtype* g, \
+                unsigned char* state1, unsigned char* state2, float beta1, float beta2, float eps, int step, float lr, \
+                float* quantiles1, float* quantiles2, float* absmax1, float* absmax2, float weight_decay, const float gnorm_scale, bool skip_zeros, long long n); \
+void fname##_8bit_blockwise_grad_multi_##gbits##_cpu(int num_tensors, gtype** p, gtype** g, \
+                unsigned char** state1, unsigned char** state2, float beta1, float beta2, float eps, int* step, float lr, \
+                float** quantiles1, float** quantiles2, float** absmax1, float** absmax2, float weight_decay, float* gnorm_scale, bool skip_zeros, long long* n); \
+
+#define MAKE_BLOCKWISE8_CPU_DECLS(fname) \
+MAKE_BLOCKWISE8_CPU_DECL(fname, float, fp32) \
+MAKE_BLOCKWISE8_CPU_DECL(fname, unsigned short, fp16) \
+MAKE_BLOCKWISE8_CPU_DECL(fname, unsigned short, bf16) \
+
+MAKE_BLOCKWISE8_CPU_DECLS(adam)
+MAKE_BLOCKWISE8_CPU_DECLS(momentum)
+MAKE_BLOCKWISE8_CPU_DECLS(rmsprop)
+MAKE_BLOCKWISE8_CPU_DECLS(adagrad)
+MAKE_BLOCKWISE8_CPU_DECLS(lion)
+
+// 32-bit optimizer updates of num_tensors parameters at once
+#define MAKE_32BIT_MULTI_CPU_DECL(fname, gtype, gbits) \
+void fname##32bit_grad_multi_##gbits##_cpu(int num_tensors, gtype** g, gtype** p, \
+                float** state1, float** state2, float** unorm, long long* n, int* step, float* gnorm_scale, float max_unorm, \
+                float beta1, float beta2, float eps, float weight_decay, float lr, bool skip_zeros); \
+
+#define MAKE_32BIT_MULTI_CPU_DECLS(fname) \
+MAKE_32BIT_MULTI_CPU_DECL(fname, float, fp32) \
+MAKE_32BIT_MULTI_CPU_DECL(fname, unsigned short, fp16) \
+MAKE_32BIT_MULTI_CPU_DECL(fname, unsigned short, bf16) \
+
+MAKE_32BIT_MULTI_CPU_DECLS(adam)
+MAKE_32BIT_MULTI_CPU_DECLS(momentum)
+MAKE_32BIT_MULTI_CPU_DECLS(rmsprop)
+MAKE_32BIT_MULTI_CPU_DECLS(adagrad)
+MAKE_32BIT_MULTI_CPU_DECLS(lion)
+
+// C[b] = A[b] @ B[b]^T with int32 accumulation, A[b] is m x k and B[b] is n x k, both row-major with leading dimensions lda and ldb
+void igemm_cpu(const signed char *A, const signed char *B, int *C, long long m, long long n, long long k,
+               long long lda, long long ldb, long long ldc, long long strideA, long long strideB, long long strideC, long long batch);
+// out = A*row_stats*col_stats/(127*127) + bias for a row-major int32 matrix A, 16-bit outputs are passed as raw bits
+void dequant_mm_int32_fp32_cpu(const int *A, const float *row_stats, const float *col_stats, float *out, const float *bias, long long rows, long long cols);
+void dequant_mm_int32_fp16_cpu(const int *A, const float *row_stats, const float *col_stats, unsigned short *out, const float *bias, long long rows, long long cols);
+void dequant_mm_int32_bf16_cpu(const int *A, const float *row_stats, const float *col_stats, unsigned short *out, const float *bias, long long rows, long long cols);
+
+// colrow_absmax: row and column absmax of a row-major matrix. Values with |x| >= threshold (if threshold > 0) are outliers that are
+// excluded from the statistics and counted per row in nnz_row_ptr[row + 1]. If out_row is not NULL, the rows are
+// quantized with their absmax in the same pass.
+// double_rowcol_quant: int8 quantization with the row and the column absmax, outliers are set to zero and written as fp16 coordinates,
+// sorted by row, at the offsets nnz_row_ptr. out_row can be NULL if the rows were already quantized.
+#define MAKE_COLROW_QUANT_CPU_DECL(dtype, dbits) \
+void colrow_absmax_##dbits##_cpu(const dtype *A, float *row_stats, float *col_stats, int *nnz_row_ptr, signed char *out_row, float threshold, long long rows, long long cols); \
+void double_rowcol_quant_##dbits##_cpu(const dtype *A, const float *row_stats, const float *col_stats, signed char *out_col, signed char *out_row, \
+                int *rowidx, int *colidx, unsigned short *val, const int *nnz_row_ptr, float threshold, long long rows, long long cols); \
+
+MAKE_COLROW_QUANT_CPU_DECL(float, fp32)
+MAKE_COLROW_QUANT_CPU_DECL(unsigned short, fp16)
+MAKE_COLROW_QUANT_CPU_DECL(unsigned short, bf16)
 
 #endif
@@ -369,6 +369,78 @@ extern "C"
 	CMAKE_ELEMENTWISE_FUNC(_mul, fp32, float, _MUL)
 
 #endif
+	void cset_num_threads_cpu(int num_threads){ set_num_threads_cpu(num_threads); }
 	void cquantize_blockwise_cpu_fp32(float *code, float *A, float *absmax, unsigned char *out, long long blocksize, long long n){ quantize_cpu(code, A, absmax, out, blocksize, n); }
 	void cdequantize_blockwise_cpu_fp32(float *code, unsigned char *A, float *absmax, float *out, long long blocksize, long long n){ dequantize_cpu(code, A, absmax, out, blocksize, n); }
+	void cdequantize_blockwise_cpu_fp16(float *code, unsigned char *A, float *absmax, unsigned short *out, long long blocksize, long long n){ dequantize_cpu_fp16(code, A, absmax, out, blocksize, n); }
+	void cdequantize_blockwise_cpu_bf16(float *code, unsigned char *A, float *absmax, unsigned short *out, long long blocksize, long long n){ dequantize_cpu_bf16(code, A, absmax, out, blocksize, n); }
+
+  #define MAKE_CBLOCKWISE8_CPU(fname, gtype, gbits) \
+  void c##fname##_8bit_blockwise_grad_##gbits##_cpu(gtype* p, gtype* g, \
+                unsigned char* state1, unsigned char* state2, float beta1, float beta2, float eps, int step, float lr,  \
+                float* quantiles1, float* quantiles2, float* absmax1, float* absmax2, float weight_decay, const float gnorm_scale, bool skip_zeros, long long n) \
+  {	fname##_8bit_blockwise_grad_##gbits##_cpu(p, g, state1, state2, beta1, beta2, eps, step, lr, quantiles1, quantiles2, absmax1, absmax2, weight_decay, gnorm_scale, skip_zeros, n); } \
+  void c##fname##_8bit_blockwise_grad_multi_##gbits##_cpu(int num_tensors, gtype** p, gtype** g, \
+                unsigned char** state1, unsigned char** state2, float beta1, float beta2, float eps, int* step, float lr,  \
+                float** quantiles1, float** quantiles2, float** absmax1, float** absmax2, float weight_decay, float* gnorm_scale, bool skip_zeros, long long* n) \
+  {	fname##_8bit_blockwise_grad_multi_##gbits##_cpu(num_tensors, p, g, state1, state2, beta1, beta2, eps, step, lr, quantiles1, quantiles2, absmax1, absmax2, weight_decay, gnorm_scale, skip_zeros, n); } \
+
+	MAKE_CBLOCKWISE8_CPU(adam, float, fp32)
+	MAKE_CBLOCKWISE8_CPU(adam, unsigned short, fp16)
+	MAKE_CBLOCKWISE8_CPU(adam, unsigned short, bf16)
+	MAKE_CBLOCKWISE8_CPU(momentum, float, fp32)
+	MAKE_CBLOCKWISE8_CPU(momentum, unsigned short, fp16)
+	MAKE_CBLOCKWISE8_CPU(momentum, unsigned short, bf16)
+	MAKE_CBLOCKWISE8_CPU(rmsprop, float, fp32)
+	MAKE_CBLOCKWISE8_CPU(rmsprop, unsigned short, fp16)
+	MAKE_CBLOCKWISE8_CPU(rmsprop, unsigned short, bf16)
+	MAKE_CBLOCKWISE8_CPU(adagrad, float, fp32)
+	MAKE_CBLOCKWISE8_CPU(adagrad, unsigned short, fp16)
+	MAKE_CBLOCKWISE8_CPU(adagrad, unsigned short, bf16)
+	MAKE_CBLOCKWISE8_CPU(lion, float, fp32)
+	MAKE_CBLOCKWISE8_CPU(lion, unsigned short, fp16)
+	MAKE_CBLOCKWISE8_CPU(lion, unsigned short, bf16)
+
+  #define MAKE_C32BIT_MULTI_CPU(fname, gtype, gbits) \
+  void c##fname##32bit_grad_multi_##gbits##_cpu(int num_tensors, gtype** g, gtype** p, \
+                float** state1, float** state2, float** unorm, long long* n, int* step, float* gnorm_scale, float max_unorm, \
+                float beta1, float beta2, float eps, float weight_decay, float lr, bool skip_zeros) \
+  { fname##32bit_grad_multi_##gbits##_cpu(num_tensors, g, p, state1, state2, unorm, n, step, gnorm_scale, max_unorm, beta1, beta2, eps, weight_decay, lr, skip_zeros); } \
+
+	MAKE_C32BIT_MULTI_CPU(adam, float, fp32)
+	MAKE_C32BIT_MULTI_CPU(adam, unsigned short, fp16)
+	MAKE_C32BIT_MULTI_CPU(adam, unsigned short, bf16)
+	MAKE_C32BIT_MULTI_CPU(momentum, float, fp32)
+	MAKE_C32BIT_MULTI_CPU(momentum, unsigned short, fp16)
+	MAKE_C32BIT_MULTI_CPU(momentum, unsigned short, bf16)
+	MAKE_C32BIT_MULTI_CPU(rmsprop, float, fp32)
+	MAKE_C32BIT_MULTI_CPU(rmsprop, unsigned short, fp16)
+	MAKE_C32BIT_MULTI_CPU(rmsprop, unsigned short, bf16)
+	MAKE_C32BIT_MULTI_CPU(adagrad, float, fp32)
+	MAKE_C32BIT_MULTI_CPU(adagrad, unsigned short, fp16)
+	MAKE_C32BIT_MULTI_CPU(adagrad, unsigned short, bf16)
+	MAKE_C32BIT_MULTI_CPU(lion, float, fp32)
+	MAKE_C32BIT_MULTI_CPU(lion, unsigned short, fp16)
+	MAKE_C32BIT_MULTI_CPU(lion, unsigned short, bf16)
+
+	void cigemm_cpu(const signed char *A, const signed char *B, int *C, long long m, long long n, long long k,
+	                long long lda, long long ldb, long long ldc, long long strideA, long long strideB, long long strideC, long long batch)
+	{ igemm_cpu(A, B, C, m, n, k, lda, ldb, ldc, strideA, strideB, strideC, batch); }
+	void cdequant_mm_int32_fp32_cpu(const int *A, const float *row_stats, const float *col_stats, float *out, const float *bias, long long rows, long long cols)
+	{ dequant_mm_int32_fp32_cpu(A, row_stats, col_stats, out, bias, rows, cols); }
+	void cdequant_mm_int32_fp16_cpu(const int *A, const float *row_stats, const float *col_stats, unsigned short *out, const float *bias, long long rows, long long cols)
+	{ dequant_mm_int32_fp16_cpu(A, row_stats, col_stats, out, bias, rows, cols); }
+	void cdequant_mm_int32_bf16_cpu(const int *A, const float *row_stats, const float *col_stats, unsigned short *out, const float *bias, long long rows, long long cols)
+	{ dequant_mm_int32_bf16_cpu(A, row_stats, col_stats, out, bias, rows, cols); }
+
+	#define MAKE_COLROW_QUANT_C_CPU(dtype, dbits) \
+	void ccolrow_absmax_##dbits##_cpu(const dtype *A, float *row_stats, float *col_stats, int *nnz_row_ptr, signed char *out_row, float threshold, long long rows, long long cols) \
+	{ colrow_absmax_##dbits##_cpu(A, row_stats, col_stats, nnz_row_ptr, out_row, threshold, rows, cols); } \
+	void cdouble_rowcol_quant_##dbits##_cpu(const dtype *A, const float *row_stats, const float *col_stats, signed char *out_col, signed char *out_row, \
+	                int *rowidx, int *colidx, unsigned short *val, const int *nnz_row_ptr, float threshold, long long rows, long long cols) \
+	{ double_rowcol_quant_##dbits##_cpu(A, row_stats, col_stats, out_col, out_row, rowidx, colidx, val, nnz_row_ptr, threshold, rows, cols); } \
+
+	MAKE_COLROW_QUANT_C_CPU(float, fp32)
+	MAKE_COLROW_QUANT_C_CPU(unsigned short, fp16)
+	MAKE_COLROW_QUANT_C_CPU(unsigned short, bf16)
 }
@@ -533,6 +533,60 @@ def test_matmul_4bit( dim1, dim2, dim3, dim4, funcs, dtype, req_grad, transpose,
                     torch.testing.assert_close(gradBias1, gradBias2)
 
 
+def test_matmul_4bit_dequant_cache():
+    cache = bnb.autograd.GlobalDequantCache.get_instance()
+    A = torch.randn(8, 64, requires_grad=True)
+    Bs = [torch.randn(32, 64) for i in range(2)]
+    quantized = [bnb.functional.quantize_4bit(B, quant_type="nf4") for B in Bs]
+    expected = [bnb.matmul_4bit(A, B2.t(), quant_state) for B2, quant_state in quantized]
+    assert len(cache.cache) == 0
+
+    try:
+        # room for one dequantized weight only
+        cache.set_max_bytes(32 * 64 * 4)
+        for i in range(2):
+            for (B2, quant_state), out_ref in zip(quantized, expected):
+                out = bnb.matmul_4bit(A, B2.t(), quant_state)
+                torch.testing.assert_close(out, out_ref, atol=0, rtol=0)
+                out.sum().backward()
+                assert len(cache.cache) == 1
+                assert cache.num_bytes == 32 * 64 * 4
+
+        # changing the packed weight in place invalidates its entry
+        B2, quant_state = quantized[1]
+        B2.copy_(quantized[0][0])
+        out = bnb.matmul_4bit(A, B2.t(), quant_state)
+        weight = bnb.functional.dequantize_4bit(B2, quant_state)
+        torch.testing.assert_close(out, A @ weight.t(), atol=1e-5, rtol=1e-5)
+
+        cache.set_max_bytes(0)
+        assert len(cache.cache) == 0 and cache.num_bytes == 0
+    finally:
+        cache.set_max_bytes(0)
+
+
+@pytest.mark.parametrize("threshold", [0.0, 3.0], ids=["no_outliers", "outliers"])
+@pytest.mark.parametrize("dtype", [torch.float32, torch.bfloat16], ids=["fp32", "bf16"])
+def test_matmullt_cpu(threshold, dtype):
+    A = torch.randn(32, 64, dtype=dtype)
+    A[:, 5] *= 8.0
+    A.requires_grad_(True)
+    B = torch.randn(48, 64, dtype=dtype, requires_grad=True)
+    bias = torch.randn(48, dtype=dtype, requires_grad=True)
+    A_ref, B_ref, bias_ref = [t.detach().float().requires_grad_(True) for t in (A, B, bias)]
+
+    out = bnb.matmul(A, B, threshold=threshold, bias=bias)
+    out_ref = torch.nn.functional.linear(A_ref, B_ref, bias_ref)
+    assert out.dtype == dtype
+    assert (out.float() - out_ref).abs().mean() / out_ref.abs().mean() < 0.02
+
+    grad = torch.randn(out.shape)
+    out.backward(grad.to(dtype))
+    out_ref.backward(grad)
+    for t, t_ref in [(A, A_ref), (B, B_ref), (bias, bias_ref)]:
+        assert (t.grad.float() - t_ref.grad).abs().mean() / t_ref.grad.abs().mean() < 0.05
+
+
 funcs = [(torch.matmul, bnb.research.matmul_fp8_mixed), (torch.matmul, bnb.research.matmul_fp8_global)]
 str_funcs = ["matmul_fp8_mixed", 'matmul_fp8_global']
 req_grad = list(product([True, False], repeat=3))
@@ -1,4 +1,7 @@
 import os
+import subprocess
+import sys
+from pathlib import Path
 from typing import List, NamedTuple
 
 import pytest
@@ -38,3 +41,70 @@ def test_cuda_full_system():
     binary_name, cudart_path, cuda, cc, cuda_version_string = evaluate_cuda_setup()
     binary_name = binary_name.replace("libbitsandbytes_cuda", "")
     assert binary_name.startswith(str(version).replace(".", ""))
+
+
+def test_import_is_lazy():
+    # a fresh interpreter so that the modules imported by other tests do not count
+    code = (
+        "import sys\n"
+        "import torch\n"
+        "import bitsandbytes as bnb\n"
+        "import bitsandbytes.nn, bitsandbytes.optim\n"
+        "from bitsandbytes import cextension\n"
+        "from bitsandbytes.cuda_setup.main import CUDASetup\n"
+        "assert not cextension.is_library_loaded()\n"
+        "assert not CUDASetup.get_instance().initialized\n"
+        "assert 'scipy' not in sys.modules\n"
+        "assert 'triton' not in sys.modules\n"
+    )
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+
+    # first use of the library runs the setup
+    code = (
+        "import bitsandbytes as bnb\n"
+        "from bitsandbytes import cextension\n"
+        "bnb.COMPILED_WITH_CUDA\n"
+        "assert cextension.is_library_loaded()\n"
+    )
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+
+
+def test_cuda_setup_cache(tmp_path, monkeypatch):
+    from bitsandbytes.cuda_setup import main, setup_cache
+
+    monkeypatch.setenv("BITSANDBYTES_CACHE_DIR", str(tmp_path))
+    monkeypatch.setenv("BITSANDBYTES_NOWELCOME", "1")
+    monkeypatch.delenv("BITSANDBYTES_NO_SETUP_CACHE", raising=False)
+    fingerprint = setup_cache.setup_fingerprint()
+    assert fingerprint == setup_cache.setup_fingerprint()
+
+    calls = []
+    def discover():
+        calls.append(1)
+        main.CUDASetup.get_instance().add_log_entry("discovered", is_warning=False)
+        return "libbitsandbytes_cuda118.so", Path("/opt/cuda/lib64/libcudart.so"), None, "8.0", "118"
+    monkeypatch.setattr(main, "discover_cuda_setup", discover)
+
+    setup = main.CUDASetup.get_instance()
+    monkeypatch.setattr(setup, "cuda_setup_log", [], raising=False)
+    expected = ("libbitsandbytes_cuda118.so", Path("/opt/cuda/lib64/libcudart.so"), None, "8.0", "118")
+    assert main.evaluate_cuda_setup() == expected
+    assert main.evaluate_cuda_setup() == expected
+    assert len(calls) == 1
+    # the log of the evaluation is replayed from the cache
+    assert setup.cuda_setup_log == [("discovered", False)] * 2
+
+    # a changed environment is evaluated again
+    monkeypatch.setenv("CUDA_VISIBLE_DEVICES", "7")
+    assert setup_cache.setup_fingerprint() != fingerprint
+    main.evaluate_cuda_setup()
+    assert len(calls) == 2
+
+    monkeypatch.setenv("BITSANDBYTES_NO_SETUP_CACHE", "1")
+    main.evaluate_cuda_setup()
+    assert len(calls) == 3
+
+    setup_cache.remove_cached_setup(fingerprint)
+    assert setup_cache.load_cached_setup(fingerprint) is None
@@ -111,6 +111,48 @@ def test_estimate_quantiles(dtype):
     assert (diff > 5e-02).sum().item() == 0
 
 
+@pytest.mark.parametrize("dtype", [torch.float32, torch.float16, torch.bfloat16], ids=["float", "half", "bfloat16"])
+def test_estimate_quantiles_cpu(dtype):
+    A = torch.randn(1024, 1024).to(dtype)
+    code = F.estimate_quantiles(A)
+    percs = torch.linspace(1 / 512, 511 / 512, 256)
+    quantiles = torch.quantile(A.float().flatten(), percs)
+    assert code.shape == (256,) and code.dtype == torch.float32
+    assert (code - quantiles).abs().max() < 5e-02
+
+    # more than 256 quantiles and fewer quantiles like on the GPU
+    assert F.estimate_quantiles(A, num_quantiles=1024).shape == (1024,)
+    code = F.estimate_quantiles(A, num_quantiles=15)
+    torch.testing.assert_close(code, torch.quantile(A.float().flatten(), torch.linspace(1/30, 29/30, 256)[torch.linspace(0, 255, 15).long()]), atol=5e-2, rtol=0)
+
+
+def test_quantile_sketch():
+    # exact while all values fit into the sketch
+    A = torch.randn(1000)
+    q = torch.linspace(0, 1, 101)
+    sketch = F.QuantileSketch(k=2048).update(A)
+    torch.testing.assert_close(sketch.quantile(q), torch.quantile(A, q))
+
+    # streaming and merged over workers, the rank error is about 1.7/k
+    A = torch.rand(2**20 + 13)
+    sketches = [F.QuantileSketch(k=512, seed=i) for i in range(4)]
+    for i, chunk in enumerate(A.split(10000)):
+        sketches[i % 4].update(chunk.half() if i % 2 else chunk)
+    merged = F.QuantileSketch.from_state_dict(sketches[0].state_dict())
+    for sketch in sketches[1:]:
+        merged.merge(sketch)
+    assert merged.n == A.numel()
+    q = torch.linspace(0, 1, 257)
+    # the values are uniform, so the quantiles are their own ranks
+    assert (merged.quantile(q) - q).abs().max() < 0.01
+    assert merged.quantile(0.0) == A.min() and merged.quantile(1.0) == A.half().float().max().clamp(min=A.max())
+
+    code = F.estimate_quantiles(merged)
+    assert (code - torch.linspace(1 / 512, 511 / 512, 256)).abs().max() < 0.01
+    with pytest.raises(ValueError):
+        merged.merge(F.QuantileSketch(k=256))
+
+
 def test_quantile_quantization():
     for i in range(100):
         A1 = torch.randn(1024, 1024, device="cuda")
@@ -154,6 +196,26 @@ def test_dynamic_quantization():
 
 
 
+@pytest.mark.parametrize("device", ["cpu", "cuda"])
+def test_dynamic_map_unsigned(device):
+    if device == "cuda" and not torch.cuda.is_available():
+        pytest.skip("this test requires a GPU")
+    code = F.create_dynamic_map(signed=False)
+    assert code.numel() == 256
+    assert (code[1:] >= code[:-1]).all()
+    assert code[0] == 0 and code[-1] == 1
+    idx = torch.tensor([1, 64, 127, 128, 192, 254])
+    expected = torch.tensor([3.25e-07, 0.012109, 0.103516, 0.110547, 0.560547, 0.996484])
+    torch.testing.assert_close(code[idx], expected, atol=0, rtol=1e-4)
+
+    torch.manual_seed(0)
+    A1 = torch.rand(1024, 1024, device=device)
+    C, S = F.quantize_blockwise(A1, code=code)
+    A2 = F.dequantize_blockwise(C, S)
+    torch.testing.assert_close(A1, A2, atol=0.01, rtol=0)
+    assert torch.abs(A1 - A2).mean().item() < 0.003
+
+
 @pytest.mark.parametrize("nested", [False, True], ids=["False", "True"])
 @pytest.mark.parametrize("blocksize", [4096, 2048, 1024, 512, 256, 128, 64])
 def test_dynamic_blockwise_quantization(nested, blocksize):
@@ -225,6 +287,30 @@ def test_percentile_clipping(gtype):
         torch.testing.assert_close(gnorm1, gnorm2)
 
 
+@pytest.mark.parametrize("gtype", [torch.float32, torch.float16, torch.bfloat16], ids=["float", "half", "bfloat16"])
+def test_percentile_clipping_cpu(gtype):
+    gnorm_vec1 = torch.zeros(100)
+    gnorm_vec2 = torch.zeros(100)
+    percentile = 5
+    for step in range(1, 250):
+        # grow the gradients so that the clip value changes and some steps are clipped
+        g = (torch.randn(64, 33) * (1.0 + step / 50.0)).to(gtype)
+        gnorm1, clip1, gnorm_scale = F.percentile_clipping(g, gnorm_vec1, step, percentile=percentile)
+        assert gnorm_scale.device.type == "cpu"
+
+        gnorm2 = torch.norm(g.float())
+        if step == 1:
+            gnorm_vec2[:] = gnorm2**2
+        else:
+            gnorm_vec2[step % 100] = gnorm2**2
+        clip2 = torch.sqrt(torch.sort(gnorm_vec2).values[percentile])
+
+        torch.testing.assert_close(gnorm_vec1, gnorm_vec2)
+        torch.testing.assert_close(gnorm1, gnorm2)
+        torch.testing.assert_close(clip1, clip2)
+        torch.testing.assert_close(gnorm_scale, clip2 / gnorm2 if gnorm2 > clip2 else torch.tensor(1.0))
+
+
 def quant(x):
     max1 = torch.abs(x).max()
     x = torch.round(x / max1 * 127)
@@ -2070,6 +2156,184 @@ def test_blockwise_cpu_large():
 
 
 
+@pytest.mark.parametrize("blocksize", [4096, 256, 64])
+def test_blockwise_cpu_num_threads(blocksize):
+    A1 = torch.randn(1024, 1031, device='cpu')
+    num_threads = torch.get_num_threads()
+    try:
+        torch.set_num_threads(1)
+        C1, S1 = F.quantize_blockwise(A1, blocksize=blocksize)
+        A2 = F.dequantize_blockwise(C1, S1, blocksize=blocksize)
+        torch.set_num_threads(4)
+        C2, S2 = F.quantize_blockwise(A1, blocksize=blocksize)
+        A3 = F.dequantize_blockwise(C2, S2, blocksize=blocksize)
+    finally:
+        torch.set_num_threads(num_threads)
+
+    torch.testing.assert_close(C1, C2, atol=0, rtol=0)
+    torch.testing.assert_close(S1[0], S2[0], atol=0, rtol=0)
+    torch.testing.assert_close(A2, A3, atol=0, rtol=0)
+    assert torch.abs(A1 - A2).mean().item() < 0.011
+
+
+@pytest.mark.parametrize("nested", [False, True], ids=["False", "True"])
+@pytest.mark.parametrize("dtype", [torch.float32, torch.float16, torch.bfloat16], ids=['fp32', 'fp16', 'bf16'])
+def test_dequantize_blockwise_cpu(nested, dtype):
+    A1 = torch.randn(1024, 1024, device='cpu')
+    C, S = F.quantize_blockwise(A1, blocksize=256, nested=nested)
+    A2 = F.dequantize_blockwise(C, S, out=torch.empty_like(A1, dtype=dtype))
+    assert A2.dtype == dtype
+    assert torch.abs(A1 - A2.float()).mean().item() < 0.011
+
+    # 16-bit outputs are rounded from the float32 result
+    A3 = F.dequantize_blockwise(C, S)
+    torch.testing.assert_close(A2, A3.to(dtype), atol=0, rtol=0)
+
+
+@pytest.mark.parametrize("transpose", [(False, False), (False, True), (True, False), (True, True)], ids=["NN", "NT", "TN", "TT"])
+def test_igemm_cpu(transpose):
+    for shapeA, shapeB in [((37, 129), (129, 65)), ((4, 33, 256), (256, 17))]:
+        A = torch.randint(-128, 127, size=shapeA, dtype=torch.int8)
+        B = torch.randint(-128, 127, size=shapeB, dtype=torch.int8)
+        if transpose[0] and A.dim() == 2:
+            A = A.t().contiguous().t()
+        if transpose[1]:
+            B = B.t().contiguous().t()
+        out = F.igemm(A, B)
+        torch.testing.assert_close(out, torch.matmul(A.long(), B.long()).int(), atol=0, rtol=0)
+
+    # bsi,bso->io
+    A = torch.randint(-128, 127, size=(4, 33, 64), dtype=torch.int8)
+    B = torch.randint(-128, 127, size=(4, 33, 48), dtype=torch.int8)
+    out = F.igemm(A, B, out=torch.zeros(64, 48, dtype=torch.int32))
+    expected = torch.einsum("bsi,bso->io", A.long(), B.long()).int()
+    torch.testing.assert_close(out, expected, atol=0, rtol=0)
+
+
+def test_batched_igemm_cpu():
+    A = torch.randint(-128, 127, size=(5, 31, 77), dtype=torch.int8)
+    B = torch.randint(-128, 127, size=(5, 77, 40), dtype=torch.int8)
+    out = F.igemm(A, B)
+    torch.testing.assert_close(out, torch.bmm(A.long(), B.long()).int(), atol=0, rtol=0)
+    out = F.batched_igemm(A, B.transpose(1, 2).contiguous().transpose(1, 2))
+    torch.testing.assert_close(out, torch.bmm(A.long(), B.long()).int(), atol=0, rtol=0)
+
+
+@pytest.mark.parametrize("has_bias", [False, True], ids=["no_bias", "bias"])
+@pytest.mark.parametrize("dtype", [torch.float32, torch.float16, torch.bfloat16], ids=['fp32', 'fp16', 'bf16'])
+def test_igemmlt_dequant_cpu(has_bias, dtype):
+    for shapeA in [(63, 256), (3, 17, 256)]:
+        A = torch.randn(*shapeA)
+        B = torch.randn(129, 256)
+        bias = torch.randn(129) if has_bias else None
+        statsA = A.abs().reshape(-1, 256).amax(dim=1)
+        statsB = B.abs().amax(dim=1)
+        CA = torch.round(A.reshape(-1, 256) * 127 / statsA[:, None]).to(torch.int8).reshape(shapeA)
+        CB = torch.round(B * 127 / statsB[:, None]).to(torch.int8)
+
+        C32, SC = F.igemmlt(CA, CB, (CA.shape, "row"), (CB.shape, "row"))
+        assert SC[1] == "row"
+        assert C32.shape == shapeA[:-1] + (129,)
+        expected = torch.matmul(CA.long(), CB.long().t()).int()
+        torch.testing.assert_close(C32, expected, atol=0, rtol=0)
+
+        out = F.mm_dequant(C32, SC, statsA, statsB, out=torch.empty(CA.numel() // 256, 129, dtype=dtype), bias=bias)
+        ref = C32.reshape(-1, 129).float() * statsA[:, None] * statsB[None, :] / (127 * 127)
+        if bias is not None:
+            ref += bias
+        assert out.dtype == dtype
+        torch.testing.assert_close(out.float(), ref.to(dtype).float(), atol=1e-2, rtol=1e-2)
+        err = (out.float() - (A.reshape(-1, 256) @ B.t() + (bias if bias is not None else 0))).abs()
+        assert err.mean() < 0.2 and err.max() < 1.0
+
+
+@pytest.mark.parametrize("threshold", [0.0, 3.0], ids=["no_outliers", "outliers"])
+@pytest.mark.parametrize("dtype", [torch.float32, torch.float16, torch.bfloat16], ids=['fp32', 'fp16', 'bf16'])
+def test_double_quant_cpu(threshold, dtype):
+    A = torch.randn(130, 257).to(dtype)
+    outliers = A.abs() >= threshold if threshold > 0.0 else torch.zeros(A.shape, dtype=torch.bool)
+    A_truncated = A.float().masked_fill(outliers, 0.0)
+
+    CA, CAt, statsA, statsAt, coo_tensor = F.double_quant(A, threshold=threshold)
+    torch.testing.assert_close(statsA, A_truncated.abs().amax(1))
+    torch.testing.assert_close(statsAt, A_truncated.abs().amax(0))
+    # max difference is 1 due to rounding differences
+    torch.testing.assert_close(CA, torch.round(A_truncated * 127 / statsA[:, None]).to(torch.int8), atol=1, rtol=0)
+    torch.testing.assert_close(CAt, torch.round(A_truncated * 127 / statsAt[None, :]).to(torch.int8), atol=1, rtol=0)
+
+    if threshold > 0.0:
+        rowidx, colidx = torch.nonzero(outliers, as_tuple=True)
+        assert coo_tensor.nnz == rowidx.numel() > 0
+        torch.testing.assert_close(coo_tensor.rowidx, rowidx.int())
+        torch.testing.assert_close(coo_tensor.colidx, colidx.int())
+        torch.testing.assert_close(coo_tensor.values, A[outliers].half())
+        assert (CA[outliers] == 0).all() and (CAt[outliers] == 0).all()
+    else:
+        assert coo_tensor is None
+
+    row_stats, col_stats, nnz_row_ptr = F.get_colrow_absmax(A, threshold=threshold)
+    torch.testing.assert_close(row_stats, statsA, atol=0, rtol=0)
+    torch.testing.assert_close(col_stats, statsAt, atol=0, rtol=0)
+    if threshold > 0.0:
+        torch.testing.assert_close(nnz_row_ptr[1:], outliers.sum(1).cumsum(0).int())
+
+    # quantization with precomputed statistics
+    CA2, CAt2, _, _, coo_tensor2 = F.double_quant(A, col_stats=statsAt, row_stats=statsA, threshold=threshold)
+    torch.testing.assert_close(CA2, CA, atol=0, rtol=0)
+    torch.testing.assert_close(CAt2, CAt, atol=0, rtol=0)
+    if threshold > 0.0:
+        torch.testing.assert_close(coo_tensor2.colidx, coo_tensor.colidx)
+
+
+@pytest.mark.parametrize("nested", [False, True], ids=["False", "True"])
+def test_quantize_blockwise_many_cpu(nested):
+    torch.manual_seed(0)
+    tensors = [torch.randn(3, 100), torch.randn(256).half(), torch.randn(7, 7, 7), torch.randn(1)]
+    C, state = F.quantize_blockwise_many(tensors, nested=nested)
+    quant_state, offsets, shapes, dtypes = state
+    assert C.numel() == 4 * 256 + 512 and shapes == [A.shape for A in tensors]
+
+    for A, offset in zip(tensors, offsets):
+        # no block spans two tensors, so the values match the quantization of each tensor
+        C1, S1 = F.quantize_blockwise(A.float(), blocksize=256)
+        torch.testing.assert_close(C[offset:offset + A.numel()], C1.view(-1), atol=0, rtol=0)
+        if not nested:
+            blocks = S1[0].numel()
+            torch.testing.assert_close(quant_state[0][offset // 256:offset // 256 + blocks], S1[0], atol=0, rtol=0)
+
+    dequantized = F.dequantize_blockwise_many(C, state)
+    for A, A2 in zip(tensors, dequantized):
+        assert A2.shape == A.shape and A2.dtype == A.dtype
+        if A.numel() == 1:
+            # a single value is its own absmax, which is only rounded when it is quantized as well
+            torch.testing.assert_close(A2, A, atol=0, rtol=0.02 if nested else 1e-5)
+        else:
+            assert torch.abs(A.float() - A2.float()).mean().item() < 0.011
+
+    out = [torch.empty_like(A) for A in tensors]
+    assert F.dequantize_blockwise_many(C, state, out=out) is out
+    for A2, A3 in zip(dequantized, out):
+        torch.testing.assert_close(A2, A3, atol=0, rtol=0)
+
+
+@pytest.mark.parametrize("quant_type", ["fp4", "nf4"])
+def test_quantize_4bit_many_cpu(quant_type):
+    tensors = [torch.randn(3, 100), torch.randn(64).half(), torch.randn(7, 9).bfloat16()]
+    C, state = F.quantize_4bit_many(tensors, blocksize=64, quant_type=quant_type)
+    quant_state, offsets, shapes, dtypes = state
+    assert dtypes == [torch.float32, torch.float16, torch.bfloat16]
+
+    for A, offset in zip(tensors, offsets):
+        C1, S1 = F.quantize_4bit(A.float(), blocksize=64, quant_type=quant_type)
+        torch.testing.assert_close(C.view(-1)[offset // 2:offset // 2 + C1.numel()], C1.view(-1), atol=0, rtol=0)
+
+    dequantized = F.dequantize_4bit_many(C, state)
+    for A, A2 in zip(tensors, dequantized):
+        assert A2.shape == A.shape and A2.dtype == A.dtype
+        A3 = F.dequantize_4bit(*F.quantize_4bit(A.float(), blocksize=64, quant_type=quant_type))
+        torch.testing.assert_close(A2, A3.to(A.dtype), atol=0, rtol=0)
+
+
 def test_fp8_quant():
     for e_bits in range(1, 7):
         p_bits = 7-e_bits
@@ -2296,6 +2560,37 @@ def test_4bit_compressed_stats(quant_type):
 
 
 
+@pytest.mark.parametrize("quant_type", ['fp4', 'nf4'])
+@pytest.mark.parametrize("blocksize", [4096, 2048, 1024, 512, 256, 128, 64])
+@pytest.mark.parametrize("dtype", [torch.float32, torch.float16], ids=['fp32', 'fp16'])
+def test_4bit_quant_cpu(quant_type, blocksize, dtype):
+    A1 = torch.randn(1024, 1023, device='cpu').to(dtype)
+    for compress_statistics in [False, True]:
+        q, SA = F.quantize_4bit(A1, blocksize=blocksize, compress_statistics=compress_statistics, quant_type=quant_type)
+        assert q.numel() == (A1.numel()+1)//2
+        A2 = F.dequantize_4bit(q, SA, quant_type=quant_type)
+        assert A2.dtype == dtype
+        assert A2.shape == A1.shape
+
+        err = (A1 - A2).abs().float()
+        relerr = (err/(A1.abs().float()+1e-15)).mean()
+        # larger blocks have a larger absmax and flush more small values to zero
+        max_err, max_relerr = (0.11, 0.3) if blocksize <= 128 else (0.15, 0.4)
+        assert err.mean().item() < max_err
+        assert relerr.item() < max_relerr
+
+    if torch.cuda.is_available() and blocksize <= 512:
+        # the CPU path reproduces the CUDA kernels bit by bit
+        q, SA = F.quantize_4bit(A1, blocksize=blocksize, quant_type=quant_type)
+        qc, SAc = F.quantize_4bit(A1.cuda(), blocksize=blocksize, quant_type=quant_type)
+        torch.testing.assert_close(q, qc.cpu(), atol=0, rtol=0)
+        torch.testing.assert_close(SA[0], SAc[0].cpu(), atol=0, rtol=0)
+        if dtype == torch.float16:
+            A2 = F.dequantize_4bit(q, SA, quant_type=quant_type)
+            A2c = F.dequantize_4bit(qc, SAc, quant_type=quant_type)
+            torch.testing.assert_close(A2, A2c.cpu(), atol=0, rtol=0)
+
+
 @pytest.mark.skipif(not torch.cuda.is_available(), reason="this test requires a GPU")
 @pytest.mark.parametrize("quant_type", ['fp4', 'nf4'])
 def test_bench_4bit_dequant(quant_type):
@@ -2344,6 +2639,76 @@ def test_normal_map_tree():
         print(pivots)
 
 
+def test_codebook_registry():
+    registry = F.CodebookRegistry.get_instance()
+    registry.clear()
+    calls = []
+    def builder(signed=True, total_bits=8):
+        calls.append((signed, total_bits))
+        return F.create_linear_map(signed, total_bits)
+
+    code = F.get_codebook(builder)
+    assert F.get_codebook(builder, True) is code
+    assert F.get_codebook(builder, signed=True, total_bits=8) is code
+    torch.testing.assert_close(code, F.create_linear_map())
+    assert F.get_codebook(builder, signed=False) is not code
+    assert len(calls) == 2
+
+    half = F.get_codebook(builder, dtype=torch.float16)
+    assert half.dtype == torch.float16
+    assert F.get_codebook(builder, dtype=torch.float16) is half
+    if torch.cuda.is_available():
+        gpu_code = F.get_codebook(builder, device="cuda")
+        assert gpu_code.is_cuda and F.get_codebook(builder, device=gpu_code.device) is gpu_code
+    assert len(calls) == 2
+
+    # the default code of the 8-bit functions and the optimizers come from the registry
+    A = torch.randn(1024)
+    C, S = F.quantize_blockwise(A)
+    assert S[1] is F.get_codebook(F.create_dynamic_map)
+    p1, p2 = torch.nn.Parameter(torch.randn(4096)), torch.nn.Parameter(torch.randn(4096))
+    opt1, opt2 = bnb.optim.Adam8bit([p1]), bnb.optim.Adam8bit([p2])
+    assert opt1.name2qmap["dynamic"] is opt2.name2qmap["dynamic"]
+
+
+def test_page_manager_prefetch_schedule():
+    page_mng = F.GlobalPageManager.get_instance()
+    page_mng.initialize()
+    page_mng.prefetch_depth = 1
+    tensors = [F.get_mmap_paged(1024, 64) for i in range(4)]
+    budget = 2 * tensors[0].numel() * tensors[0].element_size()
+    page_mng.max_resident_bytes = budget
+    try:
+        for step in range(3):
+            for i, t in enumerate(tensors):
+                page_mng.acquire(i, [t])
+                t.add_(1)
+                page_mng.release(i)
+                assert sum(page_mng.resident.values()) <= budget
+        for t in tensors:
+            assert (t == 3).all()
+        # the first iteration learns the order. The first key of the second iteration is a miss as well,
+        # because the key after the last one is only known once the first key is acquired again
+        assert page_mng.stats["misses"] == 5
+        assert page_mng.stats["hits"] == 7
+        assert page_mng.stats["evictions"] > 0
+        assert page_mng.stats["stall_time"] >= 0.0
+    finally:
+        page_mng.initialize()
+
+
+def test_normal_map_matches_scipy():
+    p = torch.linspace(0.01, 0.99, 99)
+    torch.testing.assert_close(F.normal_ppf(p), torch.from_numpy(norm.ppf(p.numpy())), rtol=1e-6, atol=1e-6)
+
+    nf4 = [-1.0, -0.6961928009986877, -0.5250730514526367, -0.39491748809814453, -0.28444138169288635,
+           -0.18477343022823334, -0.09105003625154495, 0.0, 0.07958029955625534, 0.16093020141124725,
+           0.24611230194568634, 0.33791524171829224, 0.44070982933044434, 0.5626170039176941,
+           0.7229568362236023, 1.0]
+    code = F.create_normal_map()
+    torch.testing.assert_close(torch.unique(code), torch.tensor(nf4))
+
+
 #@pytest.mark.parametrize("dtype", [torch.float32, torch.float16], ids=['fp32', 'fp16'])
 @pytest.mark.parametrize("dtype", [torch.float16], ids=['fp16'])
 def test_cutlass3_gemm(dtype):
@@ -141,3 +141,24 @@ def test_linear_serialization(has_fp16_weights, serialize_before_forward, deseri
     if has_fp16_weights or not deserialize_before_cuda:
         assert torch.allclose(fx_first, fx_second, atol=1e-5)
         assert torch.allclose(x_first.grad, x_second.grad, atol=1e-5)
+
+
+@pytest.mark.parametrize("threshold", [0.0, 3.0], ids=["no_outliers", "outliers"])
+def test_linear8bitlt_inference_cpu(threshold):
+    torch.manual_seed(0)
+    linear = torch.nn.Linear(64, 32)
+    x = torch.randn(4, 64)
+    x[:, 5] *= 8.0
+    linear_int8 = Linear8bitLt(64, 32, has_fp16_weights=False, threshold=threshold)
+    linear_int8.load_state_dict(linear.state_dict())
+
+    # the weight is quantized on the CPU on the first forward, or explicitly with quantize()
+    for i in range(2):
+        out = linear_int8(x)
+        out_ref = linear(x)
+        assert out.dtype == torch.float32 and linear_int8.weight.dtype == torch.int8
+        assert (out - out_ref).abs().mean() / out_ref.abs().mean() < 0.02
+
+    weight = bnb.nn.Int8Params(linear.weight.data.clone(), requires_grad=False, has_fp16_weights=False).quantize()
+    assert weight.dtype == torch.int8 and weight.SCB.shape == (32,)
+    torch.testing.assert_close(weight.data, linear_int8.weight.data, atol=0, rtol=0)
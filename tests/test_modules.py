@@ -1,3 +1,4 @@
+import math
 from itertools import product
 
 import pytest
@@ -608,8 +609,207 @@ def test_fp8linear():
     assert bgraderr < 0.00002
 
 
+@pytest.mark.parametrize("quant_type", ["fp4", "nf4"])
+@pytest.mark.parametrize("compress_statistics", [False, True], ids=["nocompress", "compress"])
+def test_linear4bit_save_load_quantized(tmp_path, quant_type, compress_statistics):
+    ref = nn.Sequential(bnb.nn.Linear4bit(64, 128, compress_statistics=compress_statistics, quant_type=quant_type),
+                        bnb.nn.Linear4bit(128, 32, compress_statistics=compress_statistics, quant_type=quant_type))
+    path = str(tmp_path / "weights.bnb")
+    # the weights are quantized on the CPU
+    bnb.nn.save_quantized(ref, path)
+
+    model = nn.Sequential(bnb.nn.Linear4bit(64, 128, quant_type=quant_type), bnb.nn.Linear4bit(128, 32, quant_type=quant_type))
+    bnb.nn.load_quantized(model, path)
+    for a, b in zip(ref, model):
+        b.bias.data.copy_(a.bias.data)
+        assert b.weight.dtype == torch.uint8
+        assert b.weight.compress_statistics == compress_statistics
+        torch.testing.assert_close(a.weight.data, b.weight.data, atol=0, rtol=0)
+        w1 = bnb.functional.dequantize_4bit(a.weight.data, a.weight.quant_state)
+        w2 = bnb.functional.dequantize_4bit(b.weight.data, b.weight.quant_state)
+        torch.testing.assert_close(w1, w2, atol=0, rtol=0)
+
+    if torch.cuda.is_available():
+        model.cuda()
+        ref.cuda()
+        x = torch.randn(4, 64, device="cuda", dtype=torch.float16)
+        torch.testing.assert_close(ref(x), model(x), atol=0, rtol=0)
+
+
+def test_quantization_plan():
+    model = nn.Sequential(nn.Linear(64, 128), nn.ReLU(), nn.Sequential(nn.Linear(128, 64), nn.Linear(64, 32)), nn.Linear(32, 8))
+    with torch.no_grad():
+        for module in model.modules():
+            if isinstance(module, nn.Linear):
+                # rows of very different scales
+                module.weight.copy_(torch.randn_like(module.weight) * torch.logspace(-2, 0, module.out_features).unsqueeze(1))
+    candidates = [{"quant_type": quant_type, "blocksize": blocksize, "compress_statistics": False}
+                  for quant_type in ["fp4", "nf4"] for blocksize in [64, 256]] + [{"quant_type": "int8"}]
+    report = bnb.utils.quantization_report(model, candidates, skip_modules=["3"])
+    assert list(report) == ["0", "2.0", "2.1"]
+    for name, results in report.items():
+        assert len(results) == len(candidates) + 1
+        assert [result["bytes"] for result in results] == sorted(result["bytes"] for result in results)
+        by_config = {str(result["config"]): result for result in results}
+        # smaller blocks cost memory and reduce the error
+        small, large = by_config[str(candidates[2])], by_config[str(candidates[3])]
+        assert small["bytes"] > large["bytes"] and small["sqnr"] > large["sqnr"]
+        assert by_config[str(candidates[4])]["sqnr"] > small["sqnr"]
+
+    plan, total_bytes = bnb.utils.quantization_plan(report)
+    assert total_bytes == sum(results[0]["bytes"] for results in report.values())
+    plan, total_bytes = bnb.utils.quantization_plan(report, min_sqnr=math.inf)
+    assert all(config is None for config in plan.values())
+    plan, total_bytes = bnb.utils.quantization_plan(report, min_sqnr=30.0)
+    assert all(config == {"quant_type": "int8"} for config in plan.values())
+
+    plan = {"0": {"quant_type": "nf4", "blocksize": 128, "compress_statistics": False}, "2.0": {"quant_type": "int8"}, "2.1": None}
+    weight, bias = model[0].weight.data.clone(), model[0].bias.data.clone()
+    weight_int8, bias_int8 = model[2][0].weight.data.clone(), model[2][0].bias.data.clone()
+    bnb.utils.apply_quantization_plan(model, plan)
+    assert isinstance(model[0], bnb.nn.Linear4bit) and model[0].weight.blocksize == 128
+    assert isinstance(model[2][0], bnb.nn.Linear8bitLt) and model[2][0].weight.dtype == torch.int8
+    x = torch.randn(4, 128)
+    out, out_ref = model[2][0](x), torch.nn.functional.linear(x, weight_int8, bias_int8)
+    assert (out - out_ref).abs().mean() / out_ref.abs().mean() < 0.02
+    assert type(model[2][1]) is nn.Linear and type(model[3]) is nn.Linear
+    torch.testing.assert_close(model[0].bias.data, bias, atol=0, rtol=0)
+
+    packed, quant_state = bnb.functional.quantize_4bit(weight.half(), blocksize=128, compress_statistics=False, quant_type="nf4")
+    torch.testing.assert_close(model[0].weight.data, packed, atol=0, rtol=0)
 
 
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="this test requires a GPU")
+def test_linear8bitlt_save_load_quantized(tmp_path):
+    ref = bnb.nn.Linear8bitLt(64, 128, has_fp16_weights=False).cuda()
+    x = torch.randn(4, 64, device="cuda", dtype=torch.float16)
+    out_ref = ref(x)
+    path = str(tmp_path / "weights.bnb")
+    bnb.nn.save_quantized(ref, path)
+
+    model = bnb.nn.Linear8bitLt(64, 128, has_fp16_weights=False)
+    model.bias.data.copy_(ref.bias.data)
+    bnb.nn.load_quantized(model, path)
+    assert model.weight.dtype == torch.int8
+    model = model.cuda()
+    torch.testing.assert_close(out_ref, model(x), atol=0, rtol=0)
+
+
+
+def test_params4bit_quantize_cpu():
+    # moving to the CPU does not quantize, quantizing offline is explicit
+    linear = nn.Linear(64, 32)
+    layer = bnb.nn.Linear4bit(64, 32).to("cpu")
+    assert layer.weight.quant_state is None and layer.weight.dtype == torch.float32
+    layer.load_state_dict(linear.state_dict())
+    torch.testing.assert_close(layer.weight.data, linear.weight.data, atol=0, rtol=0)
+
+    weight = layer.weight.quantize()
+    assert weight is layer.weight and weight.dtype == torch.uint8
+    packed, quant_state = bnb.functional.quantize_4bit(linear.weight.data.half(), compress_statistics=True)
+    torch.testing.assert_close(weight.data, packed, atol=0, rtol=0)
+    assert weight.quantize() is weight
+    torch.testing.assert_close(weight.data, packed, atol=0, rtol=0)
+
+
+@pytest.mark.parametrize("quant_type", ["fp4", "nf4"])
+@pytest.mark.parametrize("compress_statistics", [False, True], ids=["nocompress", "compress"])
+def test_linear4bit_state_dict(tmp_path, quant_type, compress_statistics):
+    ref = bnb.nn.Linear4bit(64, 128, compress_statistics=compress_statistics, quant_type=quant_type)
+    ref.weight.quantize()
+    path = str(tmp_path / "linear4bit.pt")
+    torch.save(ref.state_dict(), path)
+    state_dict = torch.load(path)
+    assert state_dict["weight"].dtype == torch.uint8
+    assert state_dict["weight"].numel() == 64 * 128 // 2
+    assert ("weight.nested_absmax" in state_dict) == compress_statistics
+
+    # the module is not quantized before loading and no quantization pass runs on load
+    model = bnb.nn.Linear4bit(64, 128, quant_type=quant_type)
+    model.load_state_dict(state_dict)
+    assert model.weight.dtype == torch.uint8
+    assert model.weight.quant_type == quant_type
+    assert model.weight.compress_statistics == compress_statistics
+    torch.testing.assert_close(model.bias, ref.bias, atol=0, rtol=0)
+    w1 = bnb.functional.dequantize_4bit(ref.weight.data, ref.weight.quant_state)
+    w2 = bnb.functional.dequantize_4bit(model.weight.data, model.weight.quant_state)
+    torch.testing.assert_close(w1, w2, atol=0, rtol=0)
+
+    # saving again gives the same state_dict
+    for key, value in model.state_dict().items():
+        torch.testing.assert_close(value, state_dict[key], atol=0, rtol=0)
+
+
+@pytest.mark.parametrize("quant_type", ["fp4", "nf4"])
+def test_params4bit_absmax_cache_policy(quant_type):
+    layer = bnb.nn.Linear4bit(64, 128, compress_statistics=True, quant_type=quant_type)
+    layer.weight.quantize()
+    weight = layer.weight
+    assert weight.get_quant_state() is weight.quant_state
+
+    weight.absmax_cache_policy = "latency-minimal"
+    quant_state = weight.get_quant_state()
+    assert quant_state[-2] is None
+    assert weight.get_quant_state() is quant_state
+    torch.testing.assert_close(
+        bnb.functional.dequantize_4bit(weight.data, quant_state),
+        bnb.functional.dequantize_4bit(weight.data, weight.quant_state),
+        atol=0, rtol=0,
+    )
 
+    # a new quantization state is decoded again
+    weight._quantize(torch.randn(128, 64).half())
+    torch.testing.assert_close(
+        bnb.functional.dequantize_4bit(weight.data, weight.get_quant_state()),
+        bnb.functional.dequantize_4bit(weight.data, weight.quant_state),
+        atol=0, rtol=0,
+    )
 
-
+    with pytest.raises(ValueError):
+        bnb.nn.Params4bit(torch.randn(4, 4), absmax_cache_policy="fastest")
+
+
+def test_outlier_tracer_calibration(tmp_path):
+    torch.manual_seed(0)
+    model = nn.Sequential(nn.Linear(64, 128), nn.ReLU(), nn.Linear(128, 32))
+    batches = [torch.randn(8, 64) for i in range(6)]
+    for x in batches:
+        # dimension 5 has a large std, dimension 17 a single large value
+        x[:, 5] *= 20
+    batches[3][2, 17] = 10.0
+
+    tracer = bnb.utils.OutlierTracer.get_instance()
+    try:
+        outliers = tracer.calibrate(model, batches)
+        # the statistics over all batches are exact
+        inputs = torch.cat(batches)
+        stats = tracer.calibration_stats["0"]
+        assert stats.count == inputs.shape[0]
+        torch.testing.assert_close(stats.mean, inputs.mean(0))
+        torch.testing.assert_close(stats.std, inputs.std(0))
+        assert {5, 17} <= set(outliers["0"].tolist())
+        assert set(outliers) == {"0", "2"}
+
+        path = str(tmp_path / "outliers.bin")
+        tracer.save_profile(path)
+
+        class Layer(bnb.nn.OutlierAwareLinear):
+            def quantize_weight(self, w, outlier_idx):
+                return w
+
+        model2 = nn.Sequential(Layer(64, 128), nn.ReLU(), Layer(128, 32))
+        tracer.name2outlier_idx = {}
+        tracer.calibration_stats = {}
+        loaded = tracer.load_profile(path, model2)
+        for name in ["0", "2"]:
+            torch.testing.assert_close(loaded[name], outliers[name])
+        torch.testing.assert_close(model2[0].outlier_dim, outliers["0"])
+        torch.testing.assert_close(tracer.get_outliers(model2[2].weight), outliers["2"])
+
+        # loaded statistics continue the calibration
+        outliers = tracer.calibrate(model, batches[:2], resume=True)
+        assert tracer.calibration_stats["0"].count == inputs.shape[0] + 16
+        assert {5, 17} <= set(outliers["0"].tolist())
+    finally:
+        # the tracer is a singleton, do not leave the calibration to other tests
+        bnb.utils.OutlierTracer._instance = None
@@ -179,6 +179,314 @@ def test_optimizer32bit(dim1, dim2, gtype, optim_name):
             assert bnb_optimizer.state[p2]["unorm_vec"] > 0.0
 
 
+gtype = [torch.float32, torch.float16, torch.bfloat16]
+optimizer_names = ["adam", "momentum", "rmsprop", "lion"]
+values = list(product(gtype, optimizer_names))
+names = ["gtype_{}_optim_{}".format(*vals) for vals in values]
+
+
+@pytest.mark.parametrize("gtype, optim_name", values, ids=names)
+def test_optimizer32bit_cpu(gtype, optim_name):
+    shapes = [(1024, 32), (7,), (4097, 5), (16384,)]
+    p1 = [torch.randn(shape, dtype=gtype) * 0.1 for shape in shapes]
+    p2 = [p.clone() for p in p1]
+    p1 = [p.float() for p in p1]
+
+    torch_optimizer = str2optimizers[optim_name][0](p1)
+    bnb_optimizer = str2optimizers[optim_name][1](p2)
+
+    if gtype == torch.float32:
+        atol, rtol = 1e-6, 1e-5
+    elif gtype == torch.bfloat16:
+        atol, rtol = 1e-3, 1e-2
+    else:
+        atol, rtol = 1e-4, 1e-3
+
+    for i in range(k):
+        for a, b in zip(p1, p2):
+            g = torch.randn(a.shape, dtype=gtype) * 0.01
+            a.grad = g.clone().float()
+            b.grad = g.clone()
+
+        bnb_optimizer.step()
+        torch_optimizer.step()
+
+        for a, b in zip(p1, p2):
+            for name1, name2 in str2statenames[optim_name]:
+                torch.testing.assert_close(torch_optimizer.state[a][name1], bnb_optimizer.state[b][name2], atol=atol, rtol=rtol)
+            assert_most_approx_close(a, b.float(), atol, rtol, max_error_count=10)
+            if gtype != torch.float32:
+                a.data = a.data.to(b.dtype).float()
+                b.copy_(a.data)
+
+
+@pytest.mark.parametrize("optim_name", ["adam", "momentum", "rmsprop", "lion"])
+def test_optimizer32bit_cpu_fused_matches_single(optim_name):
+    # the fused update of a whole group has to be the same as updating each tensor on its own,
+    # including the per-tensor update norms and percentile clipping
+    optimizer_class = bnb.optim.optimizer.Optimizer2State if optim_name == "adam" else bnb.optim.optimizer.Optimizer1State
+    kwargs = dict(lr=0.01, betas=(0.9, 0.99), max_unorm=0.001, percentile_clipping=5)
+    shapes = [(1024, 32), (7,), (40000,)]
+    p1 = [torch.randn(shape) * 0.1 for shape in shapes]
+    p2 = [p.clone() for p in p1]
+    fused = optimizer_class(optim_name, p1, **kwargs)
+    single = [optimizer_class(optim_name, [p], **kwargs) for p in p2]
+
+    for i in range(5):
+        for a, b in zip(p1, p2):
+            a.grad = torch.randn(a.shape) * 0.01 * (i + 1)
+            b.grad = a.grad.clone()
+        fused.step()
+        for optimizer in single:
+            optimizer.step()
+        for a, b, optimizer in zip(p1, p2, single):
+            torch.testing.assert_close(a, b, atol=0.0, rtol=0.0)
+            torch.testing.assert_close(fused.state[a]["state1"], optimizer.state[b]["state1"], atol=0.0, rtol=0.0)
+            torch.testing.assert_close(fused.state[a]["unorm_vec"], optimizer.state[b]["unorm_vec"], atol=0.0, rtol=0.0)
+
+
+def test_optimizer_clip_gradients_one_transfer(monkeypatch):
+    # the clipping scales of all parameters updated one by one are copied to the host at once
+    calls = []
+    scales_to_host = F.scales_to_host
+    def count_transfers(scales):
+        calls.append(sum(isinstance(scale, torch.Tensor) for scale in scales))
+        return scales_to_host(scales)
+
+    monkeypatch.setattr(F, "scales_to_host", count_transfers)
+    shapes = [(1024, 32), (7,), (4097, 5)]
+    p1 = [torch.randn(shape) * 0.1 for shape in shapes]
+    p2 = [p.clone() for p in p1]
+    single = bnb.optim.Adam8bit(p1, percentile_clipping=5)
+    single.fused_step = False
+    fused = bnb.optim.Adam8bit(p2, percentile_clipping=5)
+    for i in range(3):
+        for a, b in zip(p1, p2):
+            a.grad = torch.randn(a.shape) * 0.01 * (i + 1)
+            b.grad = a.grad.clone()
+        calls.clear()
+        single.step()
+        assert [count for count in calls if count > 0] == [3]
+        fused.step()
+        for a, b in zip(p1, p2):
+            torch.testing.assert_close(a, b, atol=0.0, rtol=0.0)
+    assert single.gnorm_scales == {}
+
+
+@pytest.mark.parametrize("optim_name", ["adam8bit_blockwise", "lion8bit_blockwise", "momentum8bit_blockwise", "rmsprop8bit_blockwise"])
+def test_optimizer_fused_step_cpu(optim_name):
+    # small tensors get 32-bit states, large ones 8-bit blockwise states
+    shapes = [(1024, 32), (7,), (4097, 5), (100,), (16384, 3)]
+    p1 = [torch.randn(shape) * 0.1 for shape in shapes]
+    p2 = [p.clone() for p in p1]
+    fused = str2optimizers[optim_name][1](p1)
+    single = str2optimizers[optim_name][1](p2)
+    single.fused_step = False
+
+    for i in range(5):
+        for a, b in zip(p1, p2):
+            a.grad = torch.randn(a.shape) * 0.01
+            b.grad = a.grad.clone()
+        # skipped parameters and hyperparameter changes have to invalidate the cached step plan
+        if i == 2:
+            p1[3].grad = p2[3].grad = None
+        for group in fused.param_groups + single.param_groups:
+            group["lr"] *= 0.5
+        fused.step()
+        single.step()
+        for a, b in zip(p1, p2):
+            torch.testing.assert_close(a, b, atol=0.0, rtol=0.0)
+            for name in ["state1", "state2", "absmax1", "absmax2"]:
+                if name in fused.state[a]:
+                    torch.testing.assert_close(fused.state[a][name], single.state[b][name], atol=0.0, rtol=0.0)
+    assert {kind for kind, params in fused.step_plans[0][1]} == {"32bit", "8bit_blockwise"}
+
+
+def test_optimizer_fused_step_custom_update_step():
+    # buckets bypass update_step, so an override has to see every parameter
+    class CountingAdam(bnb.optim.Adam8bit):
+        def update_step(self, group, p, gindex, pindex):
+            self.calls.append(pindex)
+            super().update_step(group, p, gindex, pindex)
+
+    params = [torch.randn(shape) * 0.1 for shape in [(1024, 32), (7,), (4097, 5)]]
+    for p in params:
+        p.grad = torch.randn(p.shape) * 0.01
+    optimizer = CountingAdam(params)
+    optimizer.calls = []
+    optimizer.step()
+    assert optimizer.calls == [0, 1, 2]
+    assert optimizer.step_plans == {}
+
+
+@pytest.mark.parametrize("optim_name", ["adam", "adam8bit_blockwise", "lion8bit_blockwise"])
+def test_paged_optimizer_mmap_cpu(optim_name):
+    # large states of paged optimizers on the cpu are memory-mapped files and give the same updates
+    shapes = [(1024, 128), (7,), (300, 400)]
+    p1 = [torch.randn(shape) * 0.1 for shape in shapes]
+    p2 = [p.clone() for p in p1]
+    page_dir = get_temp_dir()
+    page_mng = F.GlobalPageManager.get_instance()
+    page_mng.page_dir = page_dir
+    try:
+        paged = str2optimizers["paged_" + optim_name][1](p1)
+        reference = str2optimizers[optim_name][1](p2)
+        for i in range(3):
+            for a, b in zip(p1, p2):
+                a.grad = torch.randn(a.shape) * 0.01
+                b.grad = a.grad.clone()
+            paged.step()
+            reference.step()
+            for a, b in zip(p1, p2):
+                torch.testing.assert_close(a, b, atol=0.0, rtol=0.0)
+                for name in ["state1", "state2"]:
+                    if name in paged.state[a]:
+                        torch.testing.assert_close(paged.state[a][name], reference.state[b][name], atol=0.0, rtol=0.0)
+
+        assert getattr(paged.state[p1[0]]["state1"], "page_buffer", None) is not None
+        assert getattr(paged.state[p1[1]]["state1"], "page_buffer", None) is None
+        # the files are unlinked when they are created
+        assert os.listdir(page_dir) == []
+        page_mng.evict_all()
+        # evicted states are written to their files
+        state1 = paged.state[p1[2]]["state1"]
+        assert os.pread(state1.page_file.fileno(), 64, 0) == state1.view(-1)[:64 // state1.element_size()].numpy().tobytes()
+        page_mng.prefetch_all()
+        torch.testing.assert_close(paged.state[p1[2]]["state1"], reference.state[p2[2]]["state1"], atol=0.0, rtol=0.0)
+    finally:
+        page_mng.initialize()
+        rm_path(page_dir)
+
+
+def test_paged_optimizer_unregister_cpu():
+    # each optimizer learns its own update order and its states are released once it is deleted
+    page_mng = F.GlobalPageManager.get_instance()
+    page_mng.initialize()
+    try:
+        params = [[torch.randn(400, 300) * 0.1 for i in range(2)] for j in range(2)]
+        optimizers = [bnb.optim.PagedAdam8bit(ps) for ps in params]
+        for i in range(2):
+            for optimizer, ps in zip(optimizers, params):
+                for p in ps:
+                    p.grad = torch.randn(p.shape) * 0.01
+                optimizer.step()
+        owners = [id(optimizer) for optimizer in optimizers]
+        assert len(page_mng.page_groups) == 4 and len(page_mng.paged_tensors) == 8
+        for key, next_key in page_mng.successors.items():
+            assert page_mng.owners[key] == page_mng.owners[next_key]
+
+        optimizers[0].load_state_dict(optimizers[0].state_dict())
+        assert set(page_mng.owners.values()) == {owners[1]} and len(page_mng.paged_tensors) == 4
+        del optimizers[1], optimizer
+        assert page_mng.page_groups == {} and page_mng.paged_tensors == []
+        assert page_mng.successors == {} and page_mng.last_keys == {}
+    finally:
+        page_mng.initialize()
+
+
+def test_config_cache_lr_scheduler():
+    p1 = torch.randn(1024, 32) * 0.1
+    p2 = torch.randn(1024, 32) * 0.1
+    mng = bnb.optim.GlobalOptimManager.get_instance()
+    mng.initialize()
+    mng.override_config(p2, "lr", 0.5)
+    mng.register_parameters([p1, p2])
+    adam = bnb.optim.Adam([p1, p2], lr=0.01)
+    scheduler = torch.optim.lr_scheduler.StepLR(adam, step_size=1, gamma=0.5)
+
+    configs = [adam.get_config(0, pindex, adam.param_groups[0]) for pindex in range(2)]
+    plan = None
+    for i in range(3):
+        p1.grad = torch.randn_like(p1) * 0.01
+        p2.grad = torch.randn_like(p2) * 0.01
+        adam.step()
+        scheduler.step()
+        # the lr of the scheduler updates the cached configs, the override is kept
+        group = adam.param_groups[0]
+        assert adam.get_config(0, 0, group) is configs[0]
+        assert adam.get_config(0, 1, group) is configs[1]
+        assert configs[0]["lr"] == group["lr"] == 0.01 * 0.5 ** (i + 1)
+        assert configs[1]["lr"] == 0.5
+        assert plan is None or adam.step_plans[0][1] is plan
+        plan = adam.step_plans[0][1]
+
+    mng.override_config(p1, "eps", 1e-6)
+    mng.register_parameters([p1, p2])
+    assert adam.get_config(0, 0, adam.param_groups[0])["eps"] == 1e-6
+    mng.initialize()
+
+
+@pytest.mark.parametrize("sharded", [False, True], ids=["state_dict", "shards"])
+def test_optimizer_state_load_cpu(sharded):
+    shapes = [(1024, 32), (7,), (4097, 5)]
+    p1 = [torch.randn(shape) * 0.1 for shape in shapes]
+    p2 = [p.clone() for p in p1]
+    optimizer = bnb.optim.Adam8bit(p1)
+    reference = bnb.optim.Adam8bit(p2)
+
+    for i in range(6):
+        for a, b in zip(p1, p2):
+            a.grad = torch.randn(a.shape) * 0.01
+            b.grad = a.grad.clone()
+        # the last parameter has no state before the first load
+        if i == 0:
+            p1[2].grad = p2[2].grad = None
+        optimizer.step()
+        reference.step()
+
+        if i % 2 == 0:
+            path = get_temp_dir()
+            if sharded:
+                optimizer.save_state_shards(path)
+                optimizer = bnb.optim.Adam8bit(p1)
+                optimizer.load_state_shards(path)
+            else:
+                state_dict = optimizer.state_dict()
+                optimizer = bnb.optim.Adam8bit(p1)
+                optimizer.load_state_dict(state_dict)
+                # the loaded state is a copy which still shares the quantization maps
+                assert optimizer.state[p1[0]]["state1"].data_ptr() != state_dict["state"][0]["state1"].data_ptr()
+                if i > 0:
+                    assert optimizer.state[p1[0]]["qmap1"] is optimizer.state[p1[2]]["qmap1"]
+            rm_path(path)
+
+        for a, b in zip(p1, p2):
+            torch.testing.assert_close(a, b, atol=0.0, rtol=0.0)
+            for name in ["state1", "state2", "absmax1", "absmax2", "qmap1", "qmap2"]:
+                if name in reference.state[b]:
+                    torch.testing.assert_close(optimizer.state[a][name], reference.state[b][name], atol=0.0, rtol=0.0)
+
+
+def test_optimizer_state_dict_qmaps():
+    p = [torch.randn(4097, 5) * 0.1 for i in range(3)]
+    optimizer = bnb.optim.Adam8bit(p)
+    for a in p:
+        a.grad = torch.randn(a.shape) * 0.01
+    optimizer.step()
+
+    state_dict = optimizer.state_dict()
+    assert set(state_dict["qmaps"]) == {"dynamic", "udynamic"}
+    for state in state_dict["state"].values():
+        assert state["qmap1"] == "dynamic" and state["qmap2"] == "udynamic"
+    # the live state still holds the tensors
+    assert isinstance(optimizer.state[p[0]]["qmap1"], torch.Tensor)
+
+    # checkpoints of older versions store a copy of the maps in every state
+    old_state_dict = {"param_groups": state_dict["param_groups"], "state": {}}
+    for k, state in state_dict["state"].items():
+        state = dict(state)
+        state["qmap1"] = state_dict["qmaps"]["dynamic"].clone()
+        state["qmap2"] = state_dict["qmaps"]["udynamic"].clone()
+        old_state_dict["state"][k] = state
+
+    for loaded in [state_dict, old_state_dict]:
+        optimizer2 = bnb.optim.Adam8bit(p)
+        optimizer2.load_state_dict(loaded)
+        assert len({id(optimizer2.state[a]["qmap1"]) for a in p}) == 1
+        assert len({id(optimizer2.state[a]["qmap2"]) for a in p}) == 1
+        torch.testing.assert_close(optimizer2.state[p[1]]["qmap2"], optimizer.state[p[1]]["qmap2"])
+
+
 dim1 = [1024]
 dim2 = [32, 1024, 4097]
 gtype = [torch.float32, torch.float16]
@@ -377,6 +685,88 @@ def test_optimizer8bit(dim1, dim2, gtype, optim_name):
     # print(sum(relerrors)/len(relerrors))
 
 
+optimizer_names = ["adam", "momentum", "rmsprop", "lion", "adagrad"]
+gtype = [torch.float32, torch.float16, torch.bfloat16]
+values = list(product(optimizer_names, gtype))
+names = ["optim_{}_gtype_{}".format(*vals) for vals in values]
+
+
+@pytest.mark.parametrize("optim_name, gtype", values, ids=names)
+def test_optimizer8bit_blockwise_cpu(optim_name, gtype):
+    n = 3*2048 + 17
+    beta1, beta2, eps, lr, weight_decay, step = 0.9, 0.995, 1e-8, 1e-3, 1e-2, 3
+    blocksize = 2048
+    qmap1 = F.create_dynamic_map(signed=True)
+    qmap2 = F.create_dynamic_map(signed=False)
+    p = torch.randn(n)*0.1
+    g = torch.randn(n)*0.01
+    g[::7] = 0.0
+    if optim_name in ["rmsprop", "adagrad"]:
+        s1 = torch.rand(n)*1e-4
+    else:
+        s1 = torch.randn(n)*1e-2
+    s2 = torch.rand(n)*1e-4
+    state1, qs1 = F.quantize_blockwise(s1, code=qmap1.clone(), blocksize=blocksize)
+    state2, qs2 = F.quantize_blockwise(s2, code=qmap2.clone(), blocksize=blocksize)
+    absmax1, absmax2 = qs1[0], qs2[0]
+    p, g = p.to(gtype), g.to(gtype)
+
+    # reference update in 32-bit on the dequantized states
+    s1 = F.dequantize_blockwise(state1, absmax=absmax1, code=qmap1, blocksize=blocksize)
+    s2 = F.dequantize_blockwise(state2, absmax=absmax2, code=qmap2, blocksize=blocksize)
+    p_ref, g32 = p.float(), g.float()
+    if optim_name == "adam":
+        s1 = s1*beta1 + (1-beta1)*g32
+        s2 = s2*beta2 + (1-beta2)*g32*g32
+        correction1 = 1 - beta1**step
+        correction2 = (1 - beta2**step)**0.5
+        p_ref = p_ref - lr*correction2/correction1*(s1/(s2.sqrt() + correction2*eps))
+        p_ref = p_ref*(1 - lr*weight_decay)
+    elif optim_name == "lion":
+        p_ref = p_ref*(1 - lr*weight_decay)
+        p_ref = p_ref - lr*torch.sign(s1*beta1 + (1-beta1)*g32)
+        s1 = s1*beta2 + (1-beta2)*g32
+    else:
+        g_wd = g32 + p_ref*weight_decay
+        if optim_name == "momentum":
+            s1 = s1*beta1 + g_wd
+            p_ref = p_ref - lr*s1
+        else:
+            s1 = s1*beta1 + (1-beta1)*g_wd*g_wd if optim_name == "rmsprop" else s1 + g_wd*g_wd
+            p_ref = p_ref - lr*(g32/(s1.sqrt() + eps))
+
+    state2_arg, qmap2_arg, absmax2_arg = (state2, qmap2, absmax2) if optim_name == "adam" else (None, None, None)
+    p_cpu, state1_cpu, absmax1_cpu = p.clone(), state1.clone(), absmax1.clone()
+    state2_cpu = None if state2_arg is None else state2.clone()
+    absmax2_cpu = None if absmax2_arg is None else absmax2.clone()
+    F.optimizer_update_8bit_blockwise(optim_name, g, p_cpu, state1_cpu, state2_cpu, beta1, beta2, eps, step, lr,
+                                      qmap1, qmap2_arg, absmax1_cpu, absmax2_cpu, weight_decay)
+
+    if gtype == torch.float32:
+        torch.testing.assert_close(p_cpu, p_ref, atol=1e-6, rtol=1e-5)
+    else:
+        torch.testing.assert_close(p_cpu, p_ref.to(gtype), atol=1e-3, rtol=1e-2)
+    absmax1_ref = torch.stack([block.abs().max() for block in s1.split(blocksize)])
+    torch.testing.assert_close(absmax1_cpu, absmax1_ref, rtol=1e-5, atol=0.0)
+    err1 = (F.dequantize_blockwise(state1_cpu, absmax=absmax1_cpu, code=qmap1, blocksize=blocksize) - s1).abs()
+    assert (err1 <= 0.02*absmax1_cpu.repeat_interleave(blocksize)[:n]).all()
+    if optim_name == "adam":
+        err2 = (F.dequantize_blockwise(state2_cpu, absmax=absmax2_cpu, code=qmap2, blocksize=blocksize) - s2).abs()
+        assert (err2 <= 0.02*absmax2_cpu.repeat_interleave(blocksize)[:n]).all()
+
+    has_cuda_kernel = optim_name in ["adam", "lion"] or gtype != torch.bfloat16
+    if torch.cuda.is_available() and has_cuda_kernel:
+        tensors = [p.clone(), state1.clone(), absmax1.clone()]
+        tensors += [None, None] if state2_arg is None else [state2.clone(), absmax2.clone()]
+        p_gpu, state1_gpu, absmax1_gpu, state2_gpu, absmax2_gpu = [None if t is None else t.cuda() for t in tensors]
+        F.optimizer_update_8bit_blockwise(optim_name, g.cuda(), p_gpu, state1_gpu, state2_gpu, beta1, beta2, eps, step, lr,
+                                          qmap1.cuda(), None if qmap2_arg is None else qmap2.cuda(),
+                                          absmax1_gpu, absmax2_gpu, weight_decay)
+        torch.testing.assert_close(p_cpu, p_gpu.cpu(), atol=1e-5, rtol=1e-3)
+        torch.testing.assert_close(absmax1_cpu, absmax1_gpu.cpu())
+        assert ((state1_cpu.int() - state1_gpu.cpu().int()).abs() > 1).sum() == 0
+
+
 dim1 = [1024]
 dim2 = [32, 1024, 4097]
 gtype = [torch.float32]